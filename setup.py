@@ -47,6 +47,7 @@ setup(name='SynFU',
         'console_scripts' : [
             'synfu-reactor = synfu.reactor:ReactorRun',
             'synfu-mail2news = synfu.postfilter:FilterMail2News',
+            'synfu-mail2news-drain = synfu.postfilter:FilterMail2NewsDrain',
             'synfu-news2mail = synfu.postfilter:FilterNews2Mail',
             'synfu-imp       = synfu.imp:ImpRun'
         ],
@@ -1,4 +1,7 @@
 import config
+import blacklist
+import nntp
+import spool
 import fucore
 import reactor
 import postfilter
@@ -0,0 +1,434 @@
+# encoding: utf-8
+#
+# blacklist.py
+#
+# Copyright (c) 2009-2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+.. module:: blacklist
+    :platform: Unix, MacOS
+    :synopsis: Compiled blacklist index.
+
+.. moduleauthor:: René Köcher <shirk@bitspin.org>
+
+"""
+
+import os, time, mmap, struct, tempfile, threading
+
+def _hash(key):
+    h = 5381
+    for c in key:
+        h = (((h << 5) + h) & 0xffffffff) ^ ord(c)
+    
+    return h
+
+class Blacklist(object):
+    """
+    Read-only view of the blacklist file.
+    
+    The text file is compiled into a constant database (`cdb`_ layout)
+    next to it which is rebuilt whenever the modification time or size of
+    the text file changes. Lookups go through :mod:`mmap` so the cost of
+    loading the blacklist does not depend on the number of entries.
+    
+    If the index can't be written the blacklist is kept in memory.
+    
+    Besides plain addresses entries may block whole domains:
+    
+        * ``*@spam.example`` matches any address at spam.example
+        * ``*.example`` matches any address at a subdomain of example
+    
+    Wildcards are looked up label by label (see :meth:`Blacklist.match`),
+    so their cost depends on the length of the domain and not on the
+    number of rules.
+    
+    Long running processes pick up changes of the text file (or an index
+    rebuilt by another process) on their own: at most every *interval*
+    seconds :meth:`Blacklist.match` checks the file and, if needed, loads
+    the new index in a background thread. Lookups keep using the previous
+    index until the new one is swapped in.
+    
+    .. _`cdb`: http://cr.yp.to/cdb/cdb.txt
+    """
+    
+    INDEX_SUFFIX = '.cdb'
+    
+    # the index stores the mtime and size of the file it was built from
+    SOURCE_KEY   = '\0source'
+    
+    ACTIONS      = ['d', 'n', 'e', 'ne', 'en']
+    
+    def __init__(self, filename, index=None, log=None, interval=0):
+        """
+        :param filename: Path of the blacklist text file.
+        :param    index: Optional path of the compiled index
+                         (defaults to *filename* + :attr:`Blacklist.INDEX_SUFFIX`)
+        :param      log: Optional logging callable like :meth:`synfu.fucore.FUCore._log`.
+        :param interval: Check for changes at most every *interval* seconds (0 = never).
+        """
+        super(Blacklist, self).__init__()
+        
+        self._filename = filename
+        self._index    = index or filename + Blacklist.INDEX_SUFFIX
+        self._log      = log or (lambda *args, **kwargs: None)
+        self._interval = interval
+        self._state    = (None, {}, None)
+        self._next     = 0
+        self._loader   = None
+        self._owner    = None
+        
+        self.open()
+    
+    def open(self):
+        """
+        Map the index, rebuilding it if the text file changed.
+        
+        :returns: :const:`None`
+        """
+        self.close()
+        self._state = self._load()
+        self._next  = time.time() + self._interval
+    
+    def close(self):
+        """
+        Unmap the index.
+        
+        :returns: :const:`None`
+        """
+        (index, entries, stamp) = self._state
+        if index is not None:
+            index.close()
+        
+        self._state = (None, {}, None)
+    
+    def check(self):
+        """
+        Reload the blacklist in the background if it changed.
+        
+        Does nothing if the last check is less than *interval* seconds ago
+        or a reload is already running (in this process).
+        
+        :returns: :const:`True` if a reload was started.
+        """
+        now = time.time()
+        
+        if self._loader is not None and self._owner != os.getpid():
+            # forked while reloading, the thread only runs in the parent
+            self._loader = None
+        
+        if self._interval <= 0 or now < self._next or self._loader is not None:
+            return False
+        
+        self._next = now + self._interval
+        
+        if self._stamp() == self._state[2]:
+            return False
+        
+        self._log('--- blacklist "{0}" changed, reloading', self._filename, verbosity=2)
+        
+        self._owner  = os.getpid()
+        self._loader = threading.Thread(target=self._reload)
+        self._loader.setDaemon(True)
+        self._loader.start()
+        return True
+    
+    def get(self, addr, default=None):
+        """
+        Look up the blacklist entry for *addr*.
+        
+        :param    addr: The mail address.
+        :param default: Returned if *addr* is not blacklisted.
+        :returns: A dictionary with the keys `addr`, `action` and `param` or *default*.
+        """
+        (index, entries, stamp) = self._state
+        
+        if index is not None:
+            data = self._find(addr, index)
+        else:
+            data = entries.get(addr)
+        
+        if data is None or addr == Blacklist.SOURCE_KEY:
+            return default
+        
+        (action, param) = data.split(';', 1)
+        return { 'addr'   : addr,
+                 'action' : action,
+                 'param'  : param or None }
+    
+    def match(self, *addrs):
+        """
+        Find the blacklist entry for the first of *addrs* which is blacklisted.
+        
+        Exact addresses take precedence over ``*@domain`` rules and those
+        over ``*.domain`` ones (each for all *addrs*), longer domains over
+        shorter ones. The action of the matching rule is used as is
+        (see :ref:`synfu-blacklist`).
+        
+        :param addrs: Lowercased mail addresses in order of preference.
+        :returns: See :meth:`Blacklist.get` or :const:`None`.
+        """
+        self.check()
+        
+        for addr in addrs:
+            entry = self.get(addr)
+            if entry:
+                return entry
+        
+        domains = [addr.rsplit('@', 1)[1].strip('.') for addr in addrs if '@' in addr]
+        domains = [domain for domain in domains if domain]
+        
+        for domain in domains:
+            entry = self.get('*@' + domain)
+            if entry:
+                return entry
+        
+        for domain in domains:
+            labels = domain.split('.')
+            for i in xrange(1, len(labels)):
+                entry = self.get('*.' + '.'.join(labels[i:]))
+                if entry:
+                    return entry
+        
+        return None
+    
+    def _stamp(self):
+        """
+        Identify the current text file and index.
+        
+        :returns: A tuple of the text file's mtime and size and the index inode.
+        """
+        try:
+            info   = os.stat(self._filename)
+            source = '{0:.6f} {1}'.format(info.st_mtime, info.st_size)
+        except OSError:
+            source = None
+        
+        try:
+            inode = os.stat(self._index).st_ino
+        except OSError:
+            inode = None
+        
+        return (source, inode)
+    
+    def _load(self):
+        """
+        Map the index, rebuilding it if the text file changed.
+        
+        :returns: A new (index, entries, stamp) state.
+        """
+        try:
+            info = os.stat(self._filename)
+        except OSError, e:
+            self._log('!!! failed to open blacklist file "{0}": {1}', self._filename, str(e))
+            return (None, {}, (None, None))
+        
+        source = '{0:.6f} {1}'.format(info.st_mtime, info.st_size)
+        
+        try:
+            (index, inode) = self._map_index()
+            if self._find(Blacklist.SOURCE_KEY, index) == source:
+                return (index, {}, (source, inode))
+            
+            index.close()
+        except (IOError, OSError, ValueError, struct.error):
+            pass
+        
+        self._log('--- compiling blacklist "{0}"', self._filename, verbosity=2)
+        
+        try:
+            entries = self._parse()
+        except IOError, e:
+            self._log('!!! failed to open blacklist file "{0}": {1}', self._filename, str(e))
+            return (None, {}, (None, None))
+        
+        try:
+            self._write_index(entries, source)
+            (index, inode) = self._map_index()
+            return (index, {}, (source, inode))
+        except (IOError, OSError), e:
+            self._log('!!! failed to write blacklist index "{0}": {1}', self._index, str(e))
+            
+            entries = dict((addr, '{0};{1}'.format(action, param or ''))
+                           for (addr, action, param) in entries)
+            return (None, entries, (source, None))
+    
+    def _reload(self):
+        """
+        Load the blacklist and swap it in (runs in a background thread).
+        
+        The previous index is not closed as lookups might still use it,
+        it is unmapped as soon as the last of them is done.
+        
+        :returns: :const:`None`
+        """
+        try:
+            self._state = self._load()
+        finally:
+            self._loader = None
+    
+    def _parse(self):
+        """
+        Parse and validate the blacklist text file.
+        
+        :returns: A list of (addr, action, param) tuples.
+        """
+        blacklist_file = open(self._filename)
+        entries = {}
+        
+        try:
+            for (lno, line) in enumerate(blacklist_file):
+                line = line.strip()
+                if line.startswith('#'):
+                    continue
+                fields = [x.strip() for x in line.split(';') if x]
+                if len(fields) < 2 or len(fields) > 3:
+                    self._log("!!! {0}:{1}: invalid field count {2} expected 2 or 3",
+                              self._filename, lno + 1, len(fields))
+                    continue
+                elif fields[1].lower() in ['e','ne','en'] and not len(fields) == 3:
+                    self._log('!!! {0}:{1}: invalid field count {2} for rule "{3}"',
+                              self._filename, lno + 1, len(fields), fields[1])
+                    continue
+                elif not fields[1].lower() in Blacklist.ACTIONS:
+                    self._log('!!! {0}:{1}: invalid rule "{2}"',
+                              self._filename, lno + 1, fields[1])
+                    continue
+                
+                elif fields[0].startswith('*') and not (fields[0][1:2] in ['@', '.'] and
+                                                        fields[0][2:].strip('.')):
+                    self._log('!!! {0}:{1}: invalid wildcard "{2}"',
+                              self._filename, lno + 1, fields[0])
+                    continue
+                
+                if fields[0].startswith('*'):
+                    # domains are matched case insensitive
+                    fields[0] = fields[0][:2] + fields[0][2:].strip('.').lower()
+                
+                if len(fields) == 2:
+                    fields.append(None)
+                
+                entries[fields[0]] = tuple(fields)
+                self._log('--- blacklist: <addr: {0}>; <action: {1}>; <param: {2}>',
+                          fields[0], fields[1], fields[2], verbosity=3)
+        finally:
+            blacklist_file.close()
+        
+        return entries.values()
+    
+    def _write_index(self, entries, source):
+        """
+        Write *entries* to a new index replacing the current one.
+        
+        :param entries: A list of (addr, action, param) tuples.
+        :param  source: The value stored for :attr:`Blacklist.SOURCE_KEY`.
+        :returns: :const:`None`
+        """
+        records = [(Blacklist.SOURCE_KEY, source)]
+        records.extend((addr, '{0};{1}'.format(action, param or ''))
+                       for (addr, action, param) in entries)
+        
+        (fd, tmp) = tempfile.mkstemp(prefix='.blacklist-', dir=os.path.dirname(os.path.abspath(self._index)))
+        try:
+            index  = os.fdopen(fd, 'wb')
+            tables = [[] for i in xrange(256)]
+            pos    = 2048
+            
+            index.write('\0' * pos)
+            
+            for (key, data) in records:
+                h = _hash(key)
+                tables[h & 0xff].append((h, pos))
+                
+                index.write(struct.pack('<LL', len(key), len(data)))
+                index.write(key)
+                index.write(data)
+                pos += 8 + len(key) + len(data)
+            
+            header = []
+            for table in tables:
+                slots = [(0, 0)] * (len(table) * 2)
+                
+                for (h, rpos) in table:
+                    i = (h >> 8) % len(slots)
+                    while slots[i][1]:
+                        i = (i + 1) % len(slots)
+                    slots[i] = (h, rpos)
+                
+                header.append(struct.pack('<LL', pos, len(slots)))
+                index.write(''.join(struct.pack('<LL', h, rpos) for (h, rpos) in slots))
+                pos += 8 * len(slots)
+            
+            index.seek(0)
+            index.write(''.join(header))
+            index.close()
+            
+            os.chmod(tmp, 0644)
+            os.rename(tmp, self._index)
+        except:
+            os.unlink(tmp)
+            raise
+    
+    def _map_index(self):
+        """
+        Map the index into memory.
+        
+        :returns: A tuple of the :class:`mmap.mmap` and the inode of the index.
+        """
+        index = open(self._index, 'rb')
+        try:
+            return (mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ),
+                    os.fstat(index.fileno()).st_ino)
+        finally:
+            index.close()
+    
+    def _find(self, key, index):
+        """
+        Look up *key* in the mapped *index*.
+        
+        :param   key: The key to look up.
+        :param index: The :class:`mmap.mmap` of the index.
+        :returns: The stored value or :const:`None`.
+        """
+        h = _hash(key)
+        
+        (tpos, tlen) = struct.unpack_from('<LL', index, (h & 0xff) << 3)
+        if not tlen:
+            return None
+        
+        i = (h >> 8) % tlen
+        for n in xrange(tlen):
+            (sh, rpos) = struct.unpack_from('<LL', index, tpos + (i << 3))
+            if not rpos:
+                return None
+            
+            if sh == h:
+                (klen, dlen) = struct.unpack_from('<LL', index, rpos)
+                if klen == len(key) and index[rpos + 8:rpos + 8 + klen] == key:
+                    return index[rpos + 8 + klen:rpos + 8 + klen + dlen]
+            
+            i = (i + 1) % tlen
+        
+        return None
@@ -57,7 +57,14 @@ class _FUCoreConfig(yaml.YAMLObject):
         self.log_interval = 1
         self.log_keep = 14
         self.log_traceback = None
+        self.log_queue_size = 1024
+        self.log_max_arg = 0
+        self.log_sample = 1
         self.blacklist_filename = None
+        self.blacklist_index = None
+        self.blacklist_interval = 60
+        self.tag_cache_size = 256
+        self.tag_cache_evict = 16
         self.settings = {}
 
     def configure(self):
@@ -69,7 +76,14 @@ class _FUCoreConfig(yaml.YAMLObject):
         self.log_when = self.settings.get('log_when', 'D')
         self.log_interval = self.settings.get('log_interval', 1)
         self.log_keep = self.settings.get('log_keep', 14)
+        self.log_queue_size = self.settings.get('log_queue_size', 1024)
+        self.log_max_arg = self.settings.get('log_max_arg', 0)
+        self.log_sample = self.settings.get('log_sample', 1)
         self.blacklist_filename = self.settings.get('blacklist_filename', None)
+        self.blacklist_index = self.settings.get('blacklist_index', None)
+        self.blacklist_interval = self.settings.get('blacklist_interval', 60)
+        self.tag_cache_size = self.settings.get('tag_cache_size', 256)
+        self.tag_cache_evict = self.settings.get('tag_cache_evict', 16)
 
 class _ReactorConfig(_FUCoreConfig):
     yaml_tag = u'tag:news.piratenpartei.de,2009:synfu/reactor'
@@ -90,8 +104,114 @@ class _ReactorConfig(_FUCoreConfig):
         self.complex_footer = self.settings.get('complex_footer', False)
         self.strip_notes    = self.settings.get('strip_notes', False)
         self.fix_dateline   = self.settings.get('fix_dateline', False)
+        self.workers        = self.settings.get('workers', 1)
+        self.spill_threshold = self.settings.get('spill_threshold', 0)
+        
+        self.footer_parts            = self.settings.get('footer_parts', 0)
+        self.footer_max_size         = self.settings.get('footer_max_size', 0)
+        self.footer_skip_attachments = self.settings.get('footer_skip_attachments', False)
+        self.footer_window           = self.settings.get('footer_window', 4096)
+        self.footer_full_scan        = self.settings.get('footer_full_scan', False)
+        self.footer_cache            = self.settings.get('footer_cache', None)
+        self.footer_cache_size       = self.settings.get('footer_cache_size', 64)
+        self.footer_cache_misses     = self.settings.get('footer_cache_misses', 3)
         return self
 
+class _FilterIndex(object):
+    """
+    Routing index over the postfilter *filters*.
+    
+    Plain expressions (like ``.*listname@host``) are indexed by one of their
+    literal substrings, all other expressions are prefiltered by a single
+    combined expression.  :meth:`lookup` only narrows down the candidates,
+    each candidate still has to be matched using it's own expression.
+    """
+    
+    PLAIN_EXP = re.compile(r'^(?:\.\*)?([\w@.\-]+)\Z')
+    KEY_SIZE  = 4
+    
+    def __init__(self, filters):
+        self._filters = []
+        self._keys    = {}
+        self._always  = []
+        self._rest    = []
+        
+        combined = []
+        
+        for e in filters:
+            if not 'exp' in e:
+                continue
+            
+            pos = len(self._filters)
+            self._filters.append(e)
+            
+            key = self._key(e['smtp'])
+            if key:
+                self._keys.setdefault(key, []).append(pos)
+            elif e['exp'].groups or '(?' in e['smtp']:
+                # can't be merged without changing it's meaning
+                self._always.append(pos)
+            else:
+                self._rest.append(pos)
+                combined.append('(?:{0})'.format(e['smtp']))
+        
+        self._rest_exp = None
+        if combined:
+            try:
+                self._rest_exp = re.compile('(?i){0}'.format('|'.join(combined)))
+            except Exception:
+                self._always = sorted(self._always + self._rest)
+                self._rest   = []
+    
+    def __len__(self):
+        return len(self._filters)
+    
+    def _key(self, smtp):
+        """
+        Pick the index key for the plain expression *smtp*.
+        
+        Unescaped dots match any character so only the literal runs between
+        them are considered, the key used least so far wins.
+        
+        :param smtp: the filter expression
+        :returns:    a lowercase key of :attr:`KEY_SIZE` characters or None
+        """
+        m = self.PLAIN_EXP.match(smtp)
+        if not m:
+            return None
+        
+        best = None
+        for run in m.group(1).lower().split('.'):
+            for i in xrange(len(run) - self.KEY_SIZE + 1):
+                key = run[i:i + self.KEY_SIZE]
+                if best is None or \
+                   len(self._keys.get(key, ())) < len(self._keys.get(best, ())):
+                    best = key
+        return best
+    
+    def lookup(self, values):
+        """
+        Return the filters which might match any of *values* in config order.
+        
+        :param values: list of strings (List-Id, recipients)
+        :returns:      list of filter entries
+        """
+        found = set(self._always)
+        size  = self.KEY_SIZE
+        
+        for value in values:
+            if self._keys:
+                low = value.lower()
+                for i in xrange(len(low) - size + 1):
+                    hit = self._keys.get(low[i:i + size])
+                    if hit:
+                        found.update(hit)
+            
+            if self._rest_exp and self._rest_exp.search(value):
+                found.update(self._rest)
+        
+        return [self._filters[i] for i in sorted(found)]
+
 class _PostfilterConfig(_FUCoreConfig):
     yaml_tag = u'tag:news.piratenpartei.de,2009:synfu/postfilter'
     
@@ -116,6 +236,32 @@ class _PostfilterConfig(_FUCoreConfig):
         self.log_news2mail   = self.settings.get('log_news2mail', self.log_filename)
         self.use_path_marker = self.settings.get('use_path_marker', False)
         self.path_marker     = self.settings.get('path_marker', socket.gethostname()).strip()
+        self.spill_threshold = self.settings.get('spill_threshold', 0)
+        self.mail2news_reactor = self.settings.get('mail2news_reactor', False)
+        
+        self.mail2news_transport = self.settings.get('mail2news_transport', 'cmd')
+        self.nntp_host           = self.settings.get('nntp_host', 'localhost')
+        self.nntp_port           = self.settings.get('nntp_port', 119)
+        self.nntp_timeout        = self.settings.get('nntp_timeout', 60)
+        self.nntp_pipeline       = self.settings.get('nntp_pipeline', 8)
+        self.nntp_distribution   = self.settings.get('nntp_distribution', None)
+        self.nntp_drop_headers   = self.settings.get('nntp_drop_headers',
+                                                     ['Received', 'Return-Path', 'Delivered-To',
+                                                      'Xref', 'Lines', 'NNTP-Posting-Host',
+                                                      'NNTP-Posting-Date'])
+        
+        self.mail2news_spool     = self.settings.get('mail2news_spool', None)
+        self.spool_workers       = self.settings.get('spool_workers', 1)
+        self.spool_batch         = self.settings.get('spool_batch', 64)
+        self.spool_interval      = self.settings.get('spool_interval', 5)
+        self.spool_compress      = self.settings.get('spool_compress', 0)
+        self.spool_max_age       = self.settings.get('spool_max_age', 5 * 86400)
+        self.spool_stale         = self.settings.get('spool_stale', 3600)
+        
+        if not self.mail2news_transport in ['cmd', 'post', 'ihave', 'stream']:
+            sys.stderr.write('Unknown mail2news_transport "{0}", using "cmd"\n'.format(
+                             self.mail2news_transport))
+            self.mail2news_transport = 'cmd'
         
         for e in self.filters:
             try:
@@ -127,6 +273,8 @@ class _PostfilterConfig(_FUCoreConfig):
             if not 'approve' in e:
                 e['approve'] = None
         
+        self.filter_index = _FilterIndex(self.filters)
+        
         return self
 
 class _ImpConfig(_FUCoreConfig):
@@ -161,6 +309,10 @@ class Config(object):
         After a call to :meth:`Config.get` the parsed options and arguments will
         be accessible as :attr:`Config.option` and :attr:`Config.optargs`.
         
+        Adding an option again is a no-op as long as it uses the same option
+        strings, destination and action, otherwise :exc:`optparse.OptionConflictError`
+        is raised.
+        
         :param: \*args: positional arguments to passed to :meth:`optparse.OptionParser.add_option`
         :param: \**keywords: keyword arguments to passed to :meth:`optpars.OptionParser.add_option`
         :returns: None
@@ -170,7 +322,30 @@ class Config(object):
             Config._parser = optparse.OptionParser()
             
         if args:
-            Config._parser.add_option(*args, **kwargs)
+            strings = [arg for arg in args if arg]
+            known   = [Config._parser.get_option(arg) for arg in strings if Config._parser.has_option(arg)]
+            
+            if known:
+                # shared by several tools (like --workers used by the
+                # drainer and it's in-process reactor), keep the first one
+                probe  = optparse.Option(*args, **kwargs)
+                option = known[0]
+                
+                if len(known) != len(strings) or [o for o in known if o is not option] or \
+                   option.dest != probe.dest or option.action != probe.action:
+                    raise optparse.OptionConflictError(
+                        'conflicting option string(s): {0}'.format(', '.join(strings)), option)
+                
+                return
+            
+            option = Config._parser.add_option(*args, **kwargs)
+            
+            if Config._sharedConfig and option.dest and \
+               not hasattr(Config._sharedConfig.options, option.dest):
+                # added after the command line was parsed (like a Reactor
+                # created by synfu-mail2news), use the default value
+                setattr(Config._sharedConfig.options, option.dest,
+                        Config._parser.defaults.get(option.dest))
 
     @classmethod
     def get(cls, *args):
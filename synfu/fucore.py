@@ -38,14 +38,154 @@
 
 """
 
-import sys, os, re, quopri
+import sys, os, re, quopri, random
 import time
+import heapq
+import tempfile
 import traceback
+import threading
+import Queue
+import atexit
 import logging
 import logging.handlers
 import email, email.message, email.header
 from logging.handlers import TimedRotatingFileHandler, SysLogHandler
 
+from synfu.blacklist import Blacklist
+
+class _LRUCache(object):
+    """
+    A small least recently used cache with hit/miss counters.
+    
+    Once *size* entries are stored the *evict* least recently used
+    entries are dropped at once to make room for new ones.
+    A *size* of 0 disables the cache.
+    """
+    
+    def __init__(self, size, evict=1):
+        self.size   = size
+        self.evict  = max(evict, 1)
+        self.hits   = 0
+        self.misses = 0
+        
+        self._data  = {}
+        self._clock = 0
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        """
+        Return the value cached for *key* or *default*.
+        """
+        entry = self._data.get(key)
+        
+        if entry is None:
+            self.misses += 1
+            return default
+        
+        self.hits   += 1
+        self._clock += 1
+        entry[1]     = self._clock
+        return entry[0]
+    
+    def set(self, key, value):
+        """
+        Cache *value* for *key*.
+        """
+        if self.size <= 0:
+            return
+        
+        if not key in self._data and len(self._data) >= self.size:
+            for old in heapq.nsmallest(self.evict, self._data, key=lambda x: self._data[x][1]):
+                del self._data[old]
+        
+        self._clock += 1
+        self._data[key] = [value, self._clock]
+    
+    def clear(self):
+        """
+        Drop all entries (the counters are kept).
+        """
+        self._data.clear()
+
+class _QueueHandler(logging.Handler):
+    """
+    A logging handler passing records on to a background thread.
+    
+    The thread formats and writes the records using *target* so logging
+    never blocks on a slow syslog or log disk. At most *size* records
+    are queued, any further ones are dropped and counted.
+    
+    Processes forked from the creating one (like the workers of
+    ``synfu-reactor --batch``) have no such thread and log directly.
+    """
+    
+    def __init__(self, target, size):
+        logging.Handler.__init__(self)
+        
+        self.target    = target
+        self.dropped   = 0
+        
+        self._reported = 0
+        self._pid      = os.getpid()
+        self._queue    = Queue.Queue(size)
+        self._thread   = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+    
+    def emit(self, record):
+        if os.getpid() != self._pid:
+            self.target.handle(record)
+            return
+        
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+    
+    def flush(self):
+        """
+        Wait until all queued records are written.
+        """
+        if os.getpid() == self._pid and self._thread.isAlive():
+            self._queue.join()
+        
+        self._report_dropped()
+        self.target.flush()
+    
+    def close(self):
+        """
+        Write all queued records and stop the background thread.
+        """
+        if os.getpid() == self._pid and self._thread.isAlive():
+            self._queue.put(None)
+            self._thread.join()
+        
+        self._report_dropped()
+        self.target.close()
+        logging.Handler.close(self)
+    
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                
+                self._report_dropped()
+                self.target.handle(record)
+            finally:
+                self._queue.task_done()
+    
+    def _report_dropped(self):
+        dropped = self.dropped
+        if dropped > self._reported:
+            self.target.handle(logging.LogRecord(self.target.name, logging.WARNING, __file__, 0,
+                                                 '!!! {0} log messages dropped'.format(dropped - self._reported),
+                                                 None, None))
+            self._reported = dropped
+
 class FUCore(object):
     """
     FUCore contains the generic code and utility methods shared by both
@@ -60,6 +200,21 @@ class FUCore(object):
     	re.compile('^(Lines|NNTP-Posting-(Date|Host)|Xref|Path)')
     ]
     
+    # headers matching HEADER_IGN which are kept anyway
+    # (X-Message-ID is the original of a repaired Message-ID)
+    HEADER_KEEP = frozenset(['x-no-archive', 'x-message-id'])
+    
+    # all of HEADER_IGN in one (case insensitive) expression
+    HEADER_IGN_EXP = re.compile('(?i)' + '|'.join('(?:{0})'.format(e.pattern) for e in HEADER_IGN))
+    
+    # keep/drop decisions of _filter_headers by header whitelist and
+    # lowercased header name, shared by all instances
+    HEADER_CACHE       = _LRUCache(16)
+    HEADER_CACHE_NAMES = 1024
+    HEADER_CACHE_STATS = [0, 0]
+    
+    NO_TAG_EXP  = re.compile('(?i)\s*\[[^]]*(?# This is here to confuse people)\]\s*')
+    
     CANCEL_EXP  = re.compile('(?i)\s*cancel(?# Aren\'t you confused now?)\s*')
     
     OUTLOOK_HACKS = [
@@ -67,6 +222,14 @@ class FUCore(object):
             (re.compile(r'\b(FWD|WG|WTR|Wtr\.):', re.I), 'Fwd:'),
     ]
     
+    # all of OUTLOOK_HACKS in one expression, see _fix_outlook()
+    OUTLOOK_EXP = re.compile(r'\b(?:(?P<re>AW|R|REPLY|ANTWORT)|(?P<fwd>FWD|WG|WTR|Wtr\.)):', re.I)
+    
+    # subjects shorter than SUBJECT_PLAIN not matching SUBJECT_EXP are plain
+    # ASCII without list-tag which email.header would return unchanged
+    SUBJECT_EXP   = re.compile(r'=\?|\[|[^\t\x20-\x7e]|^\s|\s\Z')
+    SUBJECT_PLAIN = 76
+    
     TZ_EXP = re.compile(r'(^[^+-]*)(([+-]\d{4})\s*\([^)]*\)).*$')
     
     TZ_OFFSETS = {
@@ -110,6 +273,50 @@ class FUCore(object):
     
     BLACKLIST_MODES = [ 'news2mail', 'mail2news', 'reactor' ]
     
+    SPOOL_CHUNK = 64 * 1024
+    
+    # queued log handlers, see flush_log()
+    LOG_QUEUES = []
+    
+    # extra header fixers registered by plugins, see register_header_fixer()
+    HEADER_FIXERS = {}
+    HEADER_FIXERS_REV = 0
+    
+    @classmethod
+    def register_header_fixer(cls, name, fixer):
+        """
+        Register an additional header fixer used by :meth:`FUCore._filter_headers`.
+        
+        *fixer* is called as ``fixer(instance, key, value, list_tag, rec)``
+        for each header called *name* (case insensitive) and returns either
+        :const:`None` to leave the header untouched or a list of
+        (key, value) headers replacing it (an empty list removes it).
+        
+        Fixers registered on a subclass only apply to instances of
+        that subclass. Extra fixers run after the built-in ones.
+        
+        :param  name: The header name.
+        :param fixer: The fixer callable.
+        :returns: :const:`None`
+        """
+        if not 'HEADER_FIXERS' in cls.__dict__:
+            setattr(cls, 'HEADER_FIXERS', {})
+        
+        cls.HEADER_FIXERS.setdefault(name.lower(), []).append(fixer)
+        FUCore.HEADER_FIXERS_REV += 1
+    
+    @classmethod
+    def flush_log(cls):
+        """
+        Wait until all queued log messages are written.
+        
+        Called by the synfu-* entry points before they exit.
+        
+        :returns: :const:`None`
+        """
+        for handler in FUCore.LOG_QUEUES:
+            handler.flush()
+    
     @classmethod
     def log_traceback(cls, instance, noreturn=True):
         """
@@ -122,19 +329,25 @@ class FUCore(object):
         :param: noreturn: if :const:`True` do a sys.exit(1)
         """
 
+        # keep the order of messages logged up to here
+        FUCore.flush_log()
+        
         logger = logging.getLogger('exception-trap')
 
-        if instance and instance._conf.log_traceback:
-            filename = instance._conf.log_traceback
-            format = '%(asctime)s [%(process)d]: %(levelname)s: %(message)s'
-            handler = logging.FileHandler(filename)
-        else:
-            format = 'SYNFU[%(process)d] %(message)s'
-            handler = SysLogHandler('/dev/log', SysLogHandler.LOG_NEWS)
+        if not logger.handlers:
+            # long running processes (synfu-reactor --serve) may end up
+            # here more than once, make sure every line is logged once.
+            if instance and instance._conf.log_traceback:
+                filename = instance._conf.log_traceback
+                format = '%(asctime)s [%(process)d]: %(levelname)s: %(message)s'
+                handler = logging.FileHandler(filename)
+            else:
+                format = 'SYNFU[%(process)d] %(message)s'
+                handler = SysLogHandler('/dev/log', SysLogHandler.LOG_NEWS)
 
-        formatter = logging.Formatter(format)
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
+            formatter = logging.Formatter(format)
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
 
         for line in traceback.format_exc().splitlines():
             logger.critical(line)
@@ -146,65 +359,50 @@ class FUCore(object):
         super(FUCore, self).__init__()
 
         self._conf = conf
+        self._log_debug = True
         self._logger = logging.getLogger(self.__class__.__name__)
-        if self._conf.log_facility == 'file':
-            handler = TimedRotatingFileHandler(self._conf.log_filename,
-                                               self._conf.log_when,
-                                               self._conf.log_interval,
-                                               self._conf.log_keep)
-            if os.path.exists(self._conf.log_filename):
-                # try to fixup rollover time
-                stat = os.stat(self._conf.log_filename)
-                ctime = int(stat.st_ctime)
-                # work around python 2.6.2 deficiencies.. (not 100% accurate)
-                if sys.hexversion < 0x20603f0:
-                    handler.rolloverAt = ctime + handler.interval
-                else:
-                    handler.rolloverAt = handler.computeRollover(ctime)
+        
+        # the logger is shared by all instances of a class, set it up once
+        if not self._logger.handlers:
+            if self._conf.log_facility == 'file':
+                handler = TimedRotatingFileHandler(self._conf.log_filename,
+                                                   self._conf.log_when,
+                                                   self._conf.log_interval,
+                                                   self._conf.log_keep)
+                if os.path.exists(self._conf.log_filename):
+                    # try to fixup rollover time
+                    stat = os.stat(self._conf.log_filename)
+                    ctime = int(stat.st_ctime)
+                    # work around python 2.6.2 deficiencies.. (not 100% accurate)
+                    if sys.hexversion < 0x20603f0:
+                        handler.rolloverAt = ctime + handler.interval
+                    else:
+                        handler.rolloverAt = handler.computeRollover(ctime)
 
-            format = '%(asctime)s [%(process)d]: %(levelname)s: %(message)s'
-        else:
-            handler = SysLogHandler('/dev/log', SysLogHandler.LOG_NEWS)
-            format = 'SYNFU[%(process)d] %(message)s'
+                format = '%(asctime)s [%(process)d]: %(levelname)s: %(message)s'
+            else:
+                handler = SysLogHandler('/dev/log', SysLogHandler.LOG_NEWS)
+                format = 'SYNFU[%(process)d] %(message)s'
 
-        formatter = logging.Formatter(format)
-        handler.setFormatter(formatter)
-        self._logger.setLevel(logging.DEBUG)
-        self._logger.addHandler(handler)
+            formatter = logging.Formatter(format)
+            handler.setFormatter(formatter)
+            
+            if self._conf.verbose and self._conf.log_queue_size > 0:
+                # formatting and I/O is done by a background thread
+                handler = _QueueHandler(handler, self._conf.log_queue_size)
+                FUCore.LOG_QUEUES.append(handler)
+            
+            self._logger.setLevel(logging.DEBUG)
+            self._logger.addHandler(handler)
         
-        self._blacklist = {}
+        self._tag_cache = _LRUCache(self._conf.tag_cache_size, self._conf.tag_cache_evict)
+        self._header_fixers = {}
+        
+        self._blacklist = None
         if self._conf.blacklist_filename:
-            try:
-                blacklist_file = open(self._conf.blacklist_filename)
-                for (lno, line) in enumerate(blacklist_file.readlines()):
-                    line = line.strip()
-                    if line.startswith('#'):
-                        continue
-                    fields = [x.strip() for x in line.split(';') if x]
-                    if len(fields) < 2 or len(fields) > 3:
-                        self._log("!!! {0}:{1}: invalid field count {2} expected 2 or 3",
-                                  self._conf.blacklist_filename, lno + 1, len(fields))
-                        continue
-                    elif fields[1].lower() in ['e','ne','en'] and not len(fields) == 3:
-                        self._log('!!! {0}:{1}: invalid field count {2} for rule "{3}"',
-                                  self._conf.blacklist_filename, lno + 1, len(fields), fields[1])
-                        continue
-                    elif not fields[1].lower() in ['d', 'n', 'e', 'ne', 'en']:
-                        self._log('!!! {0}:{1}: invalid rule "{2}"',
-                                  self._conf.blacklist_filename, lno + 1, fields[1])
-                        continue
-                    
-                    if len(fields) == 2:
-                        fields.append(None)
-                    
-                    self._blacklist[fields[0]] = { 'addr' : fields[0],
-                                                   'action' : fields[1],
-                                                   'param' : fields[2] }
-                    self._log('--- blacklist: <addr: {0}>; <action: {1}>; <param: {2}>',
-                              fields[0], fields[1], fields[2], verbosity=3)
-            except IOError, e:
-                self._log('!!! failed to open blacklist file "{0}": {1}',
-                          self._conf.blacklist_filename, str(e))
+            self._blacklist = Blacklist(self._conf.blacklist_filename,
+                                        self._conf.blacklist_index, self._log,
+                                        self._conf.blacklist_interval)
             
     def _log(self, message, *args, **kwargs):# rec=0, verbosity=1):
         """
@@ -220,13 +418,21 @@ class FUCore(object):
         rec       = kwargs.get('rec', 0)
         
         if self._conf.verbose and self._conf.verbosity >= verbosity:
+            if verbosity >= 2 and not self._log_debug and not message.lstrip().startswith('!!!'):
+                # this message was not picked by _sample_log()
+                return
+            
             format_args = []
+            limit       = self._conf.log_max_arg
             
             for a in args:
                 if isinstance(a, unicode):
-                    format_args.append(a.encode('UTF-8'))
-                else:
-                    format_args.append(a)
+                    a = a.encode('UTF-8')
+                
+                if limit and isinstance(a, str) and len(a) > limit:
+                    a = '{0}... [{1} bytes]'.format(a[:limit], len(a))
+                
+                format_args.append(a)
             
             if isinstance(message, unicode):
                 message = message.encode('UTF-8')
@@ -243,6 +449,70 @@ class FUCore(object):
                 else:
                     self._logger.debug(message)
     
+    def _sample_log(self, kind):
+        """
+        Decide if debug messages (verbosity >= 2) get logged for the next message.
+        
+        Only one in *log_sample* messages gets a full trace, *log_sample*
+        is either a number or a dictionary with one for each *kind*.
+        Warnings and errors are always logged.
+        
+        :param kind: The kind of message (`reactor`, `mail2news` or `news2mail`).
+        :returns: :const:`True` if debug messages get logged.
+        """
+        rate = self._conf.log_sample
+        if isinstance(rate, dict):
+            rate = rate.get(kind, 1)
+        
+        self._log_debug = rate <= 1 or random.random() * rate < 1
+        return self._log_debug
+    
+    def _read_headers(self, fobj):
+        """
+        Read the header block of a message from *fobj*.
+        
+        Reading stops after the empty line separating headers and body,
+        leaving *fobj* positioned at the first line of the body.
+        
+        :param fobj: A file-like object providing the message.
+        :returns: The header block (including the separating empty line).
+        """
+        lines = []
+        
+        for line in iter(fobj.readline, ''):
+            lines.append(line)
+            if not line.strip('\r\n'):
+                break
+        
+        return ''.join(lines)
+    
+    def _spool(self, fobj, threshold):
+        """
+        Copy the message provided by *fobj* into a temporary file.
+        
+        The copy is kept in memory up to *threshold* bytes and spilled to
+        disk once the message grows beyond that.
+        
+        :param      fobj: A file-like object providing the message.
+        :param threshold: Maximum size of a message kept in memory.
+        :returns: A tuple of (spool, spilled) with *spool* positioned at
+                  the start of the message.
+        """
+        spool = tempfile.SpooledTemporaryFile(threshold, prefix='synfu-')
+        size  = 0
+        
+        for chunk in iter(lambda: fobj.read(FUCore.SPOOL_CHUNK), ''):
+            spool.write(chunk)
+            size += len(chunk)
+        
+        spool.seek(0)
+        
+        if size > threshold:
+            self._log('--- large message ({0} bytes), spilled to disk', size)
+            return (spool, True)
+        
+        return (spool, False)
+    
     def _is_cancel(self, message):
         """
         Check if the passed message is a CANCEL message.
@@ -288,12 +558,14 @@ class FUCore(object):
         evl = message.get('AF-Envelope-to', message.get('X-AF-Envelope-to', None))
         
         tag_base = None
-        
+        tag_exp  = None
 
         if tag:
             tag = email.header.decode_header(tag)[0][0]
             self._log('--- using supplied SynFU tag hints', rec=rec)
-            tag_base = '({0})'.format('|'.join(x.strip() for x in tag.split(',') if x.strip()))
+            tags     = [x.strip() for x in tag.split(',') if x.strip()]
+            tag_base = '({0})'.format('|'.join(tags))
+            tag_exp  = '({0})'.format('|'.join(re.escape(x) for x in tags))
         
         # preffer List-Id if we have it
         elif lid:
@@ -319,11 +591,240 @@ class FUCore(object):
         
         if tag_base:
             self._log('--- list tag: "[*{0}*]"', format(tag_base), rec=rec)
-            return re.compile('(?i)\[[^[]*{0}[^]]*\]'.format(tag_base))
+            
+            if tag_exp is None:
+                tag_exp = re.escape(tag_base)
+            
+            pattern = self._tag_cache.get(tag_exp)
+            if pattern is None:
+                pattern = re.compile('(?i)\[[^[]*{0}[^]]*\]'.format(tag_exp))
+                self._tag_cache.set(tag_exp, pattern)
+            
+            self._log('--- list tag cache: {0} hits, {1} misses',
+                      self._tag_cache.hits, self._tag_cache.misses, rec=rec, verbosity=3)
+            return pattern
             
         self._log('--- no list tag found', rec=rec)
         # return 'moab'
-        return re.compile('(?i)\s*\[[^]]*(?# This is here to confuse people)\]\s*')
+        return FUCore.NO_TAG_EXP
+    
+    @staticmethod
+    def _fix_outlook(match):
+        """
+        Replacement function used with :attr:`FUCore.OUTLOOK_EXP`.
+        
+        :param match: A match of :attr:`FUCore.OUTLOOK_EXP`.
+        :returns: The RFC prefix replacing the outlook one.
+        """
+        if match.group('re'):
+            return 'Re:'
+        
+        return 'Fwd:'
+    
+    def _header_fixer_table(self, outlook_hacks=False, fix_dateline=False):
+        """
+        Return the header fixers used by :meth:`FUCore._filter_headers`.
+        
+        The table maps lowercased header names to a tuple of fixers and
+        only contains the fixers enabled by *outlook_hacks* and *fix_dateline*
+        as well as those added using :meth:`FUCore.register_header_fixer`.
+        It is built once for each combination of settings.
+        
+        :param outlook_hacks: If :const:`True` convert AW:/FWD:/... subjects
+                              to RFC versions.
+        :param  fix_dateline: If :const:`True` fix broken Date-header timezones.
+        :returns: A dictionary of header names and fixers.
+        """
+        key   = (bool(outlook_hacks), bool(fix_dateline), FUCore.HEADER_FIXERS_REV)
+        table = self._header_fixers.get(key)
+        
+        if table is None:
+            if outlook_hacks:
+                table = { 'subject' : [FUCore._fix_outlook_subject] }
+            else:
+                table = { 'subject' : [FUCore._fix_subject] }
+            
+            table['message-id'] = [FUCore._fix_message_id]
+            table['references'] = [FUCore._fix_references]
+            
+            if fix_dateline:
+                table['date']   = [FUCore._fix_date]
+                table['x-date'] = [FUCore._fix_date]
+            
+            for cls in reversed(self.__class__.__mro__):
+                for (name, extra) in cls.__dict__.get('HEADER_FIXERS', {}).items():
+                    table.setdefault(name, []).extend(extra)
+            
+            table = dict((name, tuple(fixers)) for (name, fixers) in table.items())
+            self._header_fixers[key] = table
+        
+        return table
+    
+    def _fix_outlook_subject(self, k, v, list_tag, rec=0):
+        """
+        Header fixer: :meth:`FUCore._fix_subject` with outlook fixes applied.
+        """
+        return self._fix_subject(k, v, list_tag, rec, True)
+    
+    def _fix_subject(self, k, v, list_tag, rec=0, outlook_hacks=False):
+        """
+        Header fixer: remove *list_tag* from the Subject (converting
+        outlook-style AW:/FWD:/... prefixes if *outlook_hacks* is set).
+        
+        :returns: :const:`None` or the replacement headers.
+        """
+        orig = v
+        
+        # plain ASCII subjects without list-tag or outlook prefix
+        # don't need to be decoded and re-encoded
+        if v and len(v) < FUCore.SUBJECT_PLAIN and not FUCore.SUBJECT_EXP.search(v) and \
+           not (outlook_hacks and FUCore.OUTLOOK_EXP.search(v)):
+            return None
+        
+        have_first_match = False
+        decoded_hdr = email.header.decode_header(v)
+        
+        for (i, hv) in enumerate(decoded_hdr):
+            (v, enc) = hv
+
+            if outlook_hacks:
+                self._log('--- applying outlook fixes to Subject', rec=rec, verbosity=2)
+            
+                v = FUCore.OUTLOOK_EXP.sub(FUCore._fix_outlook, v)
+            
+            l1 = str(v)
+        
+            # try to remove the first occurence of list-tag in l1
+            l1 = list_tag.sub('', l1)
+            if not l1 == v:
+                have_first_match = True
+                v = l1
+        
+            try:
+                if not enc is None:
+                    v.decode(enc)
+            except UnicodeDecodeError:
+                enc = None
+        
+            if enc is None:
+                # deal with already decoded headers
+                for new_enc in ['ascii', 'utf-8', 'latin1']:
+                    try:
+                        v.decode(new_enc)
+                        enc = new_enc
+                        break
+                    except UnicodeDecodeError:
+                        continue
+
+                if enc is None:
+                    # probably the hardest choice..
+                    v = v.decode('ascii', 'ignore')
+                    enc = 'ascii'
+
+            decoded_hdr[i] = (v, enc)
+        v = str(email.header.make_header(decoded_hdr))
+        
+        if not v:
+            # remove the header if there's nothing left of it
+            # (or there never was anything to start with..)
+            return []
+        
+        if not v == orig:
+            # gotcha - we have a list-tag
+            self._log('--- removing list tag..', rec=rec)
+            return [(k, v)]
+        
+        return None
+    
+    def _fix_message_id(self, k, v, list_tag, rec=0):
+        """
+        Header fixer: repair missing brackets and multiple @ in Message-IDs.
+        
+        :returns: :const:`None` or the replacement headers.
+        """
+        fixed = None
+        
+        # fix <message-id
+        if v.strip().startswith('<') and not v.strip().endswith('>'):
+            self._log('--- appending missing > to Message-ID')
+            v = v.strip() + '>'
+            fixed = [(k, v)]
+            
+        # fix message-id>
+        if v.strip().endswith('>') and not v.strip().startswith('<'):
+            self._log('--- prepending missing < to Message-ID')
+            v = '<' + v.strip()
+            fixed = [(k, v)]
+            
+        # fix multiple @@ in message id
+        if v.find('@') != v.rfind('@'):
+            # there's more than one of then
+            self._log('--- copying Message-ID to X-Message-ID', rec=rec)
+            fixed = [('X-Message-ID', v)]
+            
+            while v.find('@') != v.rfind('@'):
+                v = v.replace('@', '', 1)
+            fixed.append((k, v))
+        
+        return fixed
+    
+    def _fix_references(self, k, v, list_tag, rec=0):
+        """
+        Header fixer: shorten References with more than 998 octets.
+        
+        :returns: :const:`None` or the replacement headers.
+        """
+        if len(v) + len(k) > 990:
+            self._log('--- References {0} > 990 octets, shortening', len(v) + len(k), rec=rec)
+            v = v.replace('\n', '').replace('\t', '').replace(' ', '').replace(',', '')
+            match = [x.replace('<', '').replace('>', '') for x in v.split('><')]
+            if match and len(match) >= 3:
+                v = [match[0]] + match[-2:]
+                v = ['<{0}>'.format(x) for x in v]
+                v = email.header.make_header([(' '.join(v), 'ascii')])
+                self._log('--- new References: {0}', v, rec=rec, verbosity=2)
+                
+                return [('References', v)]
+            elif len(match) < 3:
+                self._log('!!! References looks broken (HUGE but only two Message-IDs)!')
+                self._log('match: {0}', match)
+            else:
+                self._log('!!! Could not split References into Message-IDs!', rec=rec, verbosity=0)
+        
+        return None
+    
+    def _fix_date(self, k, v, list_tag, rec=0):
+        """
+        Header fixer: fix Date-headers with broken timezones
+        (like those sent by Incredymail).
+        
+        :returns: :const:`None` or the replacement headers.
+        """
+        try:
+            v.decode('ascii')
+            if v.upper().strip() == 'MAILPOST-UNKNOWN-DATE':
+                self._log('--- fix Dat-header: removing header with "MAILPOST-UNKNOWN-DATE"')
+                return []
+
+        except UnicodeDecodeError:
+            match = FUCore.TZ_EXP.findall(v)
+            if match:
+                (time_stamp, old_tz, zone_offset) = match[0]
+                orig = v
+                
+                if zone_offset in FUCore.TZ_OFFSETS:
+                    v = '{0}{1} ({2})'.format(time_stamp, zone_offset,
+                                               FUCore.TZ_OFFSETS[zone_offset])
+                    v = email.header.make_header([(v, 'ascii')])
+                    self._log('--- fix Date-header: "{0}" -> "{1}"', orig, v, rec=rec)
+                else:
+                    self._log('!!! Unknown timezone {0}, can\t fix it!', rec=rec)
+                
+                return [('Date', v)]
+            else:
+                self._log('!!! Date-header looks invalid and contains no parseable timezone!', rec=rec)
+        
+        return None
     
     def _filter_headers(self, list_tag, headers, outlook_hacks=False, fix_dateline=False, rec=0, whitelist=[]):
         """
@@ -341,195 +842,111 @@ class FUCore(object):
         - if **fix_dateline** is enabled Date-headers with broken timezone
           (like those sent by Incredymail) will get their timezone fixed.
         
+        - Message-IDs and over-long References get repaired and any fixers
+          added by :meth:`FUCore.register_header_fixer` are applied
+          (see :meth:`FUCore._header_fixer_table`).
+        
         - all tags matching :attr:`FUCore.HEADER_IGN` will be discarded
-          with the exception of X-No-Archive.
+          with the exception of X-No-Archive and X-Message-ID. Headers
+          emitted by a fixer are matched by their own name (a repaired
+          X-Date turns into Date).
         
         :param      list_tag: A :class:`re.SRE_PATTERN` as returned
                               by :meth:`FUCore._find_list_tag`.
         :param       headers: A list of (key, value) headers
         :param outlook_hacks: If :const:`True` convert AW:/FWD:/... subjects
                               to RFC versions.
+        :param  fix_dateline: If :const:`True` fix broken Date-header timezones.
         :param           rec: Optional recursion level used to indent messages.
         :param     whitelist: Optional list of header names to keep
         :returns: The filtered header list.
         """
         removed      = 0
         have_subject = False
+        result       = []
+        tail         = []
+        whitelist    = frozenset(x.lower() for x in whitelist)
+        decisions    = FUCore.HEADER_CACHE.get(whitelist)
+        misses       = 0
+        lookups      = 0
+        
+        if decisions is None:
+            decisions = {}
+            FUCore.HEADER_CACHE.set(whitelist, decisions)
         
-        for h in headers[:]:
-            # another place where we mutate a list while iterating it
-            # only this time we iterate a copy of the list
+        fixers = self._header_fixer_table(outlook_hacks, fix_dateline)
+        
+        for h in headers:
+            # the header list is rebuilt in a single pass:
+            # unmodified headers keep their position while modified ones
+            # are moved to the end (in the order they where modified)
+            
+            (k, v)  = h
+            key     = k.lower()
+            entries = [h]
+            moved   = False
             
-            (k, v) = h
             self._log('--- k == \'{0}\'', k, rec=rec, verbosity=4)
             
-            if k.lower() == 'subject':
-                have_subject = True
-                have_first_match = False
-                decoded_hdr = email.header.decode_header(v)
+            for fixer in fixers.get(key, ()):
+                fixed = fixer(self, entries[-1][0], entries[-1][1], list_tag, rec)
+                if fixed is None:
+                    continue
                 
-                for (i, hv) in enumerate(decoded_hdr):
-                    (v, enc) = hv
-
-                    if outlook_hacks:
-                        self._log('--- applying outlook fixes to Subject', rec=rec, verbosity=2)
-                        
-                        for (exp, repl) in FUCore.OUTLOOK_HACKS:
-                            v = exp.sub(repl, v)
-                        
-                    l1 = str(v)
-                    
-                    # try to remove the first occurence of list-tag in l1
-                    l1 = list_tag.sub('', l1)
-                    if not l1 == v:
-                        have_first_match = True
-                        v = l1
-                    
-                    try:
-                        if not enc is None:
-                            v.decode(enc)
-                    except UnicodeDecodeError:
-                        enc = None
-                    
-                    if enc is None:
-                        # deal with already decoded headers
-                        for new_enc in ['ascii', 'utf-8', 'latin1']:
-                            try:
-                                v.decode(new_enc)
-                                enc = new_enc
-                                break
-                            except UnicodeDecodeError:
-                                continue
-
-                        if enc is None:
-                            # probably the hardest choice..
-                            v = v.decode('ascii', 'ignore')
-                            enc = 'ascii'
-
-                    decoded_hdr[i] = (v, enc)
-                v = str(email.header.make_header(decoded_hdr))
+                entries[-1:] = fixed
+                moved = True
                 
-                if not v == h[1]:
-                    # gotcha - we have a list-tag
-                    self._log('--- removing list tag..', rec=rec)
-                    headers.remove(h)
-                    headers.append((k, v))
-                    
-                if not v:
-                    # remove the header if there's nothing left of it
-                    # (or there never was anything to start with..)
-                    try:
-                        headers.remove(h)
-                    except:
-                        pass
-                        
-                    try:
-                        headers.remove((k, v))
-                    except:
-                        pass
-                        
-                    # this will force creation of a dummy subject
-                    have_subject = False
-                    
-            elif k.lower() == 'message-id':
-                # fix <message-id
-                if v.strip().startswith('<') and not v.strip().endswith('>'):
-                    self._log('--- appending missing > to Message-ID')
-                    v = v.strip() + '>'
-                    headers.remove(h)
-                    headers.append((k, v))
-                    
-                # fix message-id>
-                if v.strip().endswith('>') and not v.strip().startswith('<'):
-                    self._log('--- prepending missing < to Message-ID')
-                    v = '<' + v.strip()
-                    headers.remove(h)
-                    headers.append((k, v))
-                    
-                # fix multiple @@ in message id
-                if v.find('@') != v.rfind('@'):
-                    # there's more than one of then
-                    self._log('--- copying Message-Id to X-Message-Id', rec=rec)
-                    headers.remove(h)
-                    headers.append(('X-Message-Id', v))
-                    
-                    while v.find('@') != v.rfind('@'):
-                        v = v.replace('@', '', 1)
-                        
-                    headers.append((k, v))
+                if not entries:
+                    break
+            
+            if key == 'subject':
+                # an empty Subject forces creation of a dummy subject
+                have_subject = bool(entries)
+            
+            # filter headers (fixers may have renamed them)
+            target = result
+            if moved:
+                target = tail
+            
+            for entry in entries:
+                name = entry[0].lower()
+                drop = decisions.get(name)
+                if drop is None:
+                    drop = bool(FUCore.HEADER_IGN_EXP.match(name)) and \
+                           name not in FUCore.HEADER_KEEP and name not in whitelist
+                    misses += 1
                     
-            elif k.lower() == 'references':
-                # handle References with more than 998 octets
-                decoded_header = email.header.decode_header(v)
+                    if len(decisions) < FUCore.HEADER_CACHE_NAMES:
+                        decisions[name] = drop
                 
-                if len(v) + len(k) > 990:
-                    self._log('--- References {0} > 990 octets, shortening', len(v) + len(k), rec=rec)
-                    v = v.replace('\n', '').replace('\t', '').replace(' ', '').replace(',', '')
-                    match = [x.replace('<', '').replace('>', '') for x in v.split('><')]
-                    if match and len(match) >= 3:
-                        v = [match[0]] + match[-2:]
-                        v = ['<{0}>'.format(x) for x in v]
-                        v = email.header.make_header([(' '.join(v), 'ascii')])
-                        self._log('--- new References: {0}', v, rec=rec, verbosity=2)
-                        
-                        headers.remove(h)
-                        headers.append(('References', v))
-                    elif len(match) < 3:
-                        self._log('!!! References looks broken (HUGE but only two Message-IDs)!')
-                        self._log('match: {0}', match)
-                    else:
-                        self._log('!!! Could not split References into Message-IDs!', rec=rec, verbosity=0)
-                        
-            elif k.lower() == 'date' or k.lower() == 'x-date':
-                if fix_dateline:
-                    try:
-                        v.decode('ascii')
-                        if v.upper().strip() == 'MAILPOST-UNKNOWN-DATE':
-                            headers.remove(h)
-                            self._log('--- fix Dat-header: removing header with "MAILPOST-UNKNOWN-DATE"')
-
-                    except UnicodeDecodeError:
-                        match = FUCore.TZ_EXP.findall(v)
-                        if match:
-                            (time_stamp, old_tz, zone_offset) = match[0]
-                            
-                            if zone_offset in FUCore.TZ_OFFSETS:
-                                v = '{0}{1} ({2})'.format(time_stamp, zone_offset,
-                                                           FUCore.TZ_OFFSETS[zone_offset])
-                                v = email.header.make_header([(v, 'ascii')])
-                                self._log('--- fix Date-header: "{0}" -> "{1}"', h[1], v, rec=rec)
-                            else:
-                                self._log('!!! Unknown timezone {0}, can\t fix it!', rec=rec)
-                            
-                            headers.remove(h)
-                            headers.append(('Date', v))
-                        else:
-                            self._log('!!! Date-header looks invalid and contains no parseable timezone!', rec=rec)
-                        
-            # filter headers
-            whitelist = [x.lower() for x in whitelist]
-            for e in FUCore.HEADER_IGN:
-                if e.match(k):
-                    if k.lower() == 'x-no-archive':
-                        self._log('--- keep X-No-Archive: {0}', v, rec=rec, verbosity=2)
-                        continue
-                    
-                    if k.lower() in whitelist:
-                        continue
-                    
-                    self._log('--- remove header "{0}"', k, rec=rec, verbosity=2)
-                    
-                    headers.remove(h)
+                lookups += 1
+                
+                if drop:
+                    self._log('--- remove header "{0}"', entry[0], rec=rec, verbosity=2)
                     removed += 1
-                    
-                    break
+                    continue
+                
+                if name == 'x-no-archive':
+                    self._log('--- keep X-No-Archive: {0}', entry[1], rec=rec, verbosity=2)
+                
+                target.append(entry)
                     
         self._log('--- {0} headers removed', removed, rec=rec)
+        stats     = FUCore.HEADER_CACHE_STATS
+        stats[0] += lookups - misses
+        stats[1] += misses
+        
+        self._log('--- header cache: {0} hits, {1} misses ({2[0]} / {2[1]} in total)',
+                  lookups - misses, misses, stats, rec=rec, verbosity=3)
+        
+        result.extend(tail)
         
         if not have_subject:
-            headers.append(('Subject', '<No Subject>'))
+            result.append(('Subject', '<No Subject>'))
             self._log('!!! had to add a dummy subject', rec=rec)
-            
+        
+        # callers may still refer to the original list
+        headers[:] = result
         return headers
     
     def _apply_blacklist(self, message, mode, rec=0):
@@ -554,7 +971,10 @@ class FUCore(object):
             self._log('!!! Message has neiter "From:" nor "Sender:" headers!', rec=rec)
             return message
         
-        list_entry = self._blacklist.get(mfrom.lower(), self._blacklist.get(sender.lower(), None))
+        if not self._blacklist:
+            return message
+        
+        list_entry = self._blacklist.match(mfrom.lower(), sender.lower())
         if not list_entry:
             return message
         
@@ -612,4 +1032,7 @@ class FUCore(object):
                     self.log('!!! blacklist rule "expires" needs a *numeric* parameter.')
 
         return message
-    
\ No newline at end of file
+    
+
+# write out queued log messages of embedding applications as well
+atexit.register(FUCore.flush_log)
@@ -276,4 +276,6 @@ def ImpRun():
         sys.exit(imp.run())
     except Exception:
         FUCore.log_traceback(imp)
+    finally:
+        FUCore.flush_log()
 
@@ -0,0 +1,400 @@
+# encoding: utf-8
+#
+# nntp.py
+#
+# Copyright (c) 2009-2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+.. module:: nntp
+    :platform: Unix, MacOS, Windows
+    :synopsis: Minimal NNTP client used to feed articles to INN.
+
+.. moduleauthor:: René Köcher <shirk@bitspin.org>
+
+"""
+
+import os, socket, select, atexit, collections
+from cStringIO import StringIO
+
+class NNTPError(Exception):
+    """
+    Raised on unexpected NNTP responses and connection failures.
+    
+    :attr:`code` is the response code or :const:`None` if the connection failed.
+    """
+    
+    def __init__(self, code, line):
+        super(NNTPError, self).__init__(line)
+        self.code = code
+        self.line = line
+    
+    @property
+    def transient(self):
+        """
+        :const:`True` if the article should be offered again later.
+        """
+        return self.code is None or self.code in NNTPClient.TRANSIENT
+
+class NNTPClient(object):
+    """
+    Client side of the NNTP commands needed to hand articles to INN_.
+    
+    Articles are either posted (``POST``, RFC 3977), offered one by one
+    (``IHAVE``) or streamed (``CHECK`` / ``TAKETHIS``, RFC 4644) with up to
+    *pipeline* commands in flight. Servers refusing ``MODE STREAM`` are fed
+    using ``IHAVE`` instead.
+    
+    An article is either a string or an iterable of lines (like a file
+    object) in local line ending convention, dot-stuffing and CRLF line
+    endings are taken care of while sending.
+    
+    The connection is opened on first use and kept open, a connection
+    closed by the server in the meantime (or inherited from a parent
+    process) is replaced transparently.
+    
+    .. _INN: http://www.eyrie.org/~eagle/software/inn/
+    """
+    
+    MODES       = ['post', 'ihave', 'stream']
+    
+    # final response codes
+    ACCEPTED    = (235, 239, 240)
+    UNWANTED    = (435, 438)
+    TRANSIENT   = (400, 403, 431, 436)
+    
+    SEND_CHUNK  = 64 * 1024
+    MAX_LINE    = 2048
+    
+    # connections shared by NNTPClient.shared()
+    CONNECTIONS = {}
+    
+    @classmethod
+    def shared(cls, host='localhost', port=119, **kwargs):
+        """
+        Return the client connected to *host*:*port* creating it as needed.
+        
+        Shared clients stay connected until :meth:`NNTPClient.close_all`
+        is called (at the latest on exit).
+        
+        :param host: The NNTP server.
+        :param port: The NNTP port.
+        :param \**kwargs: passed to :class:`NNTPClient` on creation.
+        :returns: A :class:`NNTPClient` instance.
+        """
+        key = (host, port)
+        if not key in cls.CONNECTIONS:
+            cls.CONNECTIONS[key] = cls(host, port, **kwargs)
+        
+        return cls.CONNECTIONS[key]
+    
+    @classmethod
+    def close_all(cls):
+        """
+        Close all connections opened by :meth:`NNTPClient.shared`.
+        
+        :returns: :const:`None`
+        """
+        for client in cls.CONNECTIONS.values():
+            client.close()
+        
+        cls.CONNECTIONS.clear()
+    
+    def __init__(self, host='localhost', port=119, timeout=60, pipeline=8):
+        """
+        :param     host: The NNTP server.
+        :param     port: The NNTP port.
+        :param  timeout: Socket timeout in seconds.
+        :param pipeline: Maximum number of streaming commands awaiting a response.
+        """
+        super(NNTPClient, self).__init__()
+        
+        self.host      = host
+        self.port      = port
+        self.timeout   = timeout
+        self.pipeline  = max(1, pipeline)
+        self.connects  = 0
+        
+        self._sock      = None
+        self._file      = None
+        self._pid       = None
+        
+        # False = not tried yet, None = not supported by the server
+        self._streaming = False
+    
+    def connect(self):
+        """
+        (Re-)connect to the server and read it's greeting.
+        
+        :returns: :const:`None`
+        """
+        self.close(quit=False)
+        
+        try:
+            self._sock = socket.create_connection((self.host, self.port), self.timeout)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._file = self._sock.makefile('rb')
+        except socket.error, e:
+            self.close(quit=False)
+            raise NNTPError(None, 'connect to {0}:{1} failed: {2}'.format(self.host, self.port, e))
+        
+        self._pid       = os.getpid()
+        self._streaming = False
+        self.connects  += 1
+        
+        (code, line) = self._response()
+        if not code in (200, 201):
+            self.close(quit=False)
+            raise NNTPError(code, line)
+    
+    def close(self, quit=True):
+        """
+        Close the connection (sending ``QUIT`` unless *quit* is :const:`False`).
+        
+        :returns: :const:`None`
+        """
+        (sock, fobj) = (self._sock, self._file)
+        if sock is None:
+            return
+        
+        try:
+            if quit and self._pid == os.getpid():
+                self._command('QUIT')
+        except NNTPError:
+            pass
+        
+        self._sock = None
+        self._file = None
+        
+        try:
+            fobj.close()
+            sock.close()
+        except socket.error:
+            pass
+    
+    def post(self, article):
+        """
+        Post *article* (it has to provide a Newsgroups: header).
+        
+        :param article: The article.
+        :returns: The final response code (240 or 435 if INN rejected a duplicate).
+        """
+        self._ensure()
+        
+        (code, line) = self._command('POST')
+        if code != 340:
+            raise NNTPError(code, line)
+        
+        self._send(article)
+        
+        (code, line) = self._response()
+        if code == 441 and line[4:8] == '435 ':
+            return 435
+        
+        if code != 240:
+            raise NNTPError(code, line)
+        
+        return code
+    
+    def ihave(self, msgid, article):
+        """
+        Offer *article* with the Message-ID *msgid* to the server.
+        
+        :param   msgid: The Message-ID including angle brackets.
+        :param article: The article.
+        :returns: The final response code (235 or 435 if the server already has it).
+        """
+        self._ensure()
+        return self._ihave(msgid, article)
+    
+    def stream(self, articles):
+        """
+        Stream *articles* to the server.
+        
+        Each article is announced by ``CHECK`` and sent by ``TAKETHIS``
+        if the server wants it, up to *pipeline* commands are sent before
+        waiting for the first response.
+        
+        :param articles: An iterable of (msgid, article) tuples.
+        :returns: A list of (msgid, code) tuples in the order the server
+                  answered with *code* being 239 (accepted),
+                  438 (not wanted), 431 (try later) or 439 (rejected).
+        """
+        self._ensure()
+        
+        if self._streaming is False:
+            (code, line) = self._command('MODE STREAM')
+            self._streaming = code == 203 or None
+        
+        if self._streaming is None:
+            return self._stream_ihave(articles)
+        
+        results = []
+        pending = collections.deque()
+        
+        try:
+            for (msgid, article) in articles:
+                self._write('CHECK {0}\r\n'.format(msgid))
+                pending.append(('CHECK', msgid, article))
+                
+                while len(pending) >= self.pipeline:
+                    self._stream_response(pending, results)
+            
+            while pending:
+                self._stream_response(pending, results)
+        
+        except NNTPError:
+            # responses still pending can't be matched anymore
+            self.close(quit=False)
+            raise
+        
+        return results
+    
+    def _stream_response(self, pending, results):
+        (command, msgid, article) = pending.popleft()
+        (code, line) = self._response()
+        
+        if line.split()[1:2] != [msgid]:
+            raise NNTPError(None, 'unexpected response to {0} {1}: {2}'.format(command, msgid, line))
+        
+        if command == 'CHECK' and code == 238:
+            self._send(article, 'TAKETHIS {0}\r\n'.format(msgid))
+            pending.append(('TAKETHIS', msgid, article))
+        elif command == 'CHECK' and code in (431, 438):
+            results.append((msgid, code))
+        elif command == 'TAKETHIS' and code in (239, 439):
+            results.append((msgid, code))
+        else:
+            raise NNTPError(code, line)
+    
+    def _stream_ihave(self, articles):
+        # map IHAVE results to their streaming counterparts
+        codes   = {235: 239, 435: 438, 436: 431, 437: 439}
+        results = []
+        
+        for (msgid, article) in articles:
+            try:
+                code = self._ihave(msgid, article)
+            except NNTPError, e:
+                if not e.code in codes:
+                    raise
+                code = e.code
+            
+            results.append((msgid, codes[code]))
+        
+        return results
+    
+    def _ihave(self, msgid, article):
+        (code, line) = self._command('IHAVE {0}'.format(msgid))
+        if code == 435:
+            return code
+        
+        if code != 335:
+            raise NNTPError(code, line)
+        
+        self._send(article)
+        
+        (code, line) = self._response()
+        if code != 235:
+            raise NNTPError(code, line)
+        
+        return code
+    
+    def _ensure(self):
+        """
+        Make sure there is a usable connection.
+        
+        An idle connection which became readable was closed by the server
+        (or received a timeout notice) and is replaced by a new one.
+        """
+        if self._sock is not None and self._pid == os.getpid():
+            try:
+                if not select.select([self._sock], [], [], 0)[0]:
+                    return
+            except (select.error, socket.error):
+                pass
+        
+        self.connect()
+    
+    def _command(self, command):
+        self._write('{0}\r\n'.format(command))
+        return self._response()
+    
+    def _response(self):
+        try:
+            line = self._file.readline(NNTPClient.MAX_LINE)
+        except socket.error, e:
+            self.close(quit=False)
+            raise NNTPError(None, 'read from {0}:{1} failed: {2}'.format(self.host, self.port, e))
+        
+        if not line:
+            self.close(quit=False)
+            raise NNTPError(None, 'connection to {0}:{1} closed'.format(self.host, self.port))
+        
+        line = line.rstrip('\r\n')
+        try:
+            return (int(line[:3]), line)
+        except ValueError:
+            self.close(quit=False)
+            raise NNTPError(None, 'invalid response: {0}'.format(line))
+    
+    def _write(self, data):
+        try:
+            self._sock.sendall(data)
+        except socket.error, e:
+            self.close(quit=False)
+            raise NNTPError(None, 'write to {0}:{1} failed: {2}'.format(self.host, self.port, e))
+    
+    def _send(self, article, command=None):
+        """
+        Send *article* dot-stuffed and terminated (preceded by *command*).
+        """
+        if isinstance(article, basestring):
+            article = StringIO(article)
+        
+        chunk = []
+        size  = 0
+        
+        if command:
+            chunk.append(command)
+        
+        for line in article:
+            line = line.rstrip('\r\n')
+            if line.startswith('.'):
+                chunk.append('.')
+            
+            chunk.append(line)
+            chunk.append('\r\n')
+            size += len(line) + 3
+            
+            if size >= NNTPClient.SEND_CHUNK:
+                self._write(''.join(chunk))
+                chunk = []
+                size  = 0
+        
+        chunk.append('.\r\n')
+        self._write(''.join(chunk))
+
+atexit.register(NNTPClient.close_all)
@@ -38,11 +38,14 @@
 
 """
 
-import sys, re, subprocess
-import email, email.message, email.header
+import sys, os, re, time, errno, tempfile, itertools, subprocess
+import multiprocessing
+import email, email.message, email.header, email.parser, email.generator, email.utils
 
 from synfu.config import Config
 from synfu.fucore import FUCore
+from synfu.nntp import NNTPClient, NNTPError
+from synfu.spool import Spool
 
 class PostFilter(FUCore):
     """
@@ -56,17 +59,40 @@ class PostFilter(FUCore):
     VERSION = '0.8e'
     NOTICE  = '(c) 2009-2010 Rene Koecher <shirk@bitspin.org>'
     
+    # header field names as accepted by email.feedparser
+    HEADER_EXP = re.compile(r'[\041-\071\073-\176]+:')
+    
     def __init__(self, mode=None):
+        if mode == 'drain':
+            Config.add_option('-j', '--workers',
+                              dest    = 'workers',
+                              action  = 'store',
+                              type    = 'int',
+                              default = None,
+                              metavar = 'N',
+                              help    = 'Use N worker processes to drain the spool')
+            
+            Config.add_option('-1', '--once',
+                              dest    = 'once',
+                              action  = 'store_true',
+                              default = False,
+                              help    = 'Exit once the spool is empty')
+        
         if mode == 'news2mail':
             Config.get().postfilter.log_filename = \
                     Config.get().postfilter.log_news2mail
-        elif mode == 'mail2news':
+        elif mode in ['mail2news', 'drain']:
             Config.get().postfilter.log_filename = \
                     Config.get().postfilter.log_mail2news
 
         super(PostFilter, self).__init__(Config.get().postfilter)
         
-        self._conf = Config.get().postfilter
+        self._conf     = Config.get().postfilter
+        self._reactor  = None
+        self._queue    = None
+        self._draining = False
+        self._articles = None
+        self._raw      = None
 
     def mail2news(self, fobj=sys.stdin):
         """
@@ -78,11 +104,271 @@ class PostFilter(FUCore):
         
             There is no need to import and call this method directly.
             SynFu provides the wrapper script :command:`synfu-mail2news` (see :ref:`synfu-mail2news`) for this job.
+        
+        Messages larger than *spill_threshold* are spilled to disk, only their
+        headers are parsed and the body is copied to *mail2news_cmd* as is.
+        Unless *mail2news_reactor* is enabled this is true for all messages:
+        the body and all headers left untouched are passed on byte for byte
+        and only added or modified headers are generated.
+        
+        With *mail2news_spool* set messages are only written to the spool
+        and delivered later on by :meth:`PostFilter.drain`.
+        """
+        spool = None
+        
+        if self._conf.mail2news_spool and not self._draining:
+            return self._enqueue(fobj)
+        
+        self._sample_log('mail2news')
+        
+        if self._conf.spill_threshold:
+            (spool, spilled) = self._spool(fobj, self._conf.spill_threshold)
+            if not spilled:
+                fobj  = spool
+                spool = None
+        
+        self._raw = None
+        
+        if spool:
+            self._data = None
+            headers    = self._read_headers(spool)
+            mm = self._parse_headers(headers) or email.parser.HeaderParser().parsestr(headers)
+        else:
+            self._data = fobj.read()
+            mm = None
+            
+            if not self._conf.mail2news_reactor:
+                # only the headers are needed, the body is passed on as is
+                mm = self._parse_headers(self._data)
+            
+            if not self._raw:
+                mm = email.message_from_string(self._data)
+        
+        try:
+            return self._mail2news(mm, spool)
+        finally:
+            if spool:
+                spool.close()
+    
+    def drain(self, workers=None, once=False):
+        """
+        Deliver the messages written to *mail2news_spool* by :meth:`PostFilter.mail2news`.
+        
+        Messages are claimed in batches of *spool_batch* and delivered like
+        :meth:`PostFilter.mail2news` would have done it right away. Delivered
+        messages are removed, messages failing temporarily (exit code
+        :const:`os.EX_TEMPFAIL`) are retried after *spool_interval* seconds
+        and all others are moved to the spool's ``failed/`` directory.
+        So are messages still failing temporarily *spool_max_age* seconds
+        after they were spooled.
+        
+        Whenever the spool is empty messages claimed more than *spool_stale*
+        seconds ago (by dead drainers) are given back
+        (see :meth:`synfu.spool.Spool.recover`).
+        
+        With *workers* > 1 messages are delivered by a pool of worker
+        processes which (like their NNTP connections) are kept until the
+        drainer exits.
+        
+        With *mail2news_transport* set to ``stream`` the batch is split
+        among the workers and each worker streams its share at once
+        (see :meth:`PostFilter._drain_batch`).
+        
+        .. note::
+        
+            There is no need to import and call this method directly.
+            SynFu provides the wrapper script :command:`synfu-mail2news-drain` for this job.
+        
+        :param workers: number of worker processes (defaults to *spool_workers*)
+        :param    once: exit once the spool is empty instead of waiting for new messages
+        :returns: 0 if all messages were delivered or retried, 1 otherwise
         """
+        if not self._conf.mail2news_spool:
+            raise RuntimeError('drain requires mail2news_spool')
         
-        self._data = fobj.read()
+        workers = workers or self._conf.spool_workers
+        queue   = self._mail_spool()
+        pool    = None
+        failed  = 0
         
-        mm  = email.message_from_string(self._data)
+        idle    = True
+        
+        self._draining = True
+        self._log('--- drain: "{0}" ({1} workers)', queue.path, workers)
+        
+        if workers > 1:
+            # workers log directly, don't fork while a record is being written
+            FUCore.flush_log()
+            pool = multiprocessing.Pool(workers, _drain_init, (self,))
+        
+        try:
+            while True:
+                if idle:
+                    for name in queue.recover(self._conf.spool_stale):
+                        self._log('--- drain: recovered stale message {0}', name)
+                
+                start  = time.time()
+                names  = queue.claim(self._conf.spool_batch)
+                counts = {'done': 0, 'retry': 0, 'failed': 0}
+                
+                size = 1
+                if self._conf.mail2news_transport == 'stream':
+                    # one share of the batch per worker
+                    size = max(1, -(-len(names) // workers))
+                
+                batches = [names[i:i + size] for i in xrange(0, len(names), size)]
+                
+                if pool:
+                    results = pool.imap_unordered(_drain_worker, batches)
+                else:
+                    results = itertools.imap(self._drain_batch, batches)
+                
+                for (name, code) in itertools.chain.from_iterable(results):
+                    if code == os.EX_TEMPFAIL and self._conf.spool_max_age and \
+                       queue.age(name) > self._conf.spool_max_age:
+                        self._log('!!! drain: giving up on {0} after {1:.0f}s', name, queue.age(name))
+                        code = 1
+                    
+                    if code == 0:
+                        queue.done(name)
+                        counts['done'] += 1
+                    elif code == os.EX_TEMPFAIL:
+                        queue.retry(name)
+                        counts['retry'] += 1
+                    else:
+                        queue.fail(name)
+                        counts['failed'] += 1
+                
+                if names:
+                    self._log('--- drain: {0} messages in {1:.2f}s, {2[done]} delivered, '
+                              '{2[retry]} retried, {2[failed]} failed',
+                              len(names), time.time() - start, counts)
+                
+                failed += counts['failed']
+                idle    = not names
+                
+                if not names or counts['retry']:
+                    if once:
+                        break
+                    
+                    time.sleep(self._conf.spool_interval)
+            
+            if pool:
+                pool.close()
+                pool.join()
+                pool = None
+        finally:
+            if pool:
+                pool.terminate()
+        
+        if failed:
+            return 1
+        return 0
+    
+    def _drain_batch(self, names):
+        """
+        Deliver the spooled messages *names*.
+        
+        With *mail2news_transport* set to ``stream`` the articles of all
+        messages are prepared first and streamed together, keeping up to
+        *nntp_pipeline* commands in flight. Their results are mapped like
+        the ones of a single article (see :meth:`PostFilter._mail2nntp`).
+        
+        :returns: A list of (name, exit code) tuples.
+        """
+        if self._conf.mail2news_transport != 'stream':
+            return [self._drain_one(name) for name in names]
+        
+        results = []
+        pending = {}
+        
+        self._articles = []
+        try:
+            for name in names:
+                (name, code) = self._drain_one(name)
+                
+                if code is None:
+                    # the article was added to self._articles
+                    pending.setdefault(self._articles[-1][0], []).append(name)
+                else:
+                    results.append((name, code))
+            
+            if not self._articles:
+                return results
+            
+            articles = [(msgid, article) for (msgid, article, source) in self._articles]
+            code     = os.EX_TEMPFAIL
+            
+            try:
+                for (msgid, result) in self._nntp_client().stream(articles):
+                    self._log('--- NNTP stream of {0} returned: {1}', msgid, result)
+                    results.append((pending[msgid].pop(0), self._nntp_code(result)))
+                    
+            except NNTPError, e:
+                self._log('!!! NNTP stream of {0} articles failed: {1}', len(articles), e)
+                if not e.transient:
+                    code = 1
+            
+            # not answered by the server
+            for name in itertools.chain(*pending.values()):
+                results.append((name, code))
+        finally:
+            for (msgid, article, source) in self._articles:
+                source.close()
+            
+            self._articles = None
+        
+        return results
+    
+    def _drain_one(self, name):
+        """
+        Deliver the spooled message *name*.
+        
+        :returns: A tuple of (name, exit code) with the exit code being :const:`None`
+                  if the article was left to :meth:`PostFilter._drain_batch`.
+        """
+        try:
+            fobj = self._queue.open(name)
+            try:
+                code = self.mail2news(fobj)
+            finally:
+                fobj.close()
+        except Exception:
+            FUCore.log_traceback(self, noreturn=False)
+            code = 1
+        
+        return (name, code)
+    
+    def _enqueue(self, fobj):
+        """
+        Write the message provided by *fobj* to the *mail2news_spool*.
+        
+        :param fobj: A file-like object providing the message.
+        :returns: 0 once the message is on disk, :const:`os.EX_TEMPFAIL` otherwise.
+        """
+        try:
+            name = self._mail_spool().put(fobj)
+        except (IOError, OSError), e:
+            self._log('!!! Unable to spool message: {0}', e)
+            return os.EX_TEMPFAIL
+        
+        self._log('--- spooled as {0}', name)
+        return 0
+    
+    def _mail_spool(self):
+        if self._queue is None:
+            self._queue = Spool(self._conf.mail2news_spool, self._conf.spool_compress)
+        
+        return self._queue
+    
+    def _mail2news(self, mm, spool=None):
+        """
+        Route *mm* to the matching newsgroups (see :meth:`mail2news`).
+        
+        :param    mm: A :class:`email.message` object.
+        :param spool: Optional file providing the body of a header-only *mm*.
+        :returns: The exit code of *mail2news_cmd*.
+        """
         if (self._is_cancel(mm)):
             return 0
         mm  = self._apply_blacklist(mm, 'mail2news', 0)
@@ -110,20 +396,22 @@ class PostFilter(FUCore):
                 self._log('--- Message contains a valid path_marker, going to drop it!')
                 return 0;
         
-        for mapping in self._conf.filters:
+        recipients = []
+        for header in ['To', 'Cc']:
+            ccs = [cc.strip() for cc in mm.get(header, '').split(',')]
+            recipients.append([cc for cc in ccs if cc])
+        
+        candidates = [lid]
+        for ccs in recipients:
+            candidates.extend(ccs)
+        
+        for mapping in self._conf.filter_index.lookup(candidates):
             
-            if not 'exp' in mapping:
-                continue
-                
-            if not mapping['exp'].findall(lid):
+            if not mapping['exp'].search(lid):
                 match = False
-                for header in ['To', 'Cc']:
-                    for cc in mm.get(header, '').split(','):
-                        cc = cc.strip()
-                        if not cc:
-                            continue
-                        
-                        if mapping['exp'].findall(cc):
+                for ccs in recipients:
+                    for cc in ccs:
+                        if mapping['exp'].search(cc):
                             match = True
                             self._log('--- cross post to "{0}"', cc)
                             break
@@ -171,6 +459,9 @@ class PostFilter(FUCore):
             except KeyError:
                 mm._headers.append(('X-SynFU-Tags', tag_hints))
                 
+        if cmd_args['NNTP_ID'] and self._conf.mail2news_transport != 'cmd':
+            return self._mail2nntp(mm, spool, cmd_args['NNTP_ID'])
+        
         if cmd_args['NNTP_ID']:
             cmd_args['NNTP_ID'] = ' '.join(cmd_args['NNTP_ID'])
 
@@ -180,7 +471,10 @@ class PostFilter(FUCore):
                                     stdout=sys.stdout,
                                     stderr=sys.stderr)
                                     
-            proc.communicate(str(mm))
+            if self._conf.mail2news_reactor:
+                self._react(mm, spool, proc.stdin)
+            else:
+                self._write_message(mm, spool, proc.stdin)
             proc.wait()
             
             self._log('--- mail2news_cmd returned: {0}', proc.returncode)
@@ -189,6 +483,334 @@ class PostFilter(FUCore):
         self._log('!!! No matching List-ID for {0}', lid)
         return 1
     
+    def _parse_headers(self, data):
+        """
+        Parse only the header block at the start of *data*.
+        
+        If the header block can be split into it's raw header fields
+        :attr:`_raw` is set up for :meth:`PostFilter._write_message`.
+        
+        :param data: The message or it's header block.
+        :returns: A header-only :class:`email.message` object or :const:`None`
+                  if the header block couldn't be split.
+        """
+        self._raw = None
+        
+        split = self._split_headers(data)
+        if split is None:
+            return None
+        
+        (unixfrom, fields, end) = split
+        mm = email.parser.HeaderParser().parsestr(data[:end])
+        
+        # a header the parser sees differently is generated like before
+        if len(fields) != len(mm._headers):
+            return mm
+        
+        for (field, (name, value)) in zip(fields, mm._headers):
+            if field[:len(name) + 1] != name + ':':
+                return mm
+        
+        self._raw = (unixfrom, list(mm._headers), fields, end)
+        return mm
+    
+    def _split_headers(self, data):
+        """
+        Split the header block at the start of *data* into raw header fields
+        (following the rules of :mod:`email.feedparser`).
+        
+        CRLF line endings are turned into plain newlines, just like
+        :class:`email.generator.Generator` would write them.
+        
+        :param data: The message or it's header block.
+        :returns: A tuple of (unixfrom, fields, end) with *end* being the
+                  offset of the body or :const:`None` if the block contains
+                  anything but header fields.
+        """
+        unixfrom = None
+        fields   = []
+        pos      = 0
+        
+        while True:
+            nl = data.find('\n', pos)
+            if nl < 0:
+                return None
+            
+            line = data[pos:nl + 1]
+            if line in ('\n', '\r\n'):
+                return (unixfrom, [''.join(f) for f in fields], nl + 1)
+            
+            if line.endswith('\r\n'):
+                line = line[:-2] + '\n'
+            
+            if pos == 0 and line.startswith('From '):
+                unixfrom = line
+            elif line[0] in ' \t' and fields:
+                fields[-1].append(line)
+            elif PostFilter.HEADER_EXP.match(line):
+                fields.append([line])
+            else:
+                return None
+            
+            pos = nl + 1
+    
+    def _format_head(self, mm):
+        """
+        Build the header block of *mm* from the raw header fields recorded
+        by :meth:`PostFilter._parse_headers`, generating only headers which
+        were added or modified since.
+        
+        :returns: The header block (including the separating empty line)
+                  or :const:`None` if no raw header fields are available.
+        """
+        if not self._raw:
+            return None
+        
+        (unixfrom, items, fields, end) = self._raw
+        
+        # items keeps the original tuples alive, so their ids are unique
+        raw  = dict((id(item), field) for (item, field) in zip(items, fields))
+        head = [unixfrom or 'From nobody {0}\n'.format(time.ctime(time.time()))]
+        new  = []
+        
+        for item in mm._headers + [None]:
+            field = raw.get(id(item))
+            if field is None and item is not None:
+                new.append(item)
+                continue
+            
+            if new:
+                headers = email.message.Message()
+                headers._headers = new
+                headers.set_payload('')
+                
+                # same as str(mm) without the separating empty line
+                head.append(headers.as_string()[:-1])
+                new = []
+            
+            if field is not None:
+                head.append(field)
+        
+        head.append('\n')
+        return ''.join(head)
+    
+    def _write_message(self, mm, spool, out, close=True):
+        """
+        Write *mm* to *out* and close *out* (unless *close* is :const:`False`).
+        
+        The body is taken from *spool* for a header-only *mm* or sliced from
+        the original message if :attr:`_raw` is set, otherwise it's the same
+        as str(mm).
+        """
+        try:
+            try:
+                head = self._format_head(mm)
+                
+                if head is None:
+                    email.generator.Generator(out).flatten(mm, unixfrom=True)
+                else:
+                    out.write(head)
+                    if not spool:
+                        out.write(buffer(self._data, self._raw[3]))
+                
+                if spool:
+                    for chunk in iter(lambda: spool.read(FUCore.SPOOL_CHUNK), ''):
+                        out.write(chunk)
+            finally:
+                if close:
+                    out.close()
+                
+        except IOError, e:
+            # same as subprocess.communicate()
+            if e.errno != errno.EPIPE:
+                raise
+    
+    def _react(self, mm, spool, out, close=True):
+        """
+        Filter *mm* through an in-process :class:`synfu.reactor.Reactor`
+        and write the result to *out* (closing it unless *close* is :const:`False`).
+        
+        With *mail2news_reactor* enabled *mail2news_cmd* only needs to
+        provide the final tool (like mailpost) instead of piping through
+        :command:`synfu-reactor` which would parse the message again.
+        
+        :param    mm: A :class:`email.message` object.
+        :param spool: Optional file providing the body of a header-only *mm*.
+        :param   out: A file-like object receiving the filtered message.
+        :returns: :const:`None`
+        """
+        if self._reactor is None:
+            # imported here, synfu.reactor isn't needed otherwise
+            from synfu.reactor import Reactor
+            self._reactor = Reactor()
+        
+        # headers look exactly like they would after parsing str(mm) again
+        headers = email.message.Message()
+        headers._headers = mm._headers
+        mm._headers = email.parser.HeaderParser().parsestr(headers.as_string())._headers
+        
+        try:
+            try:
+                if spool:
+                    # let the reactor decide how to handle the large message
+                    source = tempfile.TemporaryFile(prefix='synfu-')
+                    try:
+                        self._write_message(mm, spool, source, close=False)
+                        source.seek(0)
+                        self._reactor._react(source, out)
+                    finally:
+                        source.close()
+                else:
+                    self._reactor._react_message(mm, out)
+            finally:
+                if close:
+                    out.close()
+                
+        except IOError, e:
+            # same as subprocess.communicate()
+            if e.errno != errno.EPIPE:
+                raise
+    
+    def _mail2nntp(self, mm, spool, groups):
+        """
+        Post *mm* to *groups* using the built-in NNTP client instead
+        of *mail2news_cmd* (see :class:`synfu.nntp.NNTPClient`).
+        
+        *mail2news_transport* selects between ``post``, ``ihave`` and
+        ``stream``. Like mailpost the message is turned into an article
+        first (see :meth:`PostFilter._article_headers`).
+        
+        While :meth:`PostFilter._drain_batch` collects articles to be
+        streamed the article is only added to :attr:`_articles`.
+        
+        :param    mm: A :class:`email.message` object.
+        :param spool: Optional file providing the body of a header-only *mm*.
+        :param groups: List of newsgroups.
+        :returns: 0 on success, :const:`os.EX_TEMPFAIL` if the article
+                  should be offered again later, 1 otherwise
+                  (:const:`None` if the article was collected).
+        """
+        mode   = self._conf.mail2news_transport
+        source = tempfile.SpooledTemporaryFile(self._conf.spill_threshold, prefix='synfu-')
+        
+        try:
+            if self._conf.mail2news_reactor:
+                self._react(mm, spool, source, close=False)
+            else:
+                self._write_message(mm, spool, source, close=False)
+            
+            source.seek(0)
+            headers = self._read_headers(source)
+            if not headers.strip():
+                self._log('--- Message was dropped by reactor')
+                return 0
+            
+            (msgid, headers) = self._article_headers(headers, groups)
+            article = itertools.chain(headers, source)
+            
+            if mode == 'stream' and self._articles is not None:
+                # closed by _drain_batch() once it was streamed
+                self._articles.append((msgid, article, source))
+                source = None
+                return None
+            
+            try:
+                client = self._nntp_client()
+                if mode == 'post':
+                    code = client.post(article)
+                elif mode == 'ihave':
+                    code = client.ihave(msgid, article)
+                else:
+                    code = client.stream([(msgid, article)])[0][1]
+                    
+            except NNTPError, e:
+                self._log('!!! NNTP {0} of {1} failed: {2}', mode, msgid, e)
+                if e.transient:
+                    return os.EX_TEMPFAIL
+                return 1
+        finally:
+            if source is not None:
+                source.close()
+        
+        self._log('--- NNTP {0} of {1} returned: {2}', mode, msgid, code)
+        return self._nntp_code(code)
+    
+    def _nntp_client(self):
+        return NNTPClient.shared(self._conf.nntp_host, self._conf.nntp_port,
+                                 timeout=self._conf.nntp_timeout,
+                                 pipeline=self._conf.nntp_pipeline)
+    
+    def _nntp_code(self, code):
+        """
+        Map the final NNTP response *code* of an article to an exit code.
+        """
+        if code in NNTPClient.ACCEPTED or code in NNTPClient.UNWANTED:
+            return 0
+        if code in NNTPClient.TRANSIENT:
+            return os.EX_TEMPFAIL
+        return 1
+    
+    def _article_headers(self, headers, groups):
+        """
+        Turn the mail header block *headers* into the header lines of a
+        news article for *groups*.
+        
+        Headers listed in *nntp_drop_headers* are removed, Newsgroups:
+        (and Distribution: if *nntp_distribution* is set) are replaced and
+        missing Message-ID: or Date: headers are added. Articles sent by
+        IHAVE or streaming get *path_marker* prepended to their Path:.
+        All other header lines are kept exactly as they are.
+        
+        :param headers: The header block as returned by :meth:`FUCore._read_headers`.
+        :param  groups: List of newsgroups.
+        :returns: A tuple of (msgid, list of header lines including the empty line).
+        """
+        mm    = email.parser.HeaderParser().parsestr(headers)
+        drop  = set(h.lower() for h in self._conf.nntp_drop_headers)
+        extra = [('Newsgroups', ','.join(groups))]
+        
+        drop.add('newsgroups')
+        
+        if self._conf.nntp_distribution:
+            drop.add('distribution')
+            extra.append(('Distribution', self._conf.nntp_distribution))
+        
+        if self._conf.mail2news_transport != 'post':
+            drop.add('path')
+            extra.append(('Path', '{0}!{1}'.format(self._conf.path_marker,
+                                                   mm.get('Path', 'not-for-mail').strip())))
+        
+        msgid = mm.get('Message-ID', '').strip()
+        if not msgid:
+            msgid = email.utils.make_msgid('synfu')
+            extra.append(('Message-ID', msgid))
+        
+        if not mm.get('Date', None):
+            extra.append(('Date', email.utils.formatdate(localtime=True)))
+        
+        lines = []
+        skip  = False
+        
+        for (num, line) in enumerate(headers.splitlines(True)):
+            if not line.strip('\r\n'):
+                break
+            
+            if line[0] in ' \t':
+                if not skip:
+                    lines.append(line)
+                continue
+            
+            skip = (num == 0 and line.startswith('From ')) or \
+                   line.split(':', 1)[0].strip().lower() in drop
+            if not skip:
+                lines.append(line)
+        
+        for (key, value) in extra:
+            lines.append('{0}: {1}\n'.format(key, value))
+        
+        lines.append('\n')
+        return (msgid, lines)
+    
     def news2mail(self, fobj=sys.stdin):
         """
         This method provides a drop-in-replacement to news2mail.pl used by INN_.
@@ -227,6 +849,8 @@ class PostFilter(FUCore):
             (token, names) = ltok.split(line.strip(), 1)
             addrs          = {}
             
+            self._sample_log('news2mail')
+            
             self._log('--- processing LTOK = \'{0}\'', line, verbosity=2)
             
             # XXX: this could be done !!FASTER!!
@@ -379,6 +1003,25 @@ def FilterMail2News():
         sys.exit(filter.mail2news())
     except Exception:
         FUCore.log_traceback(filter)
+    finally:
+        FUCore.flush_log()
+
+def FilterMail2NewsDrain():
+    """
+    Global wrapper for setup-tools.
+    """
+    try:
+        filter = PostFilter(mode='drain')
+    except Exception:
+        FUCore.log_traceback(None)
+
+    try:
+        options = Config.get().options
+        sys.exit(filter.drain(options.workers, options.once))
+    except Exception:
+        FUCore.log_traceback(filter)
+    finally:
+        FUCore.flush_log()
 
 def FilterNews2Mail():
     """
@@ -393,5 +1036,20 @@ def FilterNews2Mail():
         sys.exit(filter.news2mail())
     except Exception:
         FUCore.log_traceback(filter)
+    finally:
+        FUCore.flush_log()
+
+_drain_filter = None
 
+def _drain_init(postfilter):
+    """
+    Worker initializer for :meth:`PostFilter.drain`.
+    """
+    global _drain_filter
+    _drain_filter = postfilter
 
+def _drain_worker(names):
+    """
+    Worker entry point for :meth:`PostFilter.drain`.
+    """
+    return _drain_filter._drain_batch(names)
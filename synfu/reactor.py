@@ -38,8 +38,10 @@
 
 """
 
-import sys, re, quopri
-import email, email.message, email.header
+import sys, os, re, stat, time, quopri, signal, mailbox, marshal, itertools, SocketServer
+import multiprocessing
+import email, email.message, email.header, email.generator, email.parser
+from cStringIO import StringIO
 
 from synfu.config import Config
 from synfu.fucore import FUCore
@@ -68,6 +70,20 @@ class Reactor(FUCore):
     
     BROKEN_MULTIPART = re.compile('^Content-Type: [^;]*; boundary=')
     
+    FOOTER_LINES = [
+        re.compile('[ \t\r\v\f]*(?:_+|-+)[ \t\r\v\f]*(?=\n|\Z)'),
+        re.compile('\n[ \t\r\v\f]*(?:_+|-+)[ \t\r\v\f]*(?=\n|\Z)'),
+        re.compile('\n[ \t\r\v\f]*(?=\n|\Z)')
+    ]
+    
+    FOOTER_SEP   = 0
+    FOOTER_SIG   = 1
+    FOOTER_RANGE = 9
+    
+    BATCH_CHUNK  = 16
+    COPY_CHUNK   = 64 * 1024
+    LARGE_WINDOW = 4096
+    
     VERSION = '0.3b (based on mutagenX 0.4g)'
     NOTICE  = '(c) 2009-2010 Rene Koecher <shirk@bitspin.org>'
     
@@ -85,10 +101,45 @@ class Reactor(FUCore):
                           default = [],
                           help    = 'Header whitelist (won\'t remove these)')
         
+        Config.add_option('-S', '--serve',
+                          dest    = 'serve_socket',
+                          action  = 'store',
+                          default = None,
+                          metavar = 'SOCKET',
+                          help    = 'Serve messages on the unix domain socket SOCKET')
+        
+        Config.add_option('-B', '--batch',
+                          dest    = 'batch_source',
+                          action  = 'store',
+                          default = None,
+                          metavar = 'SOURCE',
+                          help    = 'Filter all messages in the mbox or Maildir SOURCE')
+        
+        Config.add_option('-O', '--output',
+                          dest    = 'batch_target',
+                          action  = 'store',
+                          default = None,
+                          metavar = 'TARGET',
+                          help    = 'Write --batch results to the mbox or Maildir TARGET')
+        
+        Config.add_option('-j', '--workers',
+                          dest    = 'workers',
+                          action  = 'store',
+                          type    = 'int',
+                          default = None,
+                          metavar = 'N',
+                          help    = 'Use N worker processes for --batch')
+        
         super(Reactor, self).__init__(Config.get().reactor)
         
-        self._conf = Config.get().reactor
-        self._mm   = email.message_from_file(sys.stdin)
+        self._conf    = Config.get().reactor
+        self._skipped = [0, 0]
+        self._footers = None
+        
+        if self._conf.footer_cache_size:
+            self._footers = _FooterCache(self._conf.footer_cache,
+                                         self._conf.footer_cache_size,
+                                         self._conf.footer_cache_misses)
     
     def run(self):
         """
@@ -96,53 +147,523 @@ class Reactor(FUCore):
         :attr:`sys.stdout`.
         
         The message will be processed according the the global settings.
+        If :option:`--serve` or :option:`--batch` was given :meth:`serve`
+        or :meth:`batch` is called instead.
         
         .. note::
         
             There is no need to import and call this method directly.
             SynFu provides the wrapper script *synfu-reactor.py* for this job.
         """
-        if (self._is_cancel(self._mm)):
-            sys.exit(0)
+        options = Config.get().options
+        
+        if options.serve_socket:
+            return self.serve(options.serve_socket)
+        
+        if options.batch_source:
+            if not options.batch_target:
+                raise RuntimeError('--batch requires --output')
+            
+            return self.batch(options.batch_source, options.batch_target,
+                              options.workers or self._conf.workers)
+        
+        self._react(sys.stdin, sys.stdout)
+        self._log_footer_cache()
+    
+    def serve(self, path):
+        """
+        Serve messages on the unix domain socket *path*.
+        
+        Config, blacklist and logging are set up only once, after that
+        each connection is expected to deliver exactly one message and
+        to shut down it's sending side. The filtered message is written
+        back on the same connection, exactly as :meth:`run` would have
+        written it to :attr:`sys.stdout`.
+        
+        Connections are handled one after another until the process
+        receives SIGTERM or SIGINT.
+        
+        :param path: filesystem path of the unix domain socket
+        :returns: 0
+        """
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise RuntimeError('Refusing to replace "{0}": not a socket'.format(path))
+            
+            # left over by an instance which died unexpectedly
+            os.unlink(path)
+        
+        server = SocketServer.UnixStreamServer(path, _ReactorRequestHandler)
+        server.reactor = self
+        
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        
+        self._log('--- serving on "{0}"', path)
+        try:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+            self._log('--- stopped serving on "{0}"', path)
+            self._log('--- not decoded: {0[0]} parts, {0[1]} bytes', self._skipped)
+            self._log_footer_cache()
+        
+        return 0
+    
+    def batch(self, source, target, workers=1):
+        """
+        Filter all messages from the mailbox *source* into the mailbox *target*.
+        
+        Both mailboxes may either be a mbox file or a Maildir (any existing
+        directory or a path ending in a path separator is taken as Maildir).
+        *target* is created as needed, messages are appended to it.
+        Dropped messages (cancels, blacklist) are not written while failing
+        messages are logged and skipped.
+        
+        With *workers* > 1 messages are filtered by a pool of worker processes.
+        Results are still written in the order of *source* and the throughput
+        of each worker is logged once all messages are done.
+        
+        :param  source: path of the mailbox to read from
+        :param  target: path of the mailbox to write to
+        :param workers: number of worker processes
+        :returns: 0 if all messages were processed, 1 otherwise
+        """
+        src    = Reactor._open_mailbox(source, create=False)
+        dst    = Reactor._open_mailbox(target, create=True)
+        pool   = None
+        counts = {'read': 0, 'written': 0, 'failed': 0, 'undecoded': 0,
+                  'hits': 0, 'misses': 0}
+        stats  = {}
+        
+        self._log('--- batch: "{0}" -> "{1}" ({2} workers)', source, target, workers)
+        
+        messages = ((key, src.get_string(key)) for key in src.iterkeys())
+        
+        if workers > 1:
+            # workers log directly, don't fork while a record is being written
+            FUCore.flush_log()
+            pool    = multiprocessing.Pool(workers, _batch_init, (self,))
+            results = pool.imap(_batch_worker, messages, Reactor.BATCH_CHUNK)
+        else:
+            results = itertools.imap(self._batch_one, messages)
+        
+        dst.lock()
+        try:
+            for (pid, elapsed, size, undecoded, cached, key, result, failed) in results:
+                counts['read']      += 1
+                counts['undecoded'] += undecoded
+                counts['hits']      += cached[0]
+                counts['misses']    += cached[1]
+                
+                if failed:
+                    counts['failed'] += 1
+                elif result is not None:
+                    dst.add(result)
+                    counts['written'] += 1
+                
+                worker = stats.setdefault(pid, [0, 0, 0.0])
+                worker[0] += 1
+                worker[1] += size
+                worker[2] += elapsed
+            
+            dst.flush()
+            
+            if pool:
+                pool.close()
+                pool.join()
+                pool = None
+        finally:
+            if pool:
+                pool.terminate()
+            
+            dst.unlock()
+            dst.close()
+            src.close()
+        
+        for (pid, (messages, size, elapsed)) in sorted(stats.items()):
+            self._log('--- batch: worker {0}: {1} messages, {2} bytes in {3:.2f}s ({4:.1f} messages/s)',
+                      pid, messages, size, elapsed, messages / max(elapsed, 0.001))
+        
+        self._log('--- batch: {0[read]} read, {0[written]} written, {0[failed]} failed', counts)
+        self._log('--- batch: {0[undecoded]} bytes not decoded', counts)
+        
+        if self._footers is not None:
+            self._log('--- batch: footer cache: {0[hits]} hits, {0[misses]} misses', counts)
+        
+        if counts['failed']:
+            return 1
+        return 0
+    
+    def _batch_one(self, item):
+        """
+        Filter a single (key, message) pair for :meth:`batch`.
+        
+        :returns: a tuple of (pid, elapsed, size, undecoded, cached, key, result, failed)
+                  with *cached* being the footer cache (hits, misses) and *result*
+                  being :const:`None` for dropped messages.
+        """
+        (key, data) = item
+        
+        start  = time.time()
+        skip   = self._skipped[1]
+        stats  = [0, 0]
+        
+        if self._footers is not None:
+            stats = self._footers.stats[:]
+        out    = StringIO()
+        result = None
+        failed = False
+        
+        try:
+            if self._react(StringIO(data), out):
+                result = out.getvalue()
+                
+        except Exception:
+            self._log('!!! batch: failed to process message "{0}"', key)
+            FUCore.log_traceback(self, noreturn=False)
+            failed = True
+        
+        cached = [0, 0]
+        if self._footers is not None:
+            cached = [self._footers.stats[0] - stats[0], self._footers.stats[1] - stats[1]]
+        
+        return (os.getpid(), time.time() - start, len(data),
+                self._skipped[1] - skip, cached, key, result, failed)
+    
+    @staticmethod
+    def _open_mailbox(path, create):
+        """
+        Open *path* as :class:`mailbox.Maildir` or :class:`mailbox.mbox`.
+        """
+        if os.path.isdir(path) or path.endswith(os.sep):
+            return mailbox.Maildir(path, factory=None, create=create)
+        
+        return mailbox.mbox(path, factory=None, create=create)
+    
+    def _react(self, fobj, out):
+        """
+        Read a single message from *fobj*, filter it and write the
+        result to *out*.
+        
+        With :option:`--filter-only` only the header block is parsed, the
+        body is copied from *fobj* to *out* without being parsed or
+        regenerated. Messages larger than *spill_threshold* are spilled
+        to disk and handled by :meth:`_react_large`.
+        
+        :param fobj: A file-like object providing the message.
+        :param  out: A file-like object receiving the filtered message.
+        :returns: :const:`True` if a message was written,
+                  :const:`False` if it was dropped.
+        """
+        self._sample_log('reactor')
         
         if Config.get().options.filter_only:
-            self._mm._headers = self._filter_headers(re.compile(''), self._mm._headers,
-                                                     self._conf.outlook_hacks, 
-                                                     self._conf.fix_dateline, 0,
-                                                     Config.get().options.header_whitelist)
-
+            message = email.parser.HeaderParser().parsestr(self._read_headers(fobj))
+            body    = self._copy(fobj)
+        
+        elif self._conf.spill_threshold:
+            (spool, spilled) = self._spool(fobj, self._conf.spill_threshold)
+            try:
+                if spilled:
+                    return self._react_large(spool, out)
+                
+                message = email.message_from_file(spool)
+                body    = None
+            finally:
+                spool.close()
+        
         else:
-            self._mm  = self._apply_blacklist(self._mm, 'reactor', 0)
-            if not self._mm:
+            message = email.message_from_file(fobj)
+            body    = None
+        
+        return self._react_message(message, out, body)
+    
+    def _react_message(self, message, out, body=None):
+        """
+        Filter the already parsed *message* and write the result to *out*.
+        
+        This is the part of :meth:`_react` following the parser, it is also
+        used by :meth:`synfu.postfilter.PostFilter.mail2news` to run the
+        reactor in-process (see *mail2news_reactor*).
+        
+        :param message: A :class:`email.message` object.
+        :param     out: A file-like object receiving the filtered message.
+        :param    body: Optional iterable providing the body of a
+                        header-only *message* in chunks.
+        :returns: :const:`True` if a message was written,
+                  :const:`False` if it was dropped.
+        """
+        if (self._is_cancel(message)):
+            return False
+        
+        if Config.get().options.filter_only:
+            message._headers = self._filter_headers(re.compile(''), message._headers,
+                                                    self._conf.outlook_hacks, 
+                                                    self._conf.fix_dateline, 0,
+                                                    Config.get().options.header_whitelist)
+        
+        else:
+            message = self._apply_blacklist(message, 'reactor', 0)
+            if not message:
                 # should not happen but who knows?
                 self._log('--- Message was dropped by blacklist')
-                sys.exit(0)
+                return False
         
-            self._mm = self._process(self._mm)
-            self._mm.add_header('X-SynFU-Reactor', 
-                                Reactor.NOTICE, version=Reactor.VERSION)
+            message = self._process(message)
+            message.add_header('X-SynFU-Reactor', 
+                               Reactor.NOTICE, version=Reactor.VERSION)
+            
+            if self._footers is not None:
+                self._footers.save()
         
-        print_out = False
-        for p in str(self._mm).split('\n')[1:]:
-            if self._conf.strip_notes and not Config.get().options.filter_only:
-                if Reactor.SIGN_NOTICE[0].match(p) and not print_out:
-                    print_out = True
-                    continue
-                    
-                if Reactor.SIGN_NOTICE[1].match(p) and not print_out:
-                    # mailman is kinky
-                    print ''
-                    print_out = True
-                    continue
-                    
-                if Reactor.SIGN_NOTICE[2].match(p) and not print_out:
-                    continue
+        self._dump(message, out, body)
+        return True
+    
+    def _log_footer_cache(self):
+        """
+        Log the hit rate of the footer cache (if enabled).
+        """
+        if self._footers is None:
+            return
+        
+        (hits, misses) = self._footers.stats
+        self._log('--- footer cache: {0} hits, {1} misses ({2:.1f}% hit rate), {3} lists',
+                  hits, misses, 100.0 * hits / max(hits + misses, 1), len(self._footers))
+    
+    def _dump(self, message, out, body=None):
+        """
+        Write *message* to *out* applying the output filters
+        (signature notes and broken multipart boundaries).
+        
+        The message is generated straight into *out* (see :class:`_ReactorGenerator`
+        and :class:`_ReactorOutput`) instead of being flattened into a string first.
+        With :option:`--filter-only` the output filters only apply to the headers,
+        *body* is copied to *out* untouched.
+        
+        :param message: A :class:`email.message` object.
+        :param     out: A file-like object receiving the message.
+        :param    body: Optional iterable providing the body of a
+                        header-only *message* in chunks.
+        :returns: :const:`None`
+        """
+        output = _ReactorOutput(out, self._conf.strip_notes and \
+                                     not Config.get().options.filter_only)
+        
+        _ReactorGenerator(output).flatten(message, unixfrom=False)
+        
+        if body is not None and Config.get().options.filter_only:
+            # the header block ends with an empty line, nothing is left in output
+            for chunk in body:
+                out.write(chunk)
+            
+            return
+        
+        if body is not None:
+            for chunk in body:
+                output.write(chunk)
+        
+        output.close()
+    
+    def _copy(self, fobj, start=None, end=None):
+        """
+        Iterate over the contents of *fobj* in chunks of :attr:`COPY_CHUNK` bytes.
+        
+        :param  fobj: A file-like object.
+        :param start: Offset to start at (default: the current position).
+        :param   end: Offset to stop at (default: the end of *fobj*).
+        """
+        if start is not None:
+            fobj.seek(start)
+        
+        while True:
+            size = Reactor.COPY_CHUNK
+            if end is not None:
+                size = min(size, end - fobj.tell())
+            
+            chunk = size > 0 and fobj.read(size)
+            if not chunk:
+                break
+            
+            yield chunk
+    
+    def _react_large(self, spool, out):
+        """
+        Filter a message spilled to disk by :meth:`_react`.
+        
+        Only the headers and the last MIME part (the only one which may
+        carry a list footer) are parsed. The remaining body is copied from
+        *spool* to *out* unchanged so memory use is bounded by
+        *spill_threshold* regardless of the message size.
+        
+        :param spool: A file-like object providing the message.
+        :param   out: A file-like object receiving the filtered message.
+        :returns: Same as :meth:`_react`.
+        """
+        message = email.parser.HeaderParser().parsestr(self._read_headers(spool))
+        offset  = spool.tell()
+        
+        if (self._is_cancel(message)):
+            return False
+        
+        message = self._apply_blacklist(message, 'reactor', 0)
+        if not message:
+            self._log('--- Message was dropped by blacklist')
+            return False
+        
+        self._log('>>> processing large {0}', message.get_content_type())
+        self._process_headers(message)
+        
+        if message.get_content_maintype() == 'multipart' and message.get_boundary():
+            body = self._large_multipart(spool, offset, message.get_boundary())
+        
+        elif message.get_content_maintype() == 'text':
+            body = self._large_text(spool, offset, message)
+        
+        else:
+            body = self._copy(spool, offset)
+        
+        message.add_header('X-SynFU-Reactor', 
+                           Reactor.NOTICE, version=Reactor.VERSION)
+        
+        self._dump(message, out, body)
+        return True
+    
+    def _large_multipart(self, spool, offset, boundary):
+        """
+        Process the last part of a large multipart message.
+        
+        :param    spool: A file-like object providing the message.
+        :param   offset: Offset of the body inside *spool*.
+        :param boundary: The multipart boundary of the message.
+        :returns: An iterable providing the processed body.
+        """
+        found = self._find_last_part(spool, offset, boundary)
+        
+        if not found:
+            self._log('--- no complete last part found', rec=1)
+            return self._copy(spool, offset)
+        
+        (delim, start, end, close) = found
+        
+        if close is None:
+            # generated like email.generator would do it
+            self._log('--- adding missing closing delimiter', rec=1)
+            tail = ['--' + boundary + '--\n']
+        else:
+            tail = self._copy(spool, close)
+        
+        if end - start > self._conf.spill_threshold:
+            self._log('--- not scanning last part ({0} bytes)', end - start, rec=1)
+            if close is None:
+                return itertools.chain(self._copy(spool, offset, end), ['\n'], tail)
+            
+            return self._copy(spool, offset)
+        
+        spool.seek(start)
+        
+        container = email.message.Message()
+        container['Content-Type'] = 'multipart/mixed'
+        container.attach(email.message_from_string(spool.read(end - start)))
+        
+        self._process(container, 1)
+        
+        if not container.get_payload():
+            return itertools.chain(self._copy(spool, offset, delim), tail)
+        
+        part = StringIO()
+        _ReactorGenerator(part).flatten(container.get_payload(0), unixfrom=False)
+        
+        return itertools.chain(self._copy(spool, offset, start),
+                               [part.getvalue(), '\n'], tail)
+    
+    def _large_text(self, spool, offset, message):
+        """
+        Remove the footer from the end of a large single part text message.
+        
+        Only unencoded bodies are handled, the footer is searched for in the
+        last *footer_window* bytes (see :meth:`_find_footer`).
+        
+        :param   spool: A file-like object providing the message.
+        :param  offset: Offset of the body inside *spool*.
+        :param message: The (header-only) :class:`email.message` object.
+        :returns: An iterable providing the processed body.
+        """
+        encoding = message.get('Content-Transfer-Encoding', '7bit').strip().lower()
+        
+        if encoding not in ('7bit', '8bit', 'binary'):
+            self._log('--- not scanning large {0} body', encoding, rec=1)
+            return self._copy(spool, offset)
+        
+        spool.seek(0, os.SEEK_END)
+        start = max(offset, spool.tell() - (self._conf.footer_window or Reactor.LARGE_WINDOW))
+        
+        if start > offset:
+            # align the window to the next line start
+            spool.seek(start - 1)
+            start += len(spool.readline()) - 1
+        
+        spool.seek(start)
+        tail = spool.read()
+        
+        mailman_sig = self._conf.complex_footer and Reactor.MAILMAN_COMPLEX or Reactor.MAILMAN_SIG
+        
+        if self._find_footer(tail, mailman_sig[0]) == -1:
+            return self._copy(spool, offset)
+        
+        (use, mutation) = self._mutate_part(tail, 1)
+        if not use:
+            return self._copy(spool, offset)
+        
+        self._log('*** mutated this part', rec=1)
+        return itertools.chain(self._copy(spool, offset, start), [mutation])
+    
+    def _find_last_part(self, spool, offset, boundary):
+        """
+        Locate the last part of a multipart body without parsing it.
+        
+        :param    spool: A file-like object providing the message.
+        :param   offset: Offset of the body inside *spool*.
+        :param boundary: The multipart boundary of the message.
+        :returns: A tuple of (delimiter, start, end, close) offsets of the last
+                  delimiter line, the part itself and the closing delimiter
+                  (:const:`None` if it's missing) or :const:`None` if there
+                  is no part at all.
+        """
+        delim = '--' + boundary
+        found = None
+        pos   = offset
+        last  = '\n'
+        
+        spool.seek(offset)
+        
+        for line in iter(lambda: spool.readline(Reactor.COPY_CHUNK), ''):
+            if last.endswith('\n') and line.startswith(delim):
+                tail = line[len(delim):].rstrip(' \t\r\n')
+                
+                if tail == '--':
+                    if not found:
+                        return None
                     
-            if Reactor.BROKEN_MULTIPART.match(p):
-                # multipart *should be* seperated by a newline
-                p = p.replace('; boundary=', ';\n boundary=')
+                    # the line break in front of the delimiter belongs to it
+                    end = pos - (len(last) - len(last.rstrip('\r\n')))
+                    return (found[0], found[1], max(end, found[1]), pos)
                 
-            print p.replace('\x0d', '')
+                if not tail:
+                    found = (pos, pos + len(line))
+            
+            pos += len(line)
+            last = line
+        
+        if found:
+            # the last part ends with the body, like email.feedparser sees it
+            end = pos - (len(last) - len(last.rstrip('\r\n')))
+            return (found[0], found[1], max(end, found[1]), None)
+        
+        return None
     
     
     def _process(self, message, rec=0):
@@ -170,6 +691,8 @@ class Reactor(FUCore):
         """
         mm_parts    = 0
         text_parts  = 0
+        skip_parts  = 0
+        skip_bytes  = 0
         mailman_sig = Reactor.MAILMAN_SIG
         
         self._log('>>> processing {0}', message.get_content_type(), rec=rec)
@@ -183,24 +706,13 @@ class Reactor(FUCore):
         else:
             parts = [message,]
             
-        list_tag  = self._find_list_tag(message, rec)
-        reference = message.get('References', None)
-        in_reply  = message.get('In-Reply-To', None)
+        list_id   = None
         x_mailman = message.get('X-Mailman-Version', None)
         
-        message._headers = self._filter_headers(list_tag, message._headers,
-                                                self._conf.outlook_hacks, 
-                                                self._conf.fix_dateline, rec)
+        if self._footers is not None:
+            list_id = self._find_list_tag(message, rec, plain=True)
         
-        if in_reply and not reference and rec == 0:
-            # set References: to In-Reply-To: if where in toplevel
-            # and References was not set properly
-            self._log('--- set References: {0}', in_reply, rec=rec)
-            try:
-                # uncertain this will ever happen..
-                message.replace_header('References', in_reply)
-            except KeyError:
-                message._headers.append(('References', in_reply))
+        self._process_headers(message, rec)
                 
         for i in xrange(len(parts) - 1, -1, -1):
             # again, crude since we mutate the list while iterating it..
@@ -218,23 +730,54 @@ class Reactor(FUCore):
             if ct == 'text':
                 text_parts += 1
                 
+                reason = self._skip_scan(p, text_parts)
+                if reason:
+                    size = len(p.get_payload())
+                    self._log('--- not scanning part ({0}, {1} bytes)', reason, size, rec=rec)
+                    
+                    skip_parts += 1
+                    skip_bytes += size
+                    continue
+                
                 payload = p.get_payload(decode=True)
                 self._log('--- scan: """{0}"""', payload, rec=rec, verbosity=3)
                 
-                if mailman_sig[0].search(payload) and \
-                   mailman_sig[1].match(payload.split('\n')[0]):
+                cached = None
+                learn  = list_id and text_parts == 1 and not mm_parts
+                
+                if learn:
+                    # mailman appends it's footer to the last text part
+                    cached = self._footers.match(list_id, payload)
+                
+                if cached:
+                    self._log('--- cached footer for "{0}"', list_id, rec=rec)
+                    start = 0
+                else:
+                    start = self._find_footer(payload, mailman_sig[0])
+                
+                if (cached or start != -1) and \
+                   mailman_sig[1].match(payload.split('\n', 1)[0]):
                     
                     self._log('*** removing this part', rec=rec)
                     self._log('--- """{0}"""', payload, rec=rec, verbosity=2)
                     
+                    if learn and not cached:
+                        self._footers.learn(list_id, payload)
+                    
                     message._payload.remove(p)
                     text_parts -= 1
                     mm_parts   += 1
                     
-                elif mailman_sig[0].search(payload):
+                elif cached or start != -1:
                     self._log('--- trying to mutate..', rec=rec)
                     
-                    (use, mutation) = self._mutate_part(payload, rec)
+                    if cached:
+                        (use, mutation) = (True, payload[:len(payload) - len(cached)])
+                    else:
+                        (use, mutation) = self._mutate_part(payload, rec, start)
+                        
+                        if use and learn and payload.startswith(mutation):
+                            self._footers.learn(list_id, payload[len(mutation):])
                     if use:
                         self._log('*** mutated this part', rec=rec)
                         self._log('--- """{0}"""', payload, rec=rec, verbosity=2)
@@ -260,10 +803,17 @@ class Reactor(FUCore):
                 else:
                     self._log('--- what about {0}?', p.get_content_type(), rec=rec)
         
+        self._skipped[0] += skip_parts
+        self._skipped[1] += skip_bytes
+        
         if rec == 0:
             self._log('--- [mm_parts: {0}, text_parts: {1}, x_mailman: {0}]',
                       mm_parts, text_parts, x_mailman, rec=rec)
             
+            if skip_parts:
+                self._log('--- [not decoded: {0} parts, {1} bytes]',
+                          skip_parts, skip_bytes, rec=rec)
+            
             if x_mailman and mm_parts and not text_parts:
                 # if we have
                 # - modified the content
@@ -286,7 +836,88 @@ class Reactor(FUCore):
                 
         return message
     
-    def _mutate_part(self, body, rec=0):
+    def _skip_scan(self, part, position):
+        """
+        Check if a text part can be skipped by the footer scan.
+        
+        A part is skipped (and never decoded) if it is
+        
+            * not among the last *footer_parts* text parts of it's message
+            * an attachment and *footer_skip_attachments* is enabled
+            * larger than *footer_max_size* bytes (encoded)
+        
+        :param     part: A :class:`email.message` object.
+        :param position: Position of *part* counting text parts from the end.
+        :returns: The reason for skipping as string or :const:`None`.
+        """
+        if self._conf.footer_parts and position > self._conf.footer_parts:
+            return 'position'
+        
+        if self._conf.footer_skip_attachments:
+            disposition = part.get('Content-Disposition', '').split(';')[0]
+            if disposition.strip().lower() == 'attachment':
+                return 'attachment'
+        
+        if self._conf.footer_max_size and \
+           len(part.get_payload()) > self._conf.footer_max_size:
+            return 'size'
+        
+        return None
+    
+    def _process_headers(self, message, rec=0):
+        """
+        Filter the headers of *message* (see :meth:`_process`).
+        
+        :param message: A :class:`email.message` object.
+        :param     rec: Recursion level used to prettify log messages.
+        :returns: :const:`None`
+        """
+        list_tag  = self._find_list_tag(message, rec)
+        reference = message.get('References', None)
+        in_reply  = message.get('In-Reply-To', None)
+        
+        message._headers = self._filter_headers(list_tag, message._headers,
+                                                self._conf.outlook_hacks, 
+                                                self._conf.fix_dateline, rec)
+        
+        if in_reply and not reference and rec == 0:
+            # set References: to In-Reply-To: if where in toplevel
+            # and References was not set properly
+            self._log('--- set References: {0}', in_reply, rec=rec)
+            try:
+                # uncertain this will ever happen..
+                message.replace_header('References', in_reply)
+            except KeyError:
+                message._headers.append(('References', in_reply))
+    
+    def _find_footer(self, payload, signature):
+        """
+        Look for a mailman signature at the end of a decoded text part.
+        
+        Only the last *footer_window* bytes of *payload* (starting at the
+        first complete line) are searched, unless *footer_full_scan* is
+        enabled or the window is disabled.
+        
+        :param   payload: The decoded text part.
+        :param signature: The pattern matching a signature line.
+        :returns: The offset the footer scan should start at or -1 if no
+                  signature was found.
+        """
+        start  = 0
+        window = self._conf.footer_window
+        
+        if window and not self._conf.footer_full_scan and len(payload) > window:
+            start = len(payload) - window
+            if payload[start - 1] != '\n':
+                start = payload.find('\n', start) + 1 or len(payload)
+        
+        if payload.find('/listinfo/', start) == -1 or \
+           not signature.search(payload, start):
+            return -1
+        
+        return start
+    
+    def _mutate_part(self, body, rec=0, start=0):
         """
         Mutate a single message part.
         
@@ -300,6 +931,7 @@ class Reactor(FUCore):
         Args:
             body: The (decoded) message part including all subparts.
             rec:  Recursion level used to prettify log messages.
+            start: Offset of the first line to scan (see :meth:`_find_footer`).
             
         Returns:
             A tuple containing the (modified) message part and a flag
@@ -309,65 +941,457 @@ class Reactor(FUCore):
             (true, 'body-of-modified-message-part')
         """
         
+        if self._conf.complex_footer:
+            return self._mutate_complex(body, rec, start)
+        
         mutation = []
         skip     = 0
         mutated  = False
-        parts    = body.split('\n')
+        parts    = body[start:].split('\n')
         
         for i in range(0, len(parts)):
             parts_orig = parts[i]
             
-            if self._conf.complex_footer:
-                parts[i] = parts[i].strip()
+            if skip:
+                skip -= 1
+                continue
                 
-                if skip and not parts[i]:
-                    skip = 0
-                    self._log('--- stop line-skip at {0}', i, rec=rec)
-                    
-                elif skip:
-                    continue
-                    
-                if Reactor.MAILMAN_COMPLEX[1].match(parts[i]):
-                    try:
-                        for j in range(i + 1, i + 10):
-                            if Reactor.MAILMAN_COMPLEX[1].match(parts[j].strip()):
-                                self._log('--- not a mailman signature, reset at {0}', j, rec=rec)
-                                skip    = 0
-                                break
-                            
-                            if Reactor.MAILMAN_COMPLEX[0].match(parts[j].strip()):
-                                self._log('--- skip lines starting at {0}', j, rec=rec)
-                                skip    = 1
-                                mutated = True
-                                break
-                                
-                        if skip:
-                            continue
-                                
-                    except IndexError:
-                        pass
+            parts[i] = parts[i].strip()
+            
+            if Reactor.MAILMAN_SIG[1].match(parts[i]):
+                try:
+                    if Reactor.MAILMAN_SIG[0].match(parts[i + 3].strip()):
+                        self._log('--- skip line(s) {0}-{1}', i, i + 3, rec=rec)
+                        skip    = 3
+                        mutated = True
+                        continue
                         
+                except IndexError:
+                    pass
+            
+            mutation.append(parts_orig)
+        
+        if start and not mutation:
+            return (mutated, body[:start - 1])
+        
+        return (mutated, body[:start] + '\n'.join(mutation))
+    
+    def _footer_marks(self, body, start=0):
+        """
+        Find all separator and signature lines in *body* starting at the
+        line beginning at offset *start*.
+        
+        Separators are located using :attr:`FOOTER_LINES`, signatures by
+        searching for ``/listinfo/``. No other line is split off or stripped.
+        
+        Args:
+            body: The (decoded) message part.
+            start: Offset of the first line to look at.
+            
+        Returns:
+            A sorted list of ``(start, kind, end)`` tuples where *kind* is
+            either :attr:`FOOTER_SEP` or :attr:`FOOTER_SIG` and *start* and
+            *end* are the offsets of the line inside *body*.
+        """
+        found = []
+        size  = len(body)
+        
+        match = Reactor.FOOTER_LINES[0].match(body, start)
+        if match:
+            found.append((start, Reactor.FOOTER_SEP, match.end()))
+        
+        for match in Reactor.FOOTER_LINES[1].finditer(body, start):
+            found.append((match.start() + 1, Reactor.FOOTER_SEP, match.end()))
+        
+        pos = body.find('/listinfo/', start)
+        while pos != -1:
+            start = body.rfind('\n', 0, pos) + 1
+            end   = body.find('\n', pos)
+            if end == -1:
+                end = size
+            
+            if Reactor.MAILMAN_COMPLEX[0].match(body[start:end].strip()):
+                found.append((start, Reactor.FOOTER_SIG, end))
+            
+            pos = body.find('/listinfo/', end)
+        
+        found.sort()
+        return found
+    
+    def _mutate_complex(self, body, rec=0, start=0):
+        """
+        Remove complex mailman footers from a single message part.
+        
+        A footer starts at a separator line followed by a signature line
+        (containing a ``listinfo`` URL) within the next :attr:`FOOTER_RANGE`
+        lines, with no other separator in between. It ends right before the
+        next empty line.
+        
+        The part is scanned once (see :meth:`_footer_marks`) and the result
+        is assembled from slices of *body*.
+        
+        Args:
+            body: The (decoded) message part including all subparts.
+            rec:  Recursion level used to prettify log messages.
+            start: Offset of the first line to scan.
+            
+        Returns:
+            Same as :meth:`_mutate_part`.
+        """
+        marks    = self._footer_marks(body, start)
+        mutation = []
+        offset   = 0
+        resume   = 0
+        empty    = Reactor.FOOTER_LINES[2]
+        
+        for n in xrange(len(marks) - 1):
+            (start, kind, end) = marks[n]
+            
+            if kind != Reactor.FOOTER_SEP or start < resume:
+                continue
+            
+            (next_start, next_kind) = marks[n + 1][:2]
+            
+            if next_kind != Reactor.FOOTER_SIG or \
+               body.count('\n', start, next_start) > Reactor.FOOTER_RANGE:
+                continue
+            
+            self._log('--- skip lines starting at {0}', body.count('\n', 0, next_start), rec=rec)
+            mutation.append(body[offset:start])
+            
+            match = empty.search(body, end)
+            if match:
+                offset = resume = match.start() + 1
+                self._log('--- stop line-skip at {0}', body.count('\n', 0, offset), rec=rec)
             else:
-                if skip:
-                    skip -= 1
-                    continue
-                    
-                parts[i] = parts[i].strip()
+                offset = resume = len(body) + 1
+                break
+        
+        if not mutation:
+            return (False, body)
+        
+        mutation.append(body[offset:])
+        
+        if offset > len(body) and mutation[-2]:
+            # the footer reached the end of the body
+            mutation[-2] = mutation[-2][:-1]
+        
+        return (True, ''.join(mutation))
+    
+
+class _FooterCache(object):
+    """
+    Footers learned per mailing list.
+    
+    Once the footer scan removed a footer from the end of a text part
+    the removed text is remembered for the list tag of the message.
+    Later messages of the same list are checked against it using a plain
+    suffix comparison before any pattern is run.
+    
+    Entries are dropped after *misses* consecutive messages of their list
+    did not end in the cached footer and the least recently used entry is
+    evicted if more than *size* lists are known. If *path* is given the
+    entries are kept in that file between runs.
+    """
+    
+    MAX_FOOTER = 4096
+    
+    def __init__(self, path=None, size=64, misses=3):
+        self._path    = path and os.path.expanduser(path)
+        self._size    = size
+        self._misses  = misses
+        self._dirty   = False
+        self._entries = {}
+        self._clock   = 0
+        
+        # hits, misses
+        self.stats    = [0, 0]
+        
+        self.load()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def load(self):
+        """
+        Load the cached footers from *path* (if any).
+        """
+        if not self._path or not os.path.exists(self._path):
+            return
+        
+        try:
+            with open(self._path, 'rb') as fobj:
+                entries = marshal.load(fobj)
+            
+            if isinstance(entries, dict):
+                self._entries = entries
+                self._clock   = max([x[2] for x in entries.values()] or [0])
                 
-                if Reactor.MAILMAN_SIG[1].match(parts[i]):
-                    try:
-                        if Reactor.MAILMAN_SIG[0].match(parts[i + 3].strip()):
-                            print_ign('--- skip line(s) {0}-{1}', i, i + 3, rec=rec)
-                            skip    = 3
-                            mutated = True
-                            continue
-                            
-                    except IndexError:
-                        pass
+        except (IOError, EOFError, ValueError, TypeError):
+            # a broken cache is no reason to stop filtering
+            self._entries = {}
+    
+    def save(self):
+        """
+        Write the cached footers to *path* if they were modified.
+        """
+        if not self._path or not self._dirty:
+            return
+        
+        temp = '{0}.{1}'.format(self._path, os.getpid())
+        with open(temp, 'wb') as fobj:
+            marshal.dump(self._entries, fobj)
+        
+        os.rename(temp, self._path)
+        self._dirty = False
+    
+    def match(self, tag, payload):
+        """
+        Check if *payload* ends in the cached footer of *tag*.
+        
+        :param     tag: The plain list tag.
+        :param payload: The decoded text part.
+        :returns: The footer or :const:`None`.
+        """
+        entry = self._entries.get(tag)
+        
+        if entry:
+            if payload.endswith(entry[0]):
+                if entry[1]:
+                    # the misses so far are persistent as well
+                    self._dirty = True
+                
+                entry[1] = 0
+                entry[2] = self._tick()
+                self.stats[0] += 1
+                return entry[0]
             
-            mutation.append(parts_orig)
-        return (mutated, '\n'.join(mutation))
+            # saved even with one process per message
+            entry[1] += 1
+            self._dirty = True
+            
+            if entry[1] >= self._misses:
+                del self._entries[tag]
+        
+        self.stats[1] += 1
+        return None
+    
+    def learn(self, tag, footer):
+        """
+        Remember *footer* as the footer of *tag*.
+        
+        :param    tag: The plain list tag.
+        :param footer: The removed text.
+        """
+        if not footer or len(footer) > _FooterCache.MAX_FOOTER:
+            return
+        
+        if tag not in self._entries and len(self._entries) >= self._size:
+            oldest = min(self._entries, key=lambda x: self._entries[x][2])
+            del self._entries[oldest]
+        
+        self._entries[tag] = [footer, 0, self._tick()]
+        self._dirty = True
+    
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+    
+
+class _ReactorGenerator(email.generator.Generator):
+    """
+    A :class:`email.generator.Generator` writing straight to it's output.
+    
+    The stock generator renders every (sub-)part into a buffer before writing
+    the part headers, just in case it has to invent a multipart boundary.
+    Messages passing the reactor already carry their boundaries, so parts
+    are only buffered if one is actually missing.
+    """
+    
+    def _write(self, msg):
+        if msg.get_content_maintype() == 'multipart' and not msg.get_boundary():
+            return email.generator.Generator._write(self, msg)
+        
+        meth = getattr(msg, '_write_headers', None)
+        if meth is None:
+            self._write_headers(msg)
+        else:
+            meth(self)
+        
+        self._dispatch(msg)
     
+    def _handle_multipart(self, msg):
+        subparts = msg.get_payload()
+        boundary = msg.get_boundary()
+        
+        if isinstance(subparts, basestring) or not boundary:
+            return email.generator.Generator._handle_multipart(self, msg)
+        
+        if subparts is None:
+            subparts = []
+        elif not isinstance(subparts, list):
+            subparts = [subparts]
+        
+        if msg.preamble is not None:
+            if self._mangle_from_:
+                print >> self._fp, email.generator.fcre.sub('>From ', msg.preamble)
+            else:
+                print >> self._fp, msg.preamble
+        
+        print >> self._fp, '--' + boundary
+        
+        for (i, part) in enumerate(subparts):
+            if i:
+                print >> self._fp, '\n--' + boundary
+            
+            self.clone(self._fp).flatten(part, unixfrom=False)
+        
+        self._fp.write('\n--' + boundary + '--\n')
+        
+        if msg.epilogue is not None:
+            if self._mangle_from_:
+                self._fp.write(email.generator.fcre.sub('>From ', msg.epilogue))
+            else:
+                self._fp.write(msg.epilogue)
+
+
+class _ReactorOutput(object):
+    """
+    File-like output filter used by :meth:`Reactor._dump`.
+    
+    Data is passed on to the wrapped file as soon as a line is complete.
+    Until a signature notice (see :attr:`Reactor.SIGN_NOTICE`) was found
+    the data is checked line by line, after that whole chunks are passed on
+    and only those containing a multipart boundary are split into lines.
+    """
+    
+    def __init__(self, out, strip_notes=False):
+        self._out    = out
+        self._tail   = ''
+        self._notice = strip_notes
+        
+        # used by the print statement
+        self.softspace = 0
+    
+    def write(self, data):
+        start = 0
+        
+        if self._tail:
+            start = data.find('\n') + 1
+            if not start:
+                self._tail += data
+                return
+            
+            self._write_lines(self._tail + data[:start - 1])
+            self._tail = ''
+        
+        end = data.rfind('\n')
+        if end >= start:
+            self._write_lines(data, start, end)
+        
+        self._tail = data[end + 1:]
+    
+    def close(self):
+        """
+        Write any remaining data (every line written ends with a newline).
+        """
+        self._write_lines(self._tail)
+        self._tail = ''
+    
+    def _write_lines(self, data, start=0, end=None):
+        """
+        Write the lines of *data* between *start* and *end* followed by a newline.
+        
+        Unless a line needs to be modified no copy of *data* is made.
+        """
+        if end is None:
+            end = len(data)
+        
+        if self._notice:
+            data = self._strip_notice(data[start:end].split('\n'))
+            if data is None:
+                return
+            
+            (start, end) = (0, len(data))
+        
+        if data.find('; boundary=', start, end) != -1:
+            data = '\n'.join(self._fix_boundary(p) for p in data[start:end].split('\n'))
+            (start, end) = (0, len(data))
+        
+        if data.find('\x0d', start, end) != -1:
+            data = data[start:end].replace('\x0d', '')
+            (start, end) = (0, len(data))
+        
+        self._out.write(buffer(data, start, end - start))
+        self._out.write('\n')
+    
+    def _strip_notice(self, lines):
+        kept = []
+        
+        for (i, p) in enumerate(lines):
+            if Reactor.SIGN_NOTICE[0].match(p):
+                self._notice = False
+                
+            elif Reactor.SIGN_NOTICE[1].match(p):
+                # mailman is kinky
+                kept.append('')
+                self._notice = False
+                
+            elif Reactor.SIGN_NOTICE[2].match(p):
+                continue
+                
+            else:
+                kept.append(p)
+                continue
+            
+            kept.extend(lines[i + 1:])
+            break
+        
+        if not kept:
+            return None
+        
+        return '\n'.join(kept)
+    
+    def _fix_boundary(self, p):
+        if Reactor.BROKEN_MULTIPART.match(p):
+            # multipart *should be* seperated by a newline
+            return p.replace('; boundary=', ';\n boundary=')
+        
+        return p
+
+
+_batch_reactor = None
+
+def _batch_init(reactor):
+    """
+    Worker initializer for :meth:`Reactor.batch`.
+    
+    The pool is forked after the reactor is set up so the instance
+    is simply inherited instead of being set up once more.
+    """
+    global _batch_reactor
+    _batch_reactor = reactor
+
+def _batch_worker(item):
+    """
+    Worker entry point for :meth:`Reactor.batch`.
+    """
+    return _batch_reactor._batch_one(item)
+
+class _ReactorRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Feed a single connection of :meth:`Reactor.serve` through the reactor.
+    """
+    
+    wbufsize = -1
+    
+    def handle(self):
+        reactor = self.server.reactor
+        
+        try:
+            reactor._react(self.rfile, self.wfile)
+        except Exception:
+            FUCore.log_traceback(reactor, noreturn=False)
 
 
 def ReactorRun():
@@ -380,7 +1404,9 @@ def ReactorRun():
         FUCore.log_traceback(None)
 
     try:
-        reactor.run()
+        sys.exit(reactor.run())
     except Exception:
         FUCore.log_traceback(reactor)
+    finally:
+        FUCore.flush_log()
 
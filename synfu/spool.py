@@ -0,0 +1,238 @@
+# encoding: utf-8
+#
+# spool.py
+#
+# Copyright (c) 2009-2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+#
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+.. module:: spool
+    :platform: Unix, MacOS
+    :synopsis: Maildir-like spool for synfu-mail2news.
+
+.. moduleauthor:: René Köcher <shirk@bitspin.org>
+
+"""
+
+import os, time, gzip, errno, socket
+
+class Spool(object):
+    """
+    Maildir-like spool of raw messages waiting for :command:`synfu-mail2news-drain`.
+    
+    Messages are written to ``tmp/``, synced to disk and renamed into
+    ``new/`` so they show up either complete or not at all. The directories
+    are synced after each move so it survives a crash as well. Drainers claim
+    messages by renaming them into ``cur/`` which is atomic as well, so a
+    spool can be shared by any number of drainers. Messages which can't be
+    delivered at all are moved to ``failed/``.
+    
+    Messages larger than *compress* bytes are stored gzip compressed
+    (their names end in ``.gz``).
+    """
+    
+    DIRS  = ['tmp', 'new', 'cur', 'failed']
+    
+    # claimed messages untouched for STALE seconds are given back to new/
+    STALE = 3600
+    
+    COMPRESS_SUFFIX = '.gz'
+    COMPRESS_LEVEL  = 1
+    COPY_CHUNK      = 64 * 1024
+    
+    _counter = 0
+    
+    def __init__(self, path, compress=0):
+        """
+        :param     path: The spool directory (created as needed).
+        :param compress: Compress messages larger than *compress* bytes (0 = never).
+        """
+        super(Spool, self).__init__()
+        
+        self.path      = path
+        self._compress = compress
+        
+        for name in Spool.DIRS:
+            try:
+                os.makedirs(os.path.join(path, name))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+    
+    def put(self, fobj):
+        """
+        Copy the message provided by *fobj* into the spool.
+        
+        The message is synced to disk before it becomes visible in ``new/``.
+        
+        :param fobj: A file-like object providing the message.
+        :returns: The name of the spooled message.
+        """
+        name = self._name()
+        path = os.path.join(self.path, 'tmp', name)
+        head = ''
+        
+        if self._compress:
+            head = fobj.read(self._compress + 1)
+        
+        raw = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666), 'wb')
+        try:
+            out = raw
+            if len(head) > self._compress:
+                name += Spool.COMPRESS_SUFFIX
+                out   = gzip.GzipFile(name, 'wb', Spool.COMPRESS_LEVEL, raw)
+            
+            out.write(head)
+            for chunk in iter(lambda: fobj.read(Spool.COPY_CHUNK), ''):
+                out.write(chunk)
+            
+            if out is not raw:
+                out.close()
+            
+            raw.flush()
+            os.fsync(raw.fileno())
+            raw.close()
+            
+            os.rename(path, os.path.join(self.path, 'new', name))
+        except:
+            raw.close()
+            os.unlink(path)
+            raise
+        
+        self._sync('new')
+        return name
+    
+    def claim(self, count):
+        """
+        Claim up to *count* of the oldest messages in ``new/``.
+        
+        :param count: Maximum number of messages to claim.
+        :returns: List of message names.
+        """
+        claimed = []
+        
+        for name in sorted(os.listdir(os.path.join(self.path, 'new'))):
+            if len(claimed) >= count:
+                break
+            
+            path = os.path.join(self.path, 'cur', name)
+            try:
+                os.rename(os.path.join(self.path, 'new', name), path)
+                os.utime(path, None)
+            except OSError, e:
+                # claimed by another drainer
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            
+            claimed.append(name)
+        
+        if claimed:
+            self._sync('new', 'cur')
+        
+        return claimed
+    
+    def open(self, name):
+        """
+        Open the claimed message *name* for reading.
+        
+        :param name: The message name.
+        :returns: A file-like object providing the (uncompressed) message.
+        """
+        path = os.path.join(self.path, 'cur', name)
+        
+        if name.endswith(Spool.COMPRESS_SUFFIX):
+            return gzip.open(path, 'rb')
+        
+        return open(path, 'rb')
+    
+    def done(self, name):
+        """
+        Remove the claimed message *name* after it was delivered.
+        """
+        os.unlink(os.path.join(self.path, 'cur', name))
+    
+    def retry(self, name):
+        """
+        Give the claimed message *name* back to ``new/``.
+        """
+        os.rename(os.path.join(self.path, 'cur', name),
+                  os.path.join(self.path, 'new', name))
+        self._sync('cur', 'new')
+    
+    def fail(self, name):
+        """
+        Move the claimed message *name* to ``failed/``.
+        """
+        os.rename(os.path.join(self.path, 'cur', name),
+                  os.path.join(self.path, 'failed', name))
+        self._sync('cur', 'failed')
+    
+    def recover(self, stale=None):
+        """
+        Give messages claimed more than *stale* seconds ago back to ``new/``
+        (their drainer probably died).
+        
+        :param stale: Age in seconds (defaults to :attr:`Spool.STALE`).
+        :returns: List of recovered message names.
+        """
+        if stale is None:
+            stale = Spool.STALE
+        
+        limit     = time.time() - stale
+        recovered = []
+        
+        for name in os.listdir(os.path.join(self.path, 'cur')):
+            try:
+                if os.stat(os.path.join(self.path, 'cur', name)).st_mtime < limit:
+                    self.retry(name)
+                    recovered.append(name)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        
+        return recovered
+    
+    def age(self, name):
+        """
+        Return the number of seconds since the message *name* was spooled.
+        """
+        return time.time() - float(name.split('.P', 1)[0])
+    
+    def _sync(self, *names):
+        """
+        Sync the spool directories *names* to disk (renames are directory updates).
+        """
+        for name in names:
+            fd = os.open(os.path.join(self.path, name), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    
+    def _name(self):
+        Spool._counter += 1
+        return '{0:.6f}.P{1}Q{2}.{3}'.format(time.time(), os.getpid(), Spool._counter,
+                                             socket.gethostname().replace('/', '\\057').replace(':', '\\072'))
@@ -0,0 +1,197 @@
+# encoding: utf-8
+#
+#  benchmark.py 
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Created by René Köcher on 2010-04-03.
+#
+
+"""
+Micro benchmarks for the reactor hot paths.
+
+These are not part of the test suite, run them with::
+
+    python -m tests.benchmark
+
+Every benchmark prints the time per unit for growing input sizes,
+the numbers should stay roughly constant.
+"""
+
+import os, sys, timeit
+import email
+import synfu.config
+
+from tests.reactor import ReactorBase
+
+FOOTER = [
+    '_______________________________________________',
+    'Test mailing list',
+    'test@lists.piratenpartei.de',
+    'https://service.piratenpartei.de/mailman/listinfo/test',
+]
+
+def _body(lines, separators):
+    """
+    Create a message body with *lines* lines, every *separators*-th line
+    being a separator (0 = none), followed by a mailman footer.
+    """
+    body = []
+    for i in xrange(lines):
+        if separators and i % separators == 0:
+            body.append('-' * 30)
+        else:
+            body.append('> quoted text line {0} of a rather long digest'.format(i))
+    
+    return '\n'.join(body + FOOTER) + '\n'
+
+def _report(what, unit, results):
+    sys.stdout.write('{0}\n'.format(what))
+    for (size, elapsed) in results:
+        sys.stdout.write('  {0:>8} {1}: {2:10.3f} ms total, {3:8.3f} us/{1}\n'.format(
+                         size, unit, elapsed * 1e3, elapsed * 1e6 / size))
+
+def _time(func, repeat=3):
+    return min(timeit.Timer(func).repeat(repeat, 1))
+
+def bench_mutate_part(reactor):
+    for separators in (0, 10, 2, 1):
+        results = []
+        for lines in (1000, 10000, 100000):
+            body = _body(lines, separators)
+            results.append((lines, _time(lambda: reactor._mutate_part(body))))
+        
+        _report('_mutate_part (complex_footer, separator every {0} lines)'.format(
+                separators or 'no'), 'line', results)
+
+def bench_find_footer(reactor):
+    signature = reactor.MAILMAN_COMPLEX[0]
+    
+    for full_scan in (False, True):
+        reactor._conf.footer_full_scan = full_scan
+        results = []
+        
+        for size in (10000, 100000, 1000000):
+            # long lines make the signature pattern backtrack
+            line = 'http://example.org/ ' * 50 + '\n'
+            body = line * (size / len(line)) + _body(10, 0)
+            results.append((len(body) / 1000, _time(lambda: reactor._find_footer(body, signature))))
+        
+        _report('_find_footer (footer_full_scan: {0})'.format(full_scan and 'yes' or 'no'), 'kB', results)
+    
+    reactor._conf.footer_full_scan = False
+
+def _headers(count):
+    """
+    Create a header list with *count* headers, mostly ones to be removed.
+    """
+    headers = [('Subject', '[Test] benchmark'), ('Message-ID', '<1@example.org>')]
+    for i in xrange(count - len(headers)):
+        if i % 3 == 0:
+            headers.append(('Received', 'from host{0}.example.org by mx.example.org'.format(i)))
+        elif i % 3 == 1:
+            headers.append(('X-Spam-Score', '0.{0}'.format(i)))
+        else:
+            headers.append(('Comments', 'kept header {0}'.format(i)))
+    
+    return headers
+
+def bench_filter_headers(reactor):
+    tag = reactor._find_list_tag(email.message_from_string('List-Id: <test.lists.example.org>\n\n'))
+    
+    results = []
+    for count in (10, 100, 1000):
+        headers = _headers(count)
+        results.append((count, _time(lambda: reactor._filter_headers(tag, headers[:], True, True))))
+    
+    _report('_filter_headers', 'header', results)
+
+def bench_filter_subject(reactor):
+    tag = reactor._find_list_tag(email.message_from_string('List-Id: <test.lists.example.org>\n\n'))
+    
+    for subject in ('Re: plain ascii reply', 'AW: [Test] outlook reply', '=?utf-8?q?=5BTest=5D_=C3=A4?='):
+        results = []
+        for count in (10, 100, 1000):
+            headers = [('Subject', subject)] * count
+            results.append((count, _time(lambda: reactor._filter_headers(tag, headers[:], True, True))))
+        
+        _report('_filter_headers (Subject: {0})'.format(subject), 'header', results)
+
+def _postfilter(count):
+    conf = synfu.config._PostfilterConfig()
+    conf.filters = []
+    for i in xrange(count):
+        conf.filters.append({
+            'nntp': 'example.list{0}'.format(i),
+            'smtp': '.*list{0}.lists.example.org'.format(i)
+        })
+    
+    return conf.configure()
+
+def bench_route_filters(reactor):
+    values = ['Test list <list7.lists.example.org>', 'list7@lists.example.org', 'user@example.org']
+    
+    for count in (10, 100, 1000):
+        index   = _postfilter(count).filter_index
+        results = [(1000, _time(lambda: [index.lookup(values) for i in xrange(1000)]))]
+        
+        _report('_FilterIndex.lookup ({0} filters)'.format(count), 'lookup', results)
+
+class _Discard(object):
+    def write(self, data):
+        pass
+
+def bench_write_message(reactor):
+    from synfu.postfilter import PostFilter
+    
+    postfilter = PostFilter()
+    headers    = ''.join('{0}: {1}\n'.format(k, v) for (k, v) in _headers(20))
+    
+    for lines in (100, 1000, 10000):
+        data = headers + '\n' + _body(lines, 0)
+        postfilter._data = data
+        
+        def write():
+            mm = postfilter._parse_headers(data)
+            mm._headers.append(('X-SynFU-Tags', 'test'))
+            postfilter._write_message(mm, None, _Discard(), close=False)
+        
+        results = [(100, _time(lambda: [write() for i in xrange(100)]))]
+        _report('_write_message ({0} kB body)'.format(len(data) / 1000), 'message', results)
+
+def main():
+    data_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data')
+    cfg       = synfu.config.Config.get(os.path.join(data_path, 'synfu.conf'))
+    reactor   = ReactorBase(cfg)
+    
+    bench_mutate_part(reactor)
+    bench_find_footer(reactor)
+    bench_filter_headers(reactor)
+    bench_filter_subject(reactor)
+    bench_route_filters(reactor)
+    bench_write_message(reactor)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# encoding: utf-8
+#
+#  blacklist.py 
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys, os, time, shutil, tempfile, unittest
+import synfu.blacklist
+
+class BlacklistSuite(unittest.TestCase):
+    def setUp(self):
+        self._path     = tempfile.mkdtemp()
+        self._filename = os.path.join(self._path, 'blacklist')
+        
+        self._write('foo@example.org;d\nbar@example.org;ne;7\ninvalid;x\n')
+    
+    def tearDown(self):
+        shutil.rmtree(self._path)
+    
+    def _write(self, data):
+        blacklist_file = open(self._filename, 'w')
+        blacklist_file.write(data)
+        blacklist_file.close()
+    
+    def test_00_lookup(self):
+        blacklist = synfu.blacklist.Blacklist(self._filename)
+        
+        self.assertTrue(os.path.exists(self._filename + '.cdb'), 'Blacklist index was not written.')
+        self.assertEqual({'addr': 'foo@example.org', 'action': 'd', 'param': None},
+                         blacklist.get('foo@example.org'))
+        self.assertEqual({'addr': 'bar@example.org', 'action': 'ne', 'param': '7'},
+                         blacklist.get('bar@example.org'))
+        self.assertEqual(None, blacklist.get('invalid'))
+        self.assertEqual(None, blacklist.get(synfu.blacklist.Blacklist.SOURCE_KEY))
+    
+    def test_01_rebuild(self):
+        synfu.blacklist.Blacklist(self._filename)
+        
+        self._write('baz@example.org;n\n')
+        os.utime(self._filename, (time.time() + 10, time.time() + 10))
+        
+        blacklist = synfu.blacklist.Blacklist(self._filename)
+        self.assertEqual(None, blacklist.get('foo@example.org'))
+        self.assertEqual('n', blacklist.get('baz@example.org')['action'])
+    
+    def test_02_wildcards(self):
+        self._write('foo@spam.example;n\n*@spam.example;d\n*.example;e;3\n*.Spam.Example.;ne;1\n*@;d\n')
+        blacklist = synfu.blacklist.Blacklist(self._filename)
+        
+        self.assertEqual('n' , blacklist.match('foo@spam.example')['action'])
+        self.assertEqual('d' , blacklist.match('bar@spam.example')['action'])
+        self.assertEqual('ne', blacklist.match('bar@a.spam.example')['action'])
+        self.assertEqual('e' , blacklist.match('bar@other.example')['action'])
+        self.assertEqual(None, blacklist.match('bar@example'))
+        self.assertEqual('n' , blacklist.match('bar@other.example', 'foo@spam.example')['action'])
+        
+        # domain rules of all addresses come first
+        self.assertEqual('d' , blacklist.match('bar@a.other.example', 'bar@spam.example')['action'])
+    
+    def test_03_reload(self):
+        blacklist = synfu.blacklist.Blacklist(self._filename, interval=0.01)
+        
+        self._write('baz@example.org;n\n')
+        os.utime(self._filename, (time.time() + 10, time.time() + 10))
+        time.sleep(0.02)
+        
+        # the first lookup after interval starts the reload
+        blacklist.match('foo@example.org')
+        
+        for i in xrange(500):
+            if blacklist.get('baz@example.org'):
+                break
+            time.sleep(0.01)
+        
+        self.assertEqual('n', blacklist.match('baz@example.org')['action'])
+        self.assertEqual(None, blacklist.match('foo@example.org'))
+    
+    def test_04_fork(self):
+        blacklist = synfu.blacklist.Blacklist(self._filename, interval=0.01)
+        
+        self._write('baz@example.org;n\n')
+        os.utime(self._filename, (time.time() + 10, time.time() + 10))
+        time.sleep(0.02)
+        
+        # a reload started by the parent before the worker was forked
+        blacklist._loader = object()
+        blacklist._owner  = os.getpid() + 1
+        
+        self.assertTrue(blacklist.check())
+        
+        for i in xrange(500):
+            if blacklist.get('baz@example.org'):
+                break
+            time.sleep(0.01)
+        
+        self.assertEqual('n', blacklist.match('baz@example.org')['action'])
@@ -29,7 +29,7 @@
 # Created by René Köcher on 2010-04-03.
 #
 
-import sys, os, unittest
+import sys, os, optparse, unittest
 import synfu.config
 
 class ConfigSuite(unittest.TestCase):
@@ -48,3 +48,49 @@ class ConfigSuite(unittest.TestCase):
             self.assertRaises(RuntimeError, synfu.config.Config, path, {})
             
         sys.stderr.write('\n -- ')
+    
+    def test_01_filter_index(self):
+        conf = synfu.config._PostfilterConfig()
+        conf.filters = [
+            {'nntp': 'pirates.de.test' , 'smtp': '.*test.lists@piratenpartei.de'},
+            {'nntp': 'pirates.de.test2', 'smtp': 'test.lists.piratenpartei.de'},
+            {'nntp': 'pirates.de.nds'  , 'smtp': '.*aktive-nds.lists.piraten-nds.de'},
+            {'nntp': 'pirates.de.any'  , 'smtp': '^(test|foo)'},
+            {'nntp': 'pirates.de.re'   , 'smtp': 'piraten[a-z]+\\.de>'},
+            {'nntp': 'pirates.de.bad'  , 'smtp': 'broken['},
+        ]
+        sys.stderr.write('\n    ')
+        conf.configure()
+        
+        for values in (['Test list <test.lists.piratenpartei.de>'],
+                       ['Other <other.lists.piratenpartei.de>', 'TEST.Lists@piratenpartei.de'],
+                       ['Foo list <foo.lists.piraten-nds.de>', 'aktive-nds@lists.piraten-nds.de'],
+                       ['<nothing.example.org>', 'user@example.org']):
+            sys.stderr.write('\n    {0}..'.format(values[0]))
+            
+            expect = [e['nntp'] for e in conf.filters
+                      if 'exp' in e and [v for v in values if e['exp'].search(v)]]
+            result = [e['nntp'] for e in conf.filter_index.lookup(values)
+                      if [v for v in values if e['exp'].search(v)]]
+            
+            self.assertEqual(expect, result)
+        
+        sys.stderr.write('\n -- ')
+    
+    def test_02_add_option(self):
+        add = synfu.config.Config.add_option
+        
+        add('-Y', '--synfu-suite', dest='synfu_suite', action='store', type='int', default=None)
+        
+        # shared by several tools
+        add('-Y', '--synfu-suite', dest='synfu_suite', action='store', type='int', default=1)
+        
+        # anything else is a conflict
+        self.assertRaises(optparse.OptionConflictError, add, '-Y', '--synfu-suite',
+                          dest='synfu_other', action='store')
+        self.assertRaises(optparse.OptionConflictError, add, '-Y', '--synfu-suite',
+                          dest='synfu_suite', action='store_true')
+        self.assertRaises(optparse.OptionConflictError, add, '-Y', '--synfu-suite-other',
+                          dest='synfu_suite', action='store')
+        self.assertRaises(optparse.OptionConflictError, add, '--synfu-suite', '-c',
+                          dest='synfu_suite', action='store')
@@ -29,7 +29,7 @@
 # Created by René Köcher on 2010-04-03.
 #
 
-import sys, os, re, unittest
+import sys, os, re, logging, threading, unittest
 import email, email.message, json
 import synfu.config, synfu.fucore
 
@@ -37,7 +37,7 @@ from contextlib import nested
 
 class FUCoreBase(synfu.fucore.FUCore):
     def __init__ (self, conf):
-        super(FUCoreBase, self).__init__()
+        super(FUCoreBase, self).__init__(conf.reactor)
         self._conf = conf.reactor
 
     def __del__(self):
@@ -143,3 +143,128 @@ class FUCoreSuite(unittest.TestCase):
     
         sys.stderr.write('\n -- ')
 
+    
+    def test_03_list_tag_cache(self):
+        msg = email.message_from_string('X-SynFU-Tags: c++, (neu\n\nbody\n')
+        
+        tag = self._fucore._find_list_tag(msg)
+        self.assertTrue(tag.search('Subject: [c++] hello'))
+        self.assertTrue(tag.search('Subject: [(neu] hello'))
+        self.assertFalse(tag.search('Subject: [cc] hello'))
+        
+        self.assertEqual('(c++|(neu)', self._fucore._find_list_tag(msg, plain=True))
+        self.assertTrue(tag is self._fucore._find_list_tag(msg), 'List-Tag pattern was not cached.')
+    
+    def test_04_header_fixers(self):
+        class FUCoreFixer(FUCoreBase):
+            pass
+        
+        FUCoreFixer.register_header_fixer('Organization', lambda core, k, v, tag, rec: [(k, v.upper())])
+        fucore  = FUCoreFixer(self._cfg)
+        tag     = fucore._find_list_tag(email.message_from_string('\n'))
+        headers = [('Organization', 'synfu'), ('Subject', 'test')]
+        
+        self.assertEqual([('Subject', 'test'), ('Organization', 'SYNFU')],
+                         fucore._filter_headers(tag, headers[:]))
+        self.assertEqual(headers, self._fucore._filter_headers(tag, headers[:]))
+    
+    def test_05_sample_log(self):
+        log_sample = self._fucore._conf.log_sample
+        try:
+            self._fucore._conf.log_sample = {'reactor': 1, 'mail2news': 1e9}
+            
+            self.assertTrue(self._fucore._sample_log('reactor'))
+            self.assertTrue(self._fucore._sample_log('news2mail'))
+            self.assertFalse(self._fucore._sample_log('mail2news'))
+        finally:
+            self._fucore._conf.log_sample = log_sample
+            self._fucore._log_debug = True
+    
+    def test_06_queue_handler(self):
+        class Target(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.name     = 'target'
+                self.messages = []
+                self.started  = threading.Event()
+                self.proceed  = threading.Event()
+                self.proceed.set()
+            
+            def emit(self, record):
+                self.started.set()
+                self.proceed.wait(5)
+                self.messages.append(record.getMessage())
+        
+        def record(num):
+            return logging.LogRecord('test', logging.INFO, __file__, 0, 'record {0}'.format(num), None, None)
+        
+        # records are written in order, flush() waits for them
+        target  = Target()
+        handler = synfu.fucore._QueueHandler(target, 100)
+        try:
+            for num in xrange(10):
+                handler.emit(record(num))
+            
+            handler.flush()
+            self.assertEqual(['record {0}'.format(num) for num in xrange(10)], target.messages)
+        finally:
+            handler.close()
+        
+        # records not fitting into the queue are dropped and counted
+        target  = Target()
+        target.proceed.clear()
+        handler = synfu.fucore._QueueHandler(target, 2)
+        try:
+            handler.emit(record(0))
+            self.assertTrue(target.started.wait(5))
+            
+            # record 0 is being written, 1 and 2 fill the queue
+            for num in xrange(1, 5):
+                handler.emit(record(num))
+            
+            self.assertEqual(2, handler.dropped)
+        finally:
+            target.proceed.set()
+            handler.close()
+        
+        # close() writes the queued records and stops the thread
+        self.assertFalse(handler._thread.isAlive())
+        self.assertEqual(['record 0', '!!! 2 log messages dropped', 'record 1', 'record 2'], target.messages)
+    
+    def test_07_log_max_arg(self):
+        class Logger(object):
+            def __init__(self):
+                self.messages = []
+            
+            def info(self, message):
+                self.messages.append(message)
+        
+        conf   = self._fucore._conf
+        logger = self._fucore._logger
+        saved  = (conf.verbose, conf.log_max_arg)
+        value  = u'Gr\xfc\xdfe aus M\xfcnchen, ' * 4
+        
+        (conf.verbose, conf.log_max_arg) = (True, 20)
+        try:
+            self._fucore._logger = Logger()
+            self._fucore._log(u'--- scan: "{0}" ({1})', value, 'short')
+            
+            # cut after 20 bytes of UTF-8
+            encoded = value.encode('UTF-8')
+            self.assertEqual(['--- scan: "{0}... [{1} bytes]" (short)'.format(encoded[:20], len(encoded))],
+                             self._fucore._logger.messages)
+        finally:
+            (conf.verbose, conf.log_max_arg) = saved
+            self._fucore._logger = logger
+    
+    def test_08_fixed_date(self):
+        tag     = self._fucore._find_list_tag(email.message_from_string('\n'))
+        headers = [('Subject', 'test'),
+                   ('X-Date', 'Mon, 5 Apr 2010 12:00:00 +0200 (Mitteleurop\xe4ische Sommerzeit)')]
+        
+        # the repaired X-Date is kept as Date
+        res = self._fucore._filter_headers(tag, headers[:], fix_dateline=True)
+        self.assertEqual(['Subject', 'Date'], [k for (k, v) in res])
+        self.assertEqual('Mon, 5 Apr 2010 12:00:00 +0200 (EET)', str(res[1][1]))
+        
+        self.assertEqual([('Subject', 'test')], self._fucore._filter_headers(tag, headers[:]))
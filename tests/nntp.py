@@ -0,0 +1,185 @@
+# encoding: utf-8
+#
+#  nntp.py 
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys, os, threading, unittest, SocketServer
+import synfu.nntp
+
+class _StandInHandler(SocketServer.StreamRequestHandler):
+    """
+    Just enough of innd to accept POST, IHAVE and CHECK / TAKETHIS.
+    """
+    
+    def handle(self):
+        self.server.clients.append(self.connection)
+        self._reply('200 stand-in server ready')
+        
+        for line in iter(self.rfile.readline, ''):
+            args    = line.rstrip('\r\n').split()
+            command = ' '.join(args[:1]).upper()
+            msgid   = ' '.join(args[1:2])
+            
+            if command == 'QUIT':
+                self._reply('205 bye')
+                return
+            
+            elif command == 'MODE' and msgid.upper() == 'STREAM' and self.server.streaming:
+                self._reply('203 streaming ok')
+            
+            elif command == 'POST':
+                self._reply('340 send article')
+                article = self._article()
+                msgid   = [l.split(':', 1)[1].strip() for l in article.splitlines()
+                           if l.lower().startswith('message-id:')]
+                if not msgid:
+                    self._reply('441 no Message-ID')
+                elif self._store(msgid[0], article):
+                    self._reply('240 ok')
+                else:
+                    self._reply('441 435 duplicate')
+            
+            elif command == 'IHAVE':
+                if msgid in self.server.articles:
+                    self._reply('435 {0}'.format(msgid))
+                else:
+                    self._reply('335 {0}'.format(msgid))
+                    self._store(msgid, self._article())
+                    self._reply('235 {0}'.format(msgid))
+            
+            elif command == 'CHECK':
+                if msgid in self.server.articles:
+                    self._reply('438 {0}'.format(msgid))
+                else:
+                    self._reply('238 {0}'.format(msgid))
+            
+            elif command == 'TAKETHIS':
+                if self._store(msgid, self._article()):
+                    self._reply('239 {0}'.format(msgid))
+                else:
+                    self._reply('439 {0}'.format(msgid))
+            
+            else:
+                self._reply('500 what?')
+    
+    def _reply(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+    
+    def _article(self):
+        lines = []
+        for line in iter(self.rfile.readline, ''):
+            if not line.endswith('\r\n'):
+                self.server.errors.append(line)
+            
+            if line == '.\r\n':
+                break
+            
+            if line.startswith('..'):
+                line = line[1:]
+            
+            lines.append(line.replace('\r\n', '\n'))
+        
+        return ''.join(lines)
+    
+    def _store(self, msgid, article):
+        if msgid in self.server.articles:
+            return False
+        
+        self.server.articles[msgid] = article
+        return True
+
+class NNTPSuite(unittest.TestCase):
+    def setUp(self):
+        self._server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), _StandInHandler)
+        self._server.daemon_threads = True
+        self._server.streaming      = True
+        self._server.articles       = {}
+        self._server.clients        = []
+        self._server.errors         = []
+        
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.setDaemon(True)
+        self._thread.start()
+        
+        self._client = synfu.nntp.NNTPClient('127.0.0.1', self._server.server_address[1],
+                                             timeout=5, pipeline=3)
+    
+    def tearDown(self):
+        self._client.close()
+        self._server.shutdown()
+        self._server.server_close()
+    
+    def _article(self, num):
+        return 'Message-ID: <{0}@synfu.suite>\nNewsgroups: pirates.de.test\n\n.\n..dots\nbody {0}\n'.format(num)
+    
+    def test_00_post(self):
+        self.assertEqual(240, self._client.post(self._article(0)))
+        self.assertEqual(435, self._client.post(self._article(0)))
+        self.assertRaises(synfu.nntp.NNTPError, self._client.post, 'Subject: no Message-ID\n\n')
+        
+        self.assertEqual(self._article(0), self._server.articles['<0@synfu.suite>'])
+        self.assertEqual([], self._server.errors)
+    
+    def test_01_ihave(self):
+        self.assertEqual(235, self._client.ihave('<1@synfu.suite>', iter(self._article(1).splitlines(True))))
+        self.assertEqual(435, self._client.ihave('<1@synfu.suite>', self._article(1)))
+        
+        self.assertEqual(self._article(1), self._server.articles['<1@synfu.suite>'])
+    
+    def test_02_stream(self):
+        self._server.articles['<3@synfu.suite>'] = self._article(3)
+        
+        for streaming in (True, False):
+            sys.stderr.write('\n    streaming: {0}..'.format(streaming))
+            
+            self._server.streaming = streaming
+            self._server.articles  = {'<3@synfu.suite>': self._article(3)}
+            self._client.close()
+            
+            results = self._client.stream(('<{0}@synfu.suite>'.format(i), self._article(i))
+                                          for i in xrange(10))
+            
+            self.assertEqual(10, len(results))
+            self.assertEqual([438], [code for (msgid, code) in results if msgid == '<3@synfu.suite>'])
+            self.assertEqual([239] * 9, [code for (msgid, code) in results if msgid != '<3@synfu.suite>'])
+            self.assertEqual(10, len(self._server.articles))
+            self.assertEqual(self._article(7), self._server.articles['<7@synfu.suite>'])
+        
+        self.assertEqual([], self._server.errors)
+        sys.stderr.write('\n -- ')
+    
+    def test_03_reconnect(self):
+        self.assertEqual(240, self._client.post(self._article(4)))
+        self.assertEqual(240, self._client.post(self._article(5)))
+        self.assertEqual(1, self._client.connects)
+        
+        # the server drops the idle connection
+        self._server.clients[-1].shutdown(2)
+        
+        self.assertEqual(240, self._client.post(self._article(6)))
+        self.assertEqual(2, self._client.connects)
@@ -0,0 +1,357 @@
+# encoding: utf-8
+#
+#  postfilter.py 
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys, os, time, shutil, tempfile, threading, unittest, SocketServer
+import email, email.generator, email.header
+import synfu.config, synfu.reactor
+
+from cStringIO import StringIO
+from synfu.nntp import NNTPClient
+from synfu.postfilter import PostFilter
+from nntp import _StandInHandler
+
+FOOTER = ('_______________________________________________\n'
+          'Test mailing list\n'
+          'test@lists.piratenpartei.de\n'
+          'https://service.piratenpartei.de/listinfo/test\n')
+
+class PostFilterSuite(unittest.TestCase):
+    def setUp(self):
+        self._data_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data')
+        
+        self._cfg        = synfu.config.Config.get(os.path.join(self._data_path, 'synfu.conf'))
+        self._postfilter = PostFilter()
+        self._settings   = {}
+    
+    def tearDown(self):
+        for (key, value) in self._settings.items():
+            setattr(self._postfilter._conf, key, value)
+    
+    def _set(self, **kwargs):
+        """
+        Change postfilter settings until the test is done.
+        """
+        for (key, value) in kwargs.items():
+            self._settings.setdefault(key, getattr(self._postfilter._conf, key))
+            setattr(self._postfilter._conf, key, value)
+    
+    def _message(self, num, body=None):
+        """
+        Create a mailing list message with a mailman footer (unless *body* is given).
+        """
+        if body is None:
+            body = 'message {0}\n\n{1}'.format(num, FOOTER)
+        
+        return ('From: User {0} <user{0}@example.org>\n'
+                'To: test@lists.piratenpartei.de\n'
+                'Subject: [Test] message {0}\n'
+                'Message-ID: <{0}@synfu.suite>\n'
+                'List-Id: Test list <test.lists.piratenpartei.de>\n'
+                'X-Mailman-Version: 2.1.9\n'
+                'Content-Type: text/plain\n'
+                '\n{1}').format(num, body)
+    
+    def _tagged(self, data):
+        """
+        Parse *data* and add X-SynFU-Tags: like :meth:`PostFilter.mail2news` does.
+        """
+        message = email.message_from_string(data)
+        message._headers.append(('X-SynFU-Tags', email.header.make_header([('test', 'utf-8')])))
+        
+        return message
+    
+    def test_00_react(self):
+        multipart = self._message(1, '--MM\nContent-Type: text/plain\n\nmessage 1\n'
+                                     '--MM\nContent-Type: text/plain\n\n' + FOOTER + '--MM--\n')
+        multipart = multipart.replace('text/plain\n\n--MM', 'multipart/mixed; boundary="MM"\n\n--MM', 1)
+        
+        messages  = [self._message(0), multipart, self._message(2, 'no footer\n'),
+                     'Control: cancel <0@synfu.suite>\n' + self._message(3)]
+        
+        # what synfu-reactor used to get piped from mail2news_cmd
+        reactor = synfu.reactor.Reactor()
+        piped   = []
+        for data in messages:
+            out = StringIO()
+            reactor._react(StringIO(str(self._tagged(data))), out)
+            piped.append(out.getvalue())
+        
+        for (data, expected) in zip(messages, piped):
+            out = StringIO()
+            self._postfilter._react(self._tagged(data), None, out, close=False)
+            
+            self.assertEqual(expected, out.getvalue())
+        
+        self.assertFalse(FOOTER in ''.join(piped))
+        self.assertEqual('', piped[3])
+    
+    def test_01_drain_stream(self):
+        server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), _StandInHandler)
+        server.daemon_threads = True
+        server.streaming      = True
+        server.articles       = {'<1@synfu.suite>': 'already there\n'}
+        server.clients        = []
+        server.errors         = []
+        
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.setDaemon(True)
+        thread.start()
+        
+        path    = tempfile.mkdtemp()
+        batches = []
+        stream  = NNTPClient.stream
+        
+        def record(client, articles):
+            batches.append(len(articles))
+            return stream(client, articles)
+        
+        try:
+            NNTPClient.stream = record
+            self._set(mail2news_transport='stream', mail2news_spool=path, mail2news_reactor=False,
+                      nntp_host='127.0.0.1', nntp_port=server.server_address[1])
+            
+            for num in xrange(4):
+                data = self._message(num).replace('<test.lists.piratenpartei.de>',
+                                                  '<meunchen.lists.piratenpartei-bayern.de>')
+                self.assertEqual(0, self._postfilter.mail2news(StringIO(data)))
+            
+            # no List-Id, failed before it is streamed
+            self.assertEqual(0, self._postfilter.mail2news(StringIO('Subject: lost\n\nbody\n')))
+            
+            self.assertEqual(1, self._postfilter.drain(workers=1, once=True))
+            
+            # all articles of the batch in one go, <1@synfu.suite> was a duplicate
+            self.assertEqual([4], batches)
+            self.assertEqual('already there\n', server.articles['<1@synfu.suite>'])
+            self.assertEqual(4, len(server.articles))
+            self.assertTrue('Newsgroups: pirates.de.region.oberbayern.muenchen\n' in server.articles['<2@synfu.suite>'])
+            self.assertTrue(server.articles['<3@synfu.suite>'].endswith('\nmessage 3\n\n' + FOOTER))
+            
+            self.assertEqual([], server.errors)
+            self.assertEqual([], os.listdir(os.path.join(path, 'new')))
+            self.assertEqual([], os.listdir(os.path.join(path, 'cur')))
+            self.assertEqual(1, len(os.listdir(os.path.join(path, 'failed'))))
+        finally:
+            NNTPClient.stream = stream
+            NNTPClient.close_all()
+            self._postfilter._queue = None
+            
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(path)
+    
+    def test_02_drain(self):
+        lists = {'done': '<meunchen.lists.piratenpartei-bayern.de>',
+                 'retry': '<aktive-nds.lists.piraten-nds.de>',
+                 'failed': '<nds-osnabrueck.lists.piratenpartei.de>'}
+        
+        for workers in (1, 2):
+            sys.stderr.write('\n    workers: {0}..'.format(workers))
+            
+            path = tempfile.mkdtemp()
+            out  = tempfile.mkdtemp()
+            try:
+                self._set(mail2news_transport='cmd', mail2news_spool=os.path.join(path, 'spool'),
+                          mail2news_reactor=False, spool_max_age=86400, spool_stale=1800,
+                          mail2news_cmd='case "{0[NNTP_ID]}" in '
+                                        '*.muenchen) cat > ' + out + '/$$ ;; '
+                                        '*.misc) cat > /dev/null; exit 75 ;; '
+                                        '*) cat > /dev/null; exit 1 ;; esac')
+                
+                self._postfilter._queue = None
+                queue = self._postfilter._mail_spool()
+                names = {}
+                
+                for (num, (key, lid)) in enumerate(sorted(lists.items()) * 2):
+                    data = self._message(num).replace('<test.lists.piratenpartei.de>', lid)
+                    names.setdefault(key, []).append(queue.put(StringIO(data)))
+                
+                # spooled a long time ago
+                expired = '1000000000.000000.P1Q1.synfu'
+                os.rename(os.path.join(queue.path, 'new', names['retry'][1]),
+                          os.path.join(queue.path, 'new', expired))
+                
+                # claimed by a drainer which died
+                stale = os.path.join(queue.path, 'cur', names['done'][1])
+                os.rename(os.path.join(queue.path, 'new', names['done'][1]), stale)
+                os.utime(stale, (time.time() - 2400, time.time() - 2400))
+                
+                # claimed by a drainer which is still busy
+                live = queue.put(StringIO(self._message(9).replace('<test.lists.piratenpartei.de>',
+                                                                   lists['done'])))
+                os.rename(os.path.join(queue.path, 'new', live), os.path.join(queue.path, 'cur', live))
+                os.utime(os.path.join(queue.path, 'cur', live), (time.time() - 600, time.time() - 600))
+                
+                self.assertEqual(1, self._postfilter.drain(workers=workers, once=True))
+                
+                self.assertEqual(names['retry'][:1], os.listdir(os.path.join(queue.path, 'new')))
+                self.assertEqual([live], os.listdir(os.path.join(queue.path, 'cur')))
+                self.assertEqual(sorted(names['failed'] + [expired]),
+                                 sorted(os.listdir(os.path.join(queue.path, 'failed'))))
+                
+                delivered = []
+                for name in os.listdir(out):
+                    fobj = open(os.path.join(out, name))
+                    delivered.append(email.message_from_file(fobj)['List-Id'])
+                    fobj.close()
+                
+                self.assertEqual(['Test list ' + lists['done']] * 2, delivered)
+            finally:
+                self._postfilter._queue = None
+                
+                shutil.rmtree(path)
+                shutil.rmtree(out)
+        
+        sys.stderr.write('\n -- ')
+    
+    def test_03_split_headers(self):
+        data = ('From user0@example.org Mon Apr  5 12:00:00 2010\n'
+                'Subject: folded\r\n'
+                '  subject\r\n'
+                'To: test@lists.piratenpartei.de\n'
+                '\r\n'
+                'body\r\n')
+        
+        (unixfrom, fields, end) = self._postfilter._split_headers(data)
+        
+        self.assertEqual('From user0@example.org Mon Apr  5 12:00:00 2010\n', unixfrom)
+        self.assertEqual(['Subject: folded\n  subject\n', 'To: test@lists.piratenpartei.de\n'], fields)
+        self.assertEqual('body\r\n', data[end:])
+        
+        self.assertEqual((None, ['Subject: x\n'], 12), self._postfilter._split_headers('Subject: x\n\n'))
+        
+        # not a header field, no end of the header block
+        self.assertEqual(None, self._postfilter._split_headers('Subject: x\nnot a header\n\nbody\n'))
+        self.assertEqual(None, self._postfilter._split_headers(' folded: x\n\nbody\n'))
+        self.assertEqual(None, self._postfilter._split_headers('Subject: x\n'))
+    
+    def test_04_write_message(self):
+        body = 'message 0\r\n\r\n  unchanged  \n\tbody\n'
+        data = ('Subject:   [Test]  message 0\n'
+                'X-Folded: one,\n'
+                '\ttwo\n'
+                'Message-ID: <0@synfu.suite>\n'
+                'List-Id: Test list <test.lists.piratenpartei.de>\n'
+                'Received: from somewhere\n'
+                '\n') + body
+        
+        self._postfilter._data = data
+        
+        mm = self._postfilter._parse_headers(data)
+        mm.replace_header('Subject', 'message 0')
+        mm['X-SynFU-Tags'] = 'test'
+        del mm['Received']
+        
+        out = StringIO()
+        self._postfilter._write_message(mm, None, out, close=False)
+        
+        (unixfrom, message) = out.getvalue().split('\n', 1)
+        
+        # modified headers keep their position, new ones are added last
+        self.assertTrue(unixfrom.startswith('From nobody '))
+        self.assertEqual('Subject: message 0\n'
+                         'X-Folded: one,\n'
+                         '\ttwo\n'
+                         'Message-ID: <0@synfu.suite>\n'
+                         'List-Id: Test list <test.lists.piratenpartei.de>\n'
+                         'X-SynFU-Tags: test\n'
+                         '\n' + body, message)
+        
+        # CRLF headers are written with plain newlines, the body is left alone
+        data = data.replace('\n', '\r\n')
+        
+        self._postfilter._data = data
+        
+        mm  = self._postfilter._parse_headers(data)
+        out = StringIO()
+        self._postfilter._write_message(mm, None, out, close=False)
+        
+        (head, body) = data.split('\r\n\r\n', 1)
+        self.assertEqual(head.replace('\r\n', '\n') + '\n\n' + body, out.getvalue().split('\n', 1)[1])
+    
+    def test_05_write_fallback(self):
+        data = 'Subject: message 0\nnot a header\n\nbody\n'
+        
+        self._postfilter._data = data
+        self.assertEqual(None, self._postfilter._parse_headers(data))
+        
+        # generated from scratch like before
+        mm = email.message_from_string(data)
+        mm['X-SynFU-Tags'] = 'test'
+        
+        out = StringIO()
+        self._postfilter._write_message(mm, None, out, close=False)
+        
+        expected = StringIO()
+        email.generator.Generator(expected).flatten(mm, unixfrom=True)
+        
+        self.assertEqual(expected.getvalue(), out.getvalue())
+        self.assertTrue('X-SynFU-Tags: test\n' in out.getvalue())
+    
+    def test_06_spill(self):
+        path = tempfile.mkdtemp()
+        data = self._message(0, 'line\r\n' * 200 + '\n' + FOOTER).replace(
+            '<test.lists.piratenpartei.de>', '<meunchen.lists.piratenpartei-bayern.de>')
+        
+        def deliver(name):
+            self.assertEqual(0, self._postfilter.mail2news(StringIO(data)))
+            
+            with open(os.path.join(path, name)) as fobj:
+                result = fobj.read()
+            
+            # the generated From_ line depends on the time
+            if result.startswith('From nobody '):
+                result = result.split('\n', 1)[1]
+            
+            return result
+        
+        try:
+            self._set(mail2news_transport='cmd', mail2news_spool=None,
+                      mail2news_cmd='cat > ' + path + '/$OUT')
+            
+            for reactor in (False, True):
+                sys.stderr.write('\n    mail2news_reactor: {0}..'.format(reactor))
+                
+                self._set(mail2news_reactor=reactor, spill_threshold=0)
+                os.environ['OUT'] = 'memory'
+                expected = deliver('memory')
+                
+                # only the headers are parsed, the body is passed on as is
+                self._set(spill_threshold=256)
+                os.environ['OUT'] = 'spilled'
+                self.assertEqual(expected, deliver('spilled'))
+                
+                # the reactor writes plain newlines
+                self.assertEqual(200, expected.count(reactor and 'line\n' or 'line\r\n'))
+                self.assertEqual(reactor, FOOTER not in expected)
+        finally:
+            del os.environ['OUT']
+            shutil.rmtree(path)
+        
+        sys.stderr.write('\n -- ')
@@ -0,0 +1,481 @@
+# encoding: utf-8
+#
+#  reactor.py 
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Created by René Köcher on 2010-04-03.
+#
+
+import sys, os, glob, time, shutil, signal, socket, mailbox, tempfile, unittest
+import email
+import synfu.config, synfu.fucore, synfu.reactor
+
+from cStringIO import StringIO
+
+class ReactorBase(synfu.reactor.Reactor):
+    def __init__ (self, conf):
+        # skip Reactor.__init__, the command line options are not needed here
+        synfu.fucore.FUCore.__init__(self, conf.reactor)
+        self._conf    = conf.reactor
+        self._skipped = [0, 0]
+        self._footers = None
+        
+        # normally added by Reactor.__init__
+        for (name, value) in (('filter_only', False), ('header_whitelist', [])):
+            if not hasattr(conf.options, name):
+                setattr(conf.options, name, value)
+
+    def __del__(self):
+        # supress syslog.closelog() message
+        pass
+
+class ReactorSuite(unittest.TestCase):
+    def setUp(self):
+        self._data_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'data')
+        
+        self._cfg = synfu.config.Config.get(os.path.join(self._data_path, 'synfu.conf'))
+        
+        #
+        # prepare sample bodies for _mutate_part()
+        #
+        self._bodies = []
+        
+        for path in sorted(glob.glob(os.path.join(self._data_path, 'reactor_00_mutate_part_*.txt'))):
+            with open(path, 'r') as body:
+                with open(path[:-4] + '.exp', 'r') as exp:
+                    self._bodies.append((os.path.basename(path), body.read(), exp.read()))
+        
+        self._reactor = ReactorBase(self._cfg)
+    
+    def _message(self, num, body=None):
+        """
+        Create a mailing list message with a mailman footer (unless *body* is given).
+        """
+        if body is None:
+            body = self._bodies[0][1]
+        
+        return ('From: User {0} <user{0}@example.org>\n'
+                'To: test@lists.piratenpartei.de\n'
+                'Subject: [Test] message {0}\n'
+                'Message-ID: <{0}@synfu.suite>\n'
+                'List-Id: Test list <test.lists.piratenpartei.de>\n'
+                'X-Mailman-Version: 2.1.9\n'
+                'Content-Type: text/plain\n'
+                '\n{1}').format(num, body)
+    
+    def _react(self, data):
+        """
+        Return the output of :meth:`Reactor._react` for *data* (:const:`None` if dropped).
+        """
+        out = StringIO()
+        if not self._reactor._react(StringIO(data), out):
+            return None
+        
+        return out.getvalue()
+    
+    def test_00_mutate_part(self):
+        self.assertTrue(self._cfg.reactor.complex_footer)
+        
+        for (what, body, exp) in self._bodies:
+            sys.stderr.write('\n    {0}..'.format(what))
+            
+            self.assertEqual((body != exp, exp), self._reactor._mutate_part(body))
+        
+        sys.stderr.write('\n -- ')
+    
+    def test_01_find_footer(self):
+        footer    = self._bodies[0][1]
+        signature = synfu.reactor.Reactor.MAILMAN_COMPLEX[0]
+        window    = self._cfg.reactor.footer_window
+        
+        self.assertEqual(0, self._reactor._find_footer(footer, signature))
+        
+        # footer inside the window, scan starts at the first complete line
+        body  = 'x' * 80 + '\n'
+        body  = body * (window / len(body) + 1) + footer
+        start = self._reactor._find_footer(body, signature)
+        
+        self.assertTrue(len(body) - window <= start < len(body) - len(footer) + 1)
+        self.assertEqual('\n', body[start - 1])
+        self.assertEqual(self._reactor._mutate_part(body), self._reactor._mutate_part(body, start=start))
+        
+        # footer outside the window
+        body = footer + 'x' * window
+        
+        self.assertEqual(-1, self._reactor._find_footer(body, signature))
+        
+        self._cfg.reactor.footer_full_scan = True
+        try:
+            self.assertEqual(0, self._reactor._find_footer(body, signature))
+        finally:
+            self._cfg.reactor.footer_full_scan = False
+    
+    def test_02_footer_cache(self):
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(path)
+        
+        try:
+            body   = self._bodies[0][1]
+            footer = body[len(self._bodies[0][2]):]
+            cache  = synfu.reactor._FooterCache(path, size=2, misses=2)
+            
+            self.assertEqual(None, cache.match('test', body))
+            
+            cache.learn('test', footer)
+            self.assertEqual(footer, cache.match('test', 'other text\n' + footer))
+            self.assertEqual([1, 1], cache.stats)
+            
+            # persistent across instances
+            cache.save()
+            cache = synfu.reactor._FooterCache(path, size=2, misses=2)
+            self.assertEqual(footer, cache.match('test', body))
+            
+            # invalidated after two misses in a row
+            cache.match('test', 'no footer')
+            cache.match('test', 'no footer')
+            self.assertEqual(None, cache.match('test', body))
+            
+            # ... even if every miss happens in a process of it's own
+            cache.learn('test', footer)
+            cache.save()
+            
+            for i in xrange(2):
+                cache = synfu.reactor._FooterCache(path, size=2, misses=2)
+                self.assertEqual(1, len(cache))
+                self.assertEqual(None, cache.match('test', 'no footer'))
+                cache.save()
+            
+            cache = synfu.reactor._FooterCache(path, size=2, misses=2)
+            self.assertEqual(0, len(cache))
+            
+            # least recently used list is evicted
+            for tag in ('a', 'b', 'c'):
+                cache.learn(tag, footer)
+            
+            self.assertEqual(2, len(cache))
+            self.assertEqual(None, cache.match('a', body))
+            
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+    
+    def test_03_find_last_part(self):
+        body = 'preamble\n--BB\n\nfirst\n--BB\nContent-Type: text/plain\n\nlast\n--BB--\nepilogue\n'
+        
+        (delim, start, end, close) = self._reactor._find_last_part(StringIO(body), 0, 'BB')
+        
+        self.assertEqual('--BB\n', body[delim:start])
+        self.assertEqual('Content-Type: text/plain\n\nlast', body[start:end])
+        self.assertEqual('--BB--\nepilogue\n', body[close:])
+        
+        # no closing delimiter, the last part ends with the body
+        self.assertEqual((delim, start, end, None),
+                         self._reactor._find_last_part(StringIO(body[:close]), 0, 'BB'))
+        
+        # no part at all
+        self.assertEqual(None, self._reactor._find_last_part(StringIO(body[:body.index('--')]), 0, 'BB'))
+    
+    def test_04_serve(self):
+        path = os.path.join(tempfile.mkdtemp(), 'reactor.sock')
+        pid  = os.fork()
+        
+        if not pid:
+            try:
+                self._reactor.serve(path)
+            finally:
+                os._exit(0)
+        
+        try:
+            for num in (0, 1):
+                data = self._message(num)
+                sock = self._connect(path)
+                
+                sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+                
+                result = ''.join(iter(lambda: sock.recv(4096), ''))
+                sock.close()
+                
+                self.assertEqual(self._react(data), result)
+                self.assertTrue('\n\n' + self._bodies[0][2] in result)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        
+        # the socket is removed on SIGTERM
+        self.assertFalse(os.path.exists(path))
+        os.rmdir(os.path.dirname(path))
+    
+    def _connect(self, path, timeout=5):
+        """
+        Connect to the unix domain socket *path* once the server is listening.
+        """
+        until = time.time() + timeout
+        
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                return sock
+            except socket.error:
+                sock.close()
+                if time.time() > until:
+                    raise
+                time.sleep(0.05)
+    
+    def _batch(self, source, target, messages, workers=1):
+        """
+        Write *messages* to the mailbox *source*, run :meth:`Reactor.batch`
+        into *target* and return it's result and the messages of *target*.
+        """
+        src = synfu.reactor.Reactor._open_mailbox(source, create=True)
+        for data in messages:
+            src.add(data)
+        src.close()
+        
+        result = self._reactor.batch(source, target, workers)
+        
+        dst = synfu.reactor.Reactor._open_mailbox(target, create=False)
+        try:
+            return (result, [dst.get_string(key) for key in dst.iterkeys()])
+        finally:
+            dst.close()
+    
+    def test_05_batch(self):
+        cancel   = 'Control: cancel <0@synfu.suite>\n' + self._message(3)
+        messages = [self._message(0), cancel, self._message(1), self._message(2, 'no footer\n')]
+        expected = [self._react(data) for data in messages if data is not cancel]
+        path     = tempfile.mkdtemp()
+        
+        try:
+            # mbox keeps the order of the messages
+            (result, written) = self._batch(os.path.join(path, 'in.mbox'),
+                                            os.path.join(path, 'out.mbox'), messages)
+            self.assertEqual(0, result)
+            self.assertEqual(expected, written)
+            
+            # new Maildirs are given by a trailing separator
+            (result, written) = self._batch(os.path.join(path, 'in.maildir') + os.sep,
+                                            os.path.join(path, 'out.maildir') + os.sep, messages)
+            self.assertEqual(0, result)
+            self.assertEqual(sorted(expected), sorted(written))
+        finally:
+            shutil.rmtree(path)
+    
+    def test_06_batch_workers(self):
+        # more than one chunk per worker, sizes vary so workers finish out of order
+        messages = [self._message(num, 'line\n' * (num % 7 * 500) + self._bodies[0][1])
+                    for num in xrange(synfu.reactor.Reactor.BATCH_CHUNK * 5)]
+        expected = [self._react(data) for data in messages]
+        path     = tempfile.mkdtemp()
+        
+        try:
+            (result, written) = self._batch(os.path.join(path, 'in.mbox'),
+                                            os.path.join(path, 'out.mbox'), messages, workers=3)
+            self.assertEqual(0, result)
+            self.assertEqual(expected, written)
+        finally:
+            shutil.rmtree(path)
+    
+    def _str_dump(self, message, strip_notes):
+        """
+        The output of :meth:`Reactor._dump` before it was streamed (splitting str(message)).
+        """
+        out       = StringIO()
+        print_out = False
+        
+        for p in str(message).split('\n')[1:]:
+            if strip_notes:
+                if synfu.reactor.Reactor.SIGN_NOTICE[0].match(p) and not print_out:
+                    print_out = True
+                    continue
+                
+                if synfu.reactor.Reactor.SIGN_NOTICE[1].match(p) and not print_out:
+                    print >> out, ''
+                    print_out = True
+                    continue
+                
+                if synfu.reactor.Reactor.SIGN_NOTICE[2].match(p) and not print_out:
+                    continue
+            
+            if synfu.reactor.Reactor.BROKEN_MULTIPART.match(p):
+                p = p.replace('; boundary=', ';\n boundary=')
+            
+            print >> out, p.replace('\x0d', '')
+        
+        return out.getvalue()
+    
+    def test_07_dump(self):
+        signed = ('From: User 0 <user0@example.org>\n'
+                  'Subject: signed\n'
+                  'Content-Type: multipart/signed; boundary="SS"; protocol="application/pgp-signature"\n'
+                  '\n'
+                  'This is an OpenPGP/MIME signed message (RFC 2440 and 3156)\n'
+                  '--SS\n'
+                  'Content-Type: multipart/mixed; boundary="MM"\n'
+                  '\n'
+                  'preamble\n'
+                  '--MM\n'
+                  'Content-Type: text/plain\n'
+                  '\n'
+                  'text with\r\n'
+                  'Content-Type: multipart/mixed; boundary="XX"\n'
+                  '--MM\n'
+                  'Content-Type: text/plain\n'
+                  '\n'
+                  'second part\n'
+                  '--MM--\n'
+                  'epilogue\n'
+                  '--SS\n'
+                  'Content-Type: application/pgp-signature\n'
+                  '\n'
+                  'signature\n'
+                  '--SS--\n')
+        
+        messages = [signed, self._message(0)]
+        for path in sorted(glob.glob(os.path.join(self._data_path, '*.msg'))):
+            with open(path, 'r') as data:
+                messages.append(data.read())
+        
+        try:
+            for strip_notes in (False, True):
+                self._cfg.reactor.strip_notes = strip_notes
+                
+                for data in messages:
+                    message = email.message_from_string(data)
+                    out     = StringIO()
+                    
+                    self._reactor._dump(message, out)
+                    self.assertEqual(self._str_dump(message, strip_notes), out.getvalue())
+        finally:
+            self._cfg.reactor.strip_notes = False
+    
+    def test_08_skip_scan(self):
+        footer = self._bodies[0][1]
+        parts  = [('first', 'inline', footer),
+                  ('large', 'inline', 'x' * 2000 + '\n' + footer),
+                  ('attachment', 'attachment', footer),
+                  ('last', 'inline', footer)]
+        
+        data = [self._message(0, '').replace('text/plain', 'multipart/mixed; boundary="MM"')]
+        for (name, disposition, body) in parts:
+            data.append('--MM\nContent-Type: text/plain\nContent-Disposition: {0}; filename={1}\n\n{2}\n'.format(
+                        disposition, name, body))
+        data.append('--MM--\n')
+        
+        message = email.message_from_string(''.join(data))
+        conf    = self._cfg.reactor
+        
+        (conf.footer_parts, conf.footer_max_size, conf.footer_skip_attachments) = (3, 1000, True)
+        try:
+            payload = message.get_payload()
+            
+            self.assertEqual([None, 'attachment', 'size', 'position'],
+                             [self._reactor._skip_scan(p, i + 1) for (i, p) in enumerate(reversed(payload))])
+            
+            skipped = sum(len(p.get_payload()) for p in payload[:3])
+            message = self._reactor._process(message)
+            
+            # only the last part was scanned and lost it's footer
+            self.assertEqual([3, skipped], self._reactor._skipped)
+            self.assertEqual(self._bodies[0][2], message.get_payload(3).get_payload())
+            
+            for (i, (name, disposition, body)) in enumerate(parts[:3]):
+                self.assertEqual(body, message.get_payload(i).get_payload())
+        finally:
+            (conf.footer_parts, conf.footer_max_size, conf.footer_skip_attachments) = (0, 0, False)
+    
+    def test_09_filter_only(self):
+        body = ('CRLF line\r\n'
+                'Content-Type: multipart/mixed; boundary="XX"\r\n'
+                '\r\n'
+                'no newline at the end')
+        data = self._message(0, body).replace('Subject:', 'Received: from a by b\nSubject:')
+        
+        self._cfg.options.filter_only = True
+        try:
+            (headers, result) = self._react(data).split('\n\n', 1)
+        finally:
+            self._cfg.options.filter_only = False
+        
+        # headers are filtered, the body is copied through untouched
+        self.assertFalse('Received:' in headers)
+        self.assertEqual(body, result)
+    
+    def test_10_spill(self):
+        footer = self._bodies[0][1]
+        footer = footer[footer.index('____'):]
+        
+        def multipart(parts, close='--BB--\n'):
+            body = ''.join('--BB\nContent-Type: text/plain\n\n{0}\n'.format(p) for p in parts)
+            return self._message(0, body + close).replace(
+                'Content-Type: text/plain\n\n', 'Content-Type: multipart/mixed; boundary="BB"\n\n', 1)
+        
+        text = self._message(0, 'Gr\xfc\xdfe\n' * 100 + footer.replace('Test mailing', 'T\xe4st mailing'))
+        text = text.replace('Content-Type: text/plain\n', 'Content-Type: text/plain; charset=iso-8859-1\n'
+                                                            'Content-Transfer-Encoding: 8bit\n')
+        
+        messages = [('footer part', multipart(['x' * 400, footer.rstrip('\n')])),
+                    ('footer in last part', multipart(['x' * 600, self._bodies[0][1].rstrip('\n')])),
+                    ('large last part', multipart(['first', 'y\n' * 400])),
+                    ('large last part, no closing delimiter', multipart(['first', 'y\n' * 400], '')),
+                    ('no closing delimiter', multipart(['x' * 400, 'last'], '')),
+                    ('no closing delimiter, footer part', multipart(['x' * 400, footer.rstrip('\n')], '')),
+                    ('no complete part', multipart([]).replace('--BB--', 'x' * 600)),
+                    ('8bit text', text)]
+        
+        spilled = []
+        react   = self._reactor._react_large
+        
+        def react_large(spool, out):
+            spilled.append(True)
+            return react(spool, out)
+        
+        self._reactor._react_large = react_large
+        try:
+            for (what, data) in messages:
+                sys.stderr.write('\n    {0}..'.format(what))
+                
+                expected = self._react(data)
+                
+                self._cfg.reactor.spill_threshold = 512
+                try:
+                    self.assertEqual(expected, self._react(data))
+                finally:
+                    self._cfg.reactor.spill_threshold = 0
+            
+            self.assertEqual(len(messages), len(spilled))
+        finally:
+            del self._reactor._react_large
+        
+        # the footers were removed as usual
+        self.assertFalse('listinfo' in self._react(messages[0][1]))
+        self.assertFalse('listinfo' in self._react(messages[1][1]))
+        self.assertFalse('listinfo' in self._react(messages[5][1]))
+        self.assertFalse('listinfo' in self._react(messages[-1][1]))
+        
+        sys.stderr.write('\n -- ')
@@ -0,0 +1,105 @@
+# encoding: utf-8
+#
+#  spool.py 
+#
+# Copyright (c) 2010 René Köcher <shirk@bitspin.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modifica-
+# tion, are permitted provided that the following conditions are met:
+# 
+#   1.  Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+# 
+#   2.  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ''AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MER-
+# CHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+# EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPE-
+# CIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+# OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTH-
+# ERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import sys, os, time, shutil, tempfile, unittest
+from cStringIO import StringIO
+import synfu.spool
+
+class SpoolSuite(unittest.TestCase):
+    def setUp(self):
+        self._path  = tempfile.mkdtemp()
+        self._spool = synfu.spool.Spool(self._path, compress=64)
+    
+    def tearDown(self):
+        shutil.rmtree(self._path)
+    
+    def test_00_put_claim(self):
+        small = 'Subject: small\n\nbody\n'
+        large = 'Subject: large\n\n' + 'line of text\n' * 100
+        
+        names = [self._spool.put(StringIO(small)), self._spool.put(StringIO(large))]
+        
+        self.assertFalse(names[0].endswith('.gz'))
+        self.assertTrue(names[1].endswith('.gz'))
+        self.assertTrue(os.path.getsize(os.path.join(self._path, 'new', names[1])) < len(large))
+        self.assertEqual([], os.listdir(os.path.join(self._path, 'tmp')))
+        
+        self.assertEqual(names[:1], self._spool.claim(1))
+        self.assertEqual(names[1:], self._spool.claim(10))
+        self.assertEqual([], self._spool.claim(10))
+        
+        for (name, data) in zip(names, [small, large]):
+            fobj = self._spool.open(name)
+            self.assertEqual(data, fobj.read())
+            fobj.close()
+            
+            self._spool.done(name)
+        
+        self.assertEqual([], os.listdir(os.path.join(self._path, 'cur')))
+    
+    def test_01_retry_fail(self):
+        names = [self._spool.put(StringIO('Subject: {0}\n\n'.format(i))) for i in xrange(3)]
+        
+        self.assertEqual(names, self._spool.claim(10))
+        self._spool.retry(names[0])
+        self._spool.fail(names[1])
+        
+        self.assertEqual(names[:1], os.listdir(os.path.join(self._path, 'new')))
+        self.assertEqual(names[1:2], os.listdir(os.path.join(self._path, 'failed')))
+        
+        # the drainer of names[2] died
+        self.assertEqual([], self._spool.recover())
+        os.utime(os.path.join(self._path, 'cur', names[2]), (time.time() - 7200, time.time() - 7200))
+        self.assertEqual(names[2:], self._spool.recover())
+        
+        self.assertEqual([names[0], names[2]], self._spool.claim(10))
+    
+    def test_02_age(self):
+        name = self._spool.put(StringIO('Subject: age\n\n'))
+        
+        self.assertTrue(0 <= self._spool.age(name) < 60)
+        self.assertTrue(self._spool.age('1000000000.000000.P1Q1.synfu') > 86400)
+    
+    def test_03_sync(self):
+        synced = []
+        sync   = self._spool._sync
+        
+        def record(*names):
+            synced.append(names)
+            return sync(*names)
+        
+        self._spool._sync = record
+        
+        names = [self._spool.put(StringIO('Subject: {0}\n\n'.format(i))) for i in xrange(2)]
+        self.assertEqual(names, self._spool.claim(10))
+        self._spool.retry(names[0])
+        self._spool.fail(names[1])
+        
+        # the new/ entries are on disk once put() returns
+        self.assertEqual([('new',), ('new',), ('new', 'cur'), ('cur', 'new'), ('cur', 'failed')], synced)
@@ -30,13 +30,19 @@
 #
 
 import unittest
-import config, fucore
+import config, blacklist, fucore, reactor, nntp, spool, postfilter
 
 def additional_tests():
     config_suite = unittest.TestLoader().loadTestsFromTestCase(config.ConfigSuite)
-    fucore_suite = unittest.TestLoader().loadTestsFromTestCase(fucore.FUCoreSuite)
+    blacklist_suite = unittest.TestLoader().loadTestsFromTestCase(blacklist.BlacklistSuite)
+    fucore_suite  = unittest.TestLoader().loadTestsFromTestCase(fucore.FUCoreSuite)
+    reactor_suite = unittest.TestLoader().loadTestsFromTestCase(reactor.ReactorSuite)
+    nntp_suite    = unittest.TestLoader().loadTestsFromTestCase(nntp.NNTPSuite)
+    spool_suite   = unittest.TestLoader().loadTestsFromTestCase(spool.SpoolSuite)
+    postfilter_suite = unittest.TestLoader().loadTestsFromTestCase(postfilter.PostFilterSuite)
     
-    suite = unittest.TestSuite([config_suite, fucore_suite])
+    suite = unittest.TestSuite([config_suite, blacklist_suite, fucore_suite, reactor_suite,
+                                nntp_suite, spool_suite, postfilter_suite])
     
     return suite
 